@@ -0,0 +1,66 @@
+"""Benchmark of strict and trusted ingest of large synthetic race logs for module <report>
+
+Run from the repository root:
+    $ python -m packaging_tutorial.benchmarks.bench_ingest --drivers 17576
+"""
+import itertools
+import os
+import random
+import string
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+
+from packaging_tutorial.report_FEDONYUK import report
+
+
+def write_synthetic_race(path: str, drivers: int, seed: int = 2018) -> None:
+    """Function writes abbreviations.txt, start.log and end.log with one lap for every synthetic driver"""
+    rnd = random.Random(seed)
+    codes = [''.join(c) for c in itertools.islice(itertools.product(string.ascii_uppercase, repeat=3), drivers)]
+    start = datetime(2018, 5, 24, 12)
+    with open(os.path.join(path, report.ABBREVIATION_TXT), 'w', encoding='utf-8') as abbreviations, \
+            open(os.path.join(path, report.START_LOG), 'w', encoding='utf-8') as start_log, \
+            open(os.path.join(path, report.END_LOG), 'w', encoding='utf-8') as end_log:
+        for code in codes:
+            abbreviations.write(f"{code}_{code.title()} {code[::-1].title()}_TEAM {code[0]}\n")
+            lap_start = start + timedelta(milliseconds=rnd.randrange(3_600_000))
+            lap_end = lap_start + timedelta(milliseconds=rnd.randrange(60_000, 120_000))
+            start_log.write(f"{code}{lap_start.isoformat(sep='_', timespec='milliseconds')}\n")
+            end_log.write(f"{code}{lap_end.isoformat(sep='_', timespec='milliseconds')}\n")
+
+
+def timeit(func, repeat: int) -> float:
+    """Function returns the best wall time of several runs"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+@click.command()
+@click.option('--drivers', default=17_576, show_default=True, help='Number of synthetic drivers (max 17576).')
+@click.option('--repeat', default=3, show_default=True, help='Runs per mode, the best time is reported.')
+def main(drivers: int, repeat: int) -> None:
+    """Compare strict per-row validation with the trusted ingest mode."""
+    with tempfile.TemporaryDirectory() as path:
+        write_synthetic_race(path, drivers)
+        strict = timeit(lambda: report.build_report(path=path), repeat)
+        trusted = timeit(lambda: report.build_report(path=path, trusted=True), repeat)
+        assert report.build_report(path=path) == report.build_report(path=path, trusted=True)
+        rows = [{'driver_id': dr.driver_id, 'name': dr.name, 'team': dr.team, 'start_lap': dr.start_lap,
+                 'end_lap': dr.end_lap} for dr in report.get_drivers(path, trusted=True)]
+        strict_rows = timeit(lambda: report.build_drivers(rows), repeat)
+        trusted_rows = timeit(lambda: report.build_drivers(rows, trusted=True), repeat)
+    print(f"drivers: {drivers}")
+    print(f"build_report   strict: {strict:.3f} s  trusted: {trusted:.3f} s  (x{strict / trusted:.2f})")
+    print(f"build_drivers  strict: {strict_rows:.3f} s  trusted: {trusted_rows:.3f} s  "
+          f"(x{strict_rows / trusted_rows:.2f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""This module is a query-aware caching layer of the Web and REST API report of Monaco 2018 Racing"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from datetime import timezone
+from flask import Response, make_response, request
+from flask_caching import Cache
+from werkzeug.http import http_date, quote_etag
+from loguru import logger
+
+from packaging_tutorial.report_FEDONYUK.db_util import get_data_version_info, snapshot_dir, snapshot_version
+from packaging_tutorial.report_FEDONYUK.metrics import CACHE_SECONDS, CallbackMetric
+from packaging_tutorial.report_FEDONYUK.models import DEFAULT_SESSION
+
+NORMALIZED = {'order', 'driver_id', 'format', 'race', 'session'}  # Query parameters with a normalized form in the key
+CACHE_TIMEOUT = 24 * 60 * 60  # Entries of an old data version are never read again, they only wait for eviction
+LOCAL_CACHE_SIZE = 256  # Entries kept in the memory of every worker
+LOCAL_CACHE_TTL = 300  # Seconds an entry stays in the memory of a worker
+FAILURE_THRESHOLD = 3  # Consecutive Redis errors that open the circuit
+RESET_TIMEOUT = 30  # Seconds before an open circuit lets one request try Redis again
+VERSION_TTL = 1.0  # Seconds the validators of a worker rely on the data version they read last
+ENCODINGS = ('gzip', 'br')  # Content codings of a response, each one has its own ETag
+CACHE_CONTROL = 'public, max-age=0, must-revalidate'  # Clients and the CDN keep the report, but revalidate it
+
+
+class LocalCache:
+    """Bounded in-process LRU cache with a TTL, the first tier in front of Redis"""
+
+    def __init__(self, size: int = LOCAL_CACHE_SIZE, ttl: float = LOCAL_CACHE_TTL):
+        self.size, self.ttl = size, ttl
+        self.entries = OrderedDict()  # key -> (expiry time, value), the least recently used first
+        self.lock = Lock()
+
+    def get(self, key: str):
+        """Function returns the value of a key or None when it is missing or expired"""
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key: str, value) -> None:
+        """Function stores a value and evicts the least recently used entries over the size"""
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Function drops all entries"""
+        with self.lock:
+            self.entries.clear()
+
+
+class CircuitBreaker:
+    """Circuit breaker of Redis: opened by consecutive errors, half-open after reset_timeout.
+
+    A half-open circuit lets one probe call through and rejects the others: the probe closes the circuit, or its
+    failure opens it again for reset_timeout."""
+
+    def __init__(self, threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT):
+        self.threshold, self.reset_timeout = threshold, reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.half_open = False  # a probe call is in progress
+        self.lock = Lock()
+
+    def is_open(self) -> bool:
+        """Function tells if the calls are rejected now, without taking the probe"""
+        return self.opened_at is not None and \
+            (self.half_open or time.monotonic() - self.opened_at < self.reset_timeout)
+
+    def allow(self) -> bool:
+        """Function tells if Redis may be called: the circuit is closed, or this call is the probe of a half-open one"""
+        if self.opened_at is None:
+            return True
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.half_open or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.half_open = True
+            return True
+
+    def success(self) -> None:
+        """Function closes the circuit after a successful call"""
+        if self.opened_at is not None:
+            logger.info("[INFO] Redis is available again, the shared cache is back.")
+        with self.lock:
+            self.failures, self.opened_at, self.half_open = 0, None, False
+
+    def failure(self, error: Exception) -> None:
+        """Function counts a failed call and opens the circuit at the threshold or when the probe fails"""
+        with self.lock:
+            self.failures += 1
+            if self.half_open or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.error(f"[ERROR] Redis is not available, local cache only for {self.reset_timeout} s: {error}")
+                self.opened_at, self.half_open = time.monotonic(), False
+
+
+class TieredCache:
+    """Two-tier cache: the LocalCache of the worker, then the shared Redis cache behind a CircuitBreaker"""
+
+    def __init__(self, shared: Cache, local: LocalCache = None, breaker: CircuitBreaker = None):
+        self.shared = shared
+        self.local = local or LocalCache()
+        self.breaker = breaker or CircuitBreaker()
+        self.counters = dict.fromkeys(('local_hits', 'shared_hits', 'misses', 'shared_errors', 'shared_calls'), 0)
+        self.shared_seconds = 0.0
+
+    def call_shared(self, method: str, *args):
+        """Function calls the shared cache through the circuit breaker, returns None when it is skipped or fails"""
+        if not self.breaker.allow():
+            return None
+        started = time.perf_counter()
+        try:
+            result = getattr(self.shared, method)(*args)
+        except Exception as e:
+            self.counters['shared_errors'] += 1
+            self.breaker.failure(e)
+            return None
+        finally:
+            elapsed = time.perf_counter() - started
+            self.counters['shared_calls'] += 1
+            self.shared_seconds += elapsed
+            CACHE_SECONDS.observe(elapsed, method)
+        self.breaker.success()
+        return result
+
+    def get(self, key: str):
+        """Function looks a key up in the local tier first, then in the shared one"""
+        value = self.local.get(key)
+        if value is not None:
+            self.counters['local_hits'] += 1
+            return value
+        value = self.call_shared('get', key)
+        if value is None:
+            self.counters['misses'] += 1
+            return None
+        self.counters['shared_hits'] += 1
+        self.local.set(key, value)
+        return value
+
+    def set(self, key: str, value) -> None:
+        """Function stores a value in both tiers"""
+        self.local.set(key, value)
+        self.call_shared('set', key, value, CACHE_TIMEOUT)
+
+    def lookups(self) -> dict:
+        """Function returns the number of lookups by result: local_hit, shared_hit, miss"""
+        return {('local_hit',): self.counters['local_hits'], ('shared_hit',): self.counters['shared_hits'],
+                ('miss',): self.counters['misses']}
+
+    def hit_ratio(self) -> float:
+        """Function returns the share of the lookups answered by either tier, 0.0 before the first lookup"""
+        hits = self.counters['local_hits'] + self.counters['shared_hits']
+        return hits / (hits + self.counters['misses']) if hits else 0.0
+
+    def stats(self) -> dict:
+        """Function returns the hit/miss counters and the mean latency of the shared tier in ms"""
+        calls = self.counters['shared_calls']
+        return {**self.counters, 'shared_latency_ms': 1000 * self.shared_seconds / calls if calls else 0.0,
+                'circuit_open': self.breaker.is_open()}
+
+
+class LazyCache:
+    """Cache backend built by its first call, so a worker starts without importing or configuring the Redis client"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.backend = None
+        self.lock = Lock()
+
+    def __getattr__(self, name: str):
+        if self.backend is None:
+            with self.lock:
+                if self.backend is None:
+                    self.backend = self.factory()
+        return getattr(self.backend, name)
+
+
+def lazy_redis_cache(app, config, args, options) -> LazyCache:
+    """Factory of Flask-Caching (the CACHE_TYPE of an app) for a Redis cache on the client that
+    config['CACHE_REDIS_CLIENT'] returns on the first use of the cache"""
+    def factory():
+        from flask_caching.backends import RedisCache
+        return RedisCache(host=config['CACHE_REDIS_CLIENT'](), key_prefix=config['CACHE_KEY_PREFIX'], **options)
+    return LazyCache(factory)
+
+
+cache = Cache()
+tiered_cache = TieredCache(cache)
+CallbackMetric('report_cache_lookups_total', 'Lookups of the report cache by result.', 'counter',
+               tiered_cache.lookups, ('result',))
+CallbackMetric('report_cache_hit_ratio', 'Share of the lookups of the report cache answered by a tier.', 'gauge',
+               lambda: {(): tiered_cache.hit_ratio()})
+
+
+def query_key() -> str:
+    """Function normalizes the query parameters that select a response: order, driver_id, format, race, session,
+    then every other parameter (paging, projection, filters) as given"""
+    args = request.args
+    order = 'desc' if args.get('order') == 'desc' else 'asc'
+    return json.dumps([order, args.get('driver_id'), args.get('format', 'json'), args.get('race'),
+                       args.get('session', DEFAULT_SESSION),
+                       sorted((name, value) for name, value in args.items(multi=True) if name not in NORMALIZED)])
+
+
+def freeze(result):
+    """Function turns a view result into a cache entry, returns None for a result that must not be cached"""
+    if isinstance(result, Response):
+        if result.status_code >= 400 or result.is_streamed:  # a stream is never held in memory
+            return None
+        headers = [(name, value) for name, value in result.headers.items() if name != 'Content-Length']
+        return 'response', result.get_data(), result.status_code, headers
+    if isinstance(result, tuple) and result[1] >= 400:
+        return None
+    return 'value', result
+
+
+def thaw(entry):
+    """Function turns a cache entry back into a view result"""
+    if entry[0] == 'response':
+        return Response(entry[1], status=entry[2], headers=entry[3])
+    return entry[1]
+
+
+def cached_query(view):
+    """Decorator caches a view of the report by its path, normalized query and the version of its source.
+
+    An import bumps the data version, so the requests miss once version_memo reads it (VERSION_TTL at most) and
+    no entry outlives the data it was built from. A hit makes no database query."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = f"{request.path}:{source_version()[0]}:{query_key()}"
+        entry = tiered_cache.get(key)
+        if entry is not None:
+            return thaw(entry)
+        result = view(*args, **kwargs)
+        if (entry := freeze(result)) is not None:
+            tiered_cache.set(key, entry)
+        return result
+    return wrapper
+
+
+class VersionMemo:
+    """Data version and its import time, read from the database at most once per ttl by every worker"""
+
+    def __init__(self, ttl: float = VERSION_TTL):
+        self.ttl = ttl
+        self.value, self.expires = None, 0.0
+
+    def cached(self) -> tuple | None:
+        """Function returns (version, updated_at) read less than ttl ago, None when it must be read again"""
+        return self.value if time.monotonic() < self.expires else None
+
+    def update(self, value: tuple) -> tuple:
+        """Function keeps (version, updated_at) just read for ttl seconds"""
+        self.value, self.expires = value, time.monotonic() + self.ttl
+        return value
+
+    def get(self) -> tuple:
+        """Function returns (version, updated_at) of the stored data"""
+        value = self.cached()
+        return value if value is not None else self.update(get_data_version_info())
+
+
+version_memo = VersionMemo()
+
+
+def source_version(data_version: tuple = None, app=None) -> tuple:
+    """Function returns (version, updated_at) of the data the requests of an app (the current one) are answered from:
+    the data version (of version_memo unless given), combined with the version of the race snapshot of
+    REPORT_SNAPSHOT_DIR when the app sets it, so the cached responses, the ETags and the snapshots change with
+    either source"""
+    version, updated_at = data_version or version_memo.get()
+    if (path := snapshot_dir(app)) is None:
+        return version, updated_at
+    snapshot, changed_at = snapshot_version(path)
+    return f"{version}.{snapshot}", max(updated_at, changed_at) if updated_at else changed_at
+
+
+def entity_tag(version: int, path: str, args) -> str:
+    """Function derives the strong ETag of a request from the data version, its path and its query"""
+    query = json.dumps(sorted(args.items(multi=True)))
+    return f"v{version}-" + hashlib.sha256(f"{path}?{query}".encode()).hexdigest()[:16]
+
+
+def not_modified(etag: str, updated_at, if_none_match, if_modified_since) -> str | None:
+    """Function returns the ETag a conditional request already holds, None when the response must be sent.
+
+    A gzip or brotli variant is tagged etag-gzip or etag-br and is valid as long as the data version is the same."""
+    if if_none_match:
+        tags = (etag, *(f"{etag}-{encoding}" for encoding in ENCODINGS))
+        return next((tag for tag in tags if if_none_match.contains_weak(tag)), None)
+    if updated_at and if_modified_since:
+        return etag if updated_at.replace(tzinfo=timezone.utc) <= if_modified_since else None
+    return None
+
+
+def validators(etag: str, updated_at) -> dict:
+    """Function returns the ETag, Last-Modified and Cache-Control headers of a report response"""
+    headers = {'ETag': quote_etag(etag), 'Cache-Control': CACHE_CONTROL}
+    if updated_at:
+        headers['Last-Modified'] = http_date(updated_at.replace(tzinfo=timezone.utc))
+    return headers
+
+
+def conditional_get(view):
+    """Decorator answers If-None-Match and If-Modified-Since with 304 from the version of the source alone, before
+    the snapshots, the cache, the database or the templates, and adds the validators to every 200 response."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = source_version()
+        etag = entity_tag(version, request.path, request.args)
+        if (held := not_modified(etag, updated_at, request.if_none_match, request.if_modified_since)) is not None:
+            return Response(status=304, headers=validators(held, updated_at))
+        result = view(*args, **kwargs)
+        if isinstance(result, tuple):  # data of a REST resource, serialized by flask_restful
+            headers = result[2] if len(result) > 2 else {}
+            return (result[0], 200, {**headers, **validators(etag, updated_at)}) if result[1] == 200 else result
+        response = make_response(result)
+        if response.status_code == 200:
+            if (encoding := response.headers.get('Content-Encoding')) in ENCODINGS:
+                etag = f"{etag}-{encoding}"  # a strong ETag differs between the encodings of a response
+            response.headers.update(validators(etag, updated_at))
+        return response
+    return wrapper
@@ -0,0 +1,116 @@
+"""This module exports the report of Monaco 2018 Racing in binary columnar formats: Arrow IPC, Parquet, MessagePack"""
+from flask import make_response
+
+from packaging_tutorial.report_FEDONYUK.db_util import stream_source, get_drivers, encode_cursor, read_connection, \
+    FIELDS
+from packaging_tutorial.report_FEDONYUK.models import DEFAULT_SESSION
+
+try:
+    import msgpack
+except ImportError:  # optional: format=msgpack needs the msgpack package
+    msgpack = None
+
+COLUMNAR_FORMATS = ('arrow', 'parquet', 'msgpack')
+COLUMNAR_TYPES = {'arrow': 'application/vnd.apache.arrow.stream', 'parquet': 'application/vnd.apache.parquet',
+                  'msgpack': 'application/msgpack'}
+DRIVER_COLUMNS = ('name', 'driver_id')  # Columns of the drivers list
+COLUMNS = {'position': 'int64', 'driver_id': 'string', 'name': 'string', 'team': 'string', 'best_lap_ms': 'int64'}
+_PENDING = object()
+pyarrow = _PENDING  # imported by the first Arrow or Parquet export, it doubles the start time of a worker
+
+
+def load_pyarrow():
+    """Function imports pyarrow on first use, None when it is not installed (optional: format=arrow and
+    format=parquet need the pyarrow package)"""
+    global pyarrow
+    if pyarrow is _PENDING:
+        try:
+            import pyarrow.parquet  # binds the global pyarrow, with its parquet module loaded
+        except ImportError:
+            pyarrow = None
+    return pyarrow
+
+
+def columnar_fields(fields: tuple = FIELDS) -> tuple:
+    """Function maps the fields of a report to its columns, the lap time is an int64 number of milliseconds"""
+    return tuple('best_lap_ms' if field == 'best_lap' else field for field in fields)
+
+
+def check_format(data_format: str) -> None:
+    """Function raises ValueError for a columnar format whose package is not installed"""
+    if (msgpack if data_format == 'msgpack' else load_pyarrow()) is None:
+        raise ValueError(f"Unavailable format: {data_format}")
+
+
+def encode_columns(batches, names: tuple, data_format: str) -> bytes:
+    """Function encodes batches of database rows column by column, only the first len(names) values of a row.
+
+    Arrow and Parquet get one record batch per batch of rows, MessagePack a map of column name to values."""
+    if data_format == 'msgpack':
+        columns = {name: [] for name in names}
+        for rows in batches:
+            for name, values in zip(names, zip(*rows)):
+                columns[name].extend(values)
+        return msgpack.packb(columns)
+    schema = pyarrow.schema([(name, COLUMNS[name]) for name in names])
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.ipc.new_stream(sink, schema) if data_format == 'arrow' else \
+        pyarrow.parquet.ParquetWriter(sink, schema)
+    with writer:
+        for rows in batches:
+            if rows:
+                arrays = [pyarrow.array(values, field.type) for values, field in zip(zip(*rows), schema)]
+                writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+    return sink.getvalue().to_pybytes()
+
+
+def encode_report(batches, names: tuple, data_format: str, limit: int = None) -> tuple[bytes, str | None]:
+    """Function encodes the batches of rows of a report statement and returns the cursor of the next page"""
+    count, last = 0, None
+
+    def counted():
+        nonlocal count, last
+        for rows in batches:
+            count, last = count + len(rows), rows[-1] if rows else last
+            yield rows
+    body = encode_columns(counted(), names, data_format)
+    return body, encode_cursor(last) if limit and count == limit else None
+
+
+def report_export(data_format: str, asc: bool = True, driver: str = None, race: str = None,
+                  session: str = DEFAULT_SESSION, limit: int = None, cursor: str = None, fields: tuple = FIELDS,
+                  team: str = None, max_lap: int = None, app=None) -> tuple[tuple, list | None, tuple | None]:
+    """Function checks the format of a report export and selects its rows without I/O, shared by export_report and
+    report_asgi: (column names, batches read from the race snapshot, None) or (column names, None, statement)"""
+    check_format(data_format)
+    names = columnar_fields(fields)
+    return (names, *stream_source(asc, driver, limit, race, session, team, max_lap, cursor, names, app=app))
+
+
+def export_report(data_format: str, asc: bool = True, driver: str = None, race: str = None,
+                  session: str = DEFAULT_SESSION, limit: int = None, cursor: str = None, fields: tuple = FIELDS,
+                  team: str = None, max_lap: int = None) -> tuple[bytes, str | None]:
+    """Function encodes a page of the report straight from the batches of the database cursor, or of the race
+    snapshot of REPORT_SNAPSHOT_DIR without a race selector"""
+    names, batches, statement = report_export(data_format, asc, driver, race, session, limit, cursor, fields, team,
+                                              max_lap)
+    if statement is None:
+        return encode_report(batches, names, data_format, limit)
+    with read_connection() as connection:
+        return encode_report(connection.execute(*statement).partitions(), names, data_format, limit)
+
+
+def export_drivers(data_format: str, asc: bool = True, race: str = None, session: str = DEFAULT_SESSION) -> bytes:
+    """Function encodes the list of drivers ordered by name"""
+    check_format(data_format)
+    return encode_columns([get_drivers(asc, race, session)], DRIVER_COLUMNS, data_format)
+
+
+def columnar_headers(data_format: str, cursor: str = None) -> dict:
+    """Function returns the headers of an export: the media type of its format and the cursor of the next page"""
+    return {'Content-Type': COLUMNAR_TYPES[data_format], **({'X-Next-Cursor': cursor} if cursor else {})}
+
+
+def columnar_response(body: bytes, data_format: str, cursor: str = None):
+    """Function writes an export with the media type of its format"""
+    return make_response(body, 200, columnar_headers(data_format, cursor))
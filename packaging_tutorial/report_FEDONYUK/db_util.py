@@ -1,39 +1,401 @@
 """---This module provides utilities for working with the database---"""
+import base64
+import hashlib
+import json
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from flask import current_app
 from loguru import logger
+from sqlalchemy import Integer, bindparam, create_engine, event, func, select, tuple_
 
-from packaging_tutorial.report_FEDONYUK.models import db, DriverModel
+from packaging_tutorial.report_FEDONYUK.metrics import DB_QUERY_SECONDS, timed
+from packaging_tutorial.report_FEDONYUK.report import load_snapshot, snapshot_stamp
+from packaging_tutorial.report_FEDONYUK.models import db, DriverModel, RaceModel, SessionModel, TeamModel, \
+    RacerModel, LapModel, DataVersion, DEFAULT_SESSION, format_timedelta
 
-logger.add('debug.log', format='{time} {level} {message}', level='DEBUG')
+FIELDS = ('position', 'driver_id', 'name', 'team', 'best_lap')  # Columns of a report row
+STREAM_BATCH = 500  # Rows fetched from the database cursor at a time by a streamed report
+READER_ENGINE = 'report_reader'  # Key of the reader engine in the extensions of an app
+READER_POOL_SIZE = 8  # Reader connections kept open by every worker
+STATEMENT_CACHE_SIZE = 256  # Statements kept built by the read path and prepared by every reader connection
+SNAPSHOT_DIR = 'REPORT_SNAPSHOT_DIR'  # Race directory whose binary snapshot serves the report without a race selector
+READER_PRAGMAS = ('PRAGMA query_only=ON', 'PRAGMA mmap_size=268435456', 'PRAGMA cache_size=-16384',
+                  'PRAGMA temp_store=MEMORY', 'PRAGMA busy_timeout=5000')  # 256 MB mapped, 16 MB of page cache
 
 
-def get_report(asc: bool = True, driver: str = None) -> list[list]:
-    """Building an overall or separate report on the Monaco race F1 2018 from monaco.db"""
-    try:
-        query = db.session.query(DriverModel).order_by(DriverModel.id)
+def reader_pragmas(dbapi_connection, connection_record) -> None:
+    """Event listener tunes a new reader connection: read only, memory-mapped I/O, larger page cache. In WAL mode
+    (set by the imports) readers never wait for an import and an import never waits for them."""
+    cursor = dbapi_connection.cursor()
+    for pragma in READER_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def init_read_path(app, url: str) -> None:
+    """Function gives an app the engine of its read path: a tuned pool of read-only connections, on an SQLite file
+    each one with a larger cache of prepared statements, on a server database (a read replica) with health checks"""
+    if url.startswith('sqlite'):
+        engine = create_engine(url, pool_size=READER_POOL_SIZE, max_overflow=2 * READER_POOL_SIZE, pool_recycle=-1,
+                               connect_args={'check_same_thread': False, 'cached_statements': STATEMENT_CACHE_SIZE})
+        event.listen(engine, 'connect', reader_pragmas)
+    else:
+        engine = create_engine(url, pool_size=READER_POOL_SIZE, max_overflow=2 * READER_POOL_SIZE, pool_recycle=1800,
+                               pool_pre_ping=True, connect_args={'options': '-c default_transaction_read_only=on'})
+    app.extensions[READER_ENGINE] = engine
+
+
+def enable_wal() -> None:
+    """Function switches the SQLite database to the WAL journal, which is kept by the database file"""
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+
+@contextmanager
+def read_connection():
+    """Context manager yields the connection of the read path: a pooled Core connection of the reader engine, which
+    returns plain row tuples without the ORM session, or the session of an app without a read path"""
+    engine = current_app.extensions.get(READER_ENGINE)
+    if engine is None:
+        yield db.session
+        return
+    with engine.connect() as connection:
+        yield connection
+
 
+@lru_cache(maxsize=1)
+def session_best_laps():
+    """Statement of the best lap of every driver in the session :session of the race :race, read by a range scan of
+    the laps index"""
+    lap_rank = func.row_number().over(partition_by=LapModel.driver_id, order_by=(LapModel.lap_time_ms, LapModel.id))
+    laps = (select(LapModel.driver_id, LapModel.team_id, LapModel.lap_time_ms, lap_rank.label('lap_rank'))
+            .join(SessionModel, SessionModel.id == LapModel.session_id)
+            .join(RaceModel, RaceModel.id == SessionModel.race_id)
+            .where(RaceModel.slug == bindparam('race'), SessionModel.name == bindparam('session')).subquery())
+    return (select(RacerModel.code.label('driver_id'), RacerModel.name, TeamModel.name.label('team'),
+                   laps.c.lap_time_ms.label('best_lap_ms'))
+            .select_from(laps)
+            .join(RacerModel, RacerModel.id == laps.c.driver_id)
+            .join(TeamModel, TeamModel.id == laps.c.team_id)
+            .where(laps.c.lap_rank == 1))
+
+
+def sort_order(columns, asc: bool = True) -> tuple:
+    """Function returns the order of the sort key (best_lap_ms, tie_break) of the report rows"""
+    return (columns.best_lap_ms, columns.tie_break) if asc else (columns.best_lap_ms.desc(), columns.tie_break.desc())
+
+
+def key_filters(statement, columns, asc: bool = True, slower_than: bool = False, max_lap: bool = False,
+                after: bool = False):
+    """Function adds the lap-time filters :slower_than and :max_lap and the keyset predicate on the sort key
+    (best_lap_ms, tie_break) after (:after_lap, :after_tie)"""
+    if slower_than:
+        statement = statement.where(columns.best_lap_ms > bindparam('slower_than', type_=Integer))
+    if max_lap:
+        statement = statement.where(columns.best_lap_ms <= bindparam('max_lap', type_=Integer))
+    if after:
+        key = tuple_(columns.best_lap_ms, columns.tie_break)
+        last = tuple_(bindparam('after_lap', type_=Integer), bindparam('after_tie', type_=columns.tie_break.type))
+        statement = statement.where(key > last if asc else key < last)
+    return statement
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def report_shape(asc: bool = True, driver: bool = False, limit: bool = False, slower_than: bool = False,
+                 race: bool = False, team: bool = False, max_lap: bool = False, after: int = 0,
+                 fields: tuple = FIELDS):
+    """Statement of the report for one shape of query: every value (race, filters, cursor, limit) is a bound
+    parameter, so a statement is built once per shape and reused with its compiled form by every page and filter.
+    after is the length of the decoded cursor, 0 without one.
+
+    Only the requested fields are selected, followed by the sort key (best_lap_ms, tie-break) of the lap-time
+    index and the position. The lap-time filters, the keyset predicate and the limit run on the lap-time index and the
+    positions of a page are counted on from the position of the cursor. Only a team or a driver filter, whose rows
+    are not consecutive positions, ranks the whole report."""
+    if race:
+        best_laps = session_best_laps().subquery()
+        source = select(best_laps, best_laps.c.best_lap_ms.label('best_lap'),
+                        best_laps.c.driver_id.label('tie_break')).subquery()
+    else:
+        source = select(DriverModel.driver_id, DriverModel.name, DriverModel.team, DriverModel.best_lap,
+                        DriverModel.best_lap_ms, DriverModel.id.label('tie_break')).subquery()
+    page_limit = bindparam('limit', type_=Integer) if limit else None
+    if driver or team or after == 2:  # a cursor without position ranks the report
+        position = func.row_number().over(order_by=sort_order(source.c))
+        ranked = select(source, position.label('position')).subquery()
+        statement = key_filters(select(ranked), ranked.c, asc, slower_than, max_lap, after > 0)
         if driver:
-            query = query.filter_by(driver_id=driver)
-        report = [[dr.id, dr.driver_id, dr.name, dr.team, dr.best_lap] for dr in query.all()]
-        if not asc:
-            report.reverse()
+            statement = statement.where(ranked.c.driver_id == bindparam('driver'))
+        if team:
+            statement = statement.where(ranked.c.team == bindparam('team'))
+        page = statement.order_by(*sort_order(ranked.c, asc)).limit(page_limit).subquery()
+        position = page.c.position
+    else:
+        page = key_filters(select(source), source.c, asc, slower_than, max_lap, after > 0) \
+            .order_by(*sort_order(source.c, asc)).limit(page_limit).subquery()
+        if after:
+            start = bindparam('after_position', type_=Integer)
+        elif asc:  # the rows before the first one are the laps filtered out by slower_than
+            start = 0 if not slower_than else select(func.count()).select_from(source) \
+                .where(source.c.best_lap_ms <= bindparam('slower_than', type_=Integer)).scalar_subquery()
+        else:  # the last position is the number of rows not filtered out by max_lap
+            start = key_filters(select(func.count() + 1).select_from(source), source.c,
+                                max_lap=max_lap).scalar_subquery()
+        rank = func.row_number().over(order_by=sort_order(page.c, asc))
+        position = start + rank if asc else start - rank
+    columns = [position.label('position') if field == 'position' else page.c[field] for field in fields]
+    return select(*columns, page.c.best_lap_ms, page.c.tie_break, position.label('cursor_position')) \
+        .order_by(*sort_order(page.c, asc))
+
+
+def report_statement(asc: bool = True, driver: str = None, limit: int = None, slower_than: int = None,
+                     race: str = None, session: str = DEFAULT_SESSION, team: str = None, max_lap: int = None,
+                     after: tuple = None, fields: tuple = FIELDS) -> tuple:
+    """Statement of the report and its parameters, shared by the synchronous and the asynchronous (report_asgi)
+    database access: connection.execute(*report_statement(...)). after is the sort key and the position of the last
+    row of the previous page (keyset pagination)."""
+    params = {name: value for name, value, used in (
+        ('driver', driver, bool(driver)), ('limit', limit, bool(limit)), ('team', team, bool(team)),
+        ('slower_than', slower_than, slower_than is not None), ('max_lap', max_lap, max_lap is not None)) if used}
+    if race:
+        params.update(race=race, session=session)
+    params.update(zip(('after_lap', 'after_tie', 'after_position'), after or ()))
+    statement = report_shape(asc, 'driver' in params, 'limit' in params, 'slower_than' in params, bool(race),
+                             'team' in params, 'max_lap' in params, len(after or ()), fields)
+    return statement, params
+
+
+def report_rows(rows, race: str = None, fields: tuple = FIELDS) -> list[list]:
+    """Function turns the rows of report_statement into the report, lap times of a race session are formatted"""
+    report = [list(row[:len(fields)]) for row in rows]
+    if race and 'best_lap' in fields:
+        index = fields.index('best_lap')
+        for row in report:
+            row[index] = format_timedelta(timedelta(milliseconds=row[index]))
+    return report
+
+
+def encode_cursor(row) -> str:
+    """Function encodes the sort key and the position of a row of report_statement into an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(list(row[-3:])).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Function decodes a cursor of encode_cursor, ValueError for a cursor that was not made by it.
+    A cursor of an older version, without position, is decoded to the sort key only."""
+    try:
+        best_lap_ms, tie_break, *position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(best_lap_ms, int) or not isinstance(tie_break, (int, str)) or len(position) > 1 \
+            or not all(isinstance(value, int) for value in position):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return best_lap_ms, tie_break, *position
+
+
+@lru_cache(maxsize=2)
+def drivers_shape(race: bool = False):
+    """Statement of the drivers list ordered by name, of the race session (:race, :session) when race is set"""
+    if race:
+        best_laps = session_best_laps().subquery()
+        return select(best_laps.c.name, best_laps.c.driver_id).order_by(best_laps.c.name)
+    return select(DriverModel.name, DriverModel.driver_id).order_by(DriverModel.name)
+
+
+def drivers_statement(race: str = None, session: str = DEFAULT_SESSION) -> tuple:
+    """Statement of the drivers list and its parameters: connection.execute(*drivers_statement(...))"""
+    return drivers_shape(bool(race)), {'race': race, 'session': session} if race else {}
+
+
+def drivers_rows(rows, asc: bool = True) -> list[list]:
+    """Function turns the rows of drivers_statement into the drivers list"""
+    drivers = [[name, driver_id] for name, driver_id in rows]
+    if not asc:
+        drivers.reverse()
+    return drivers
+
+
+def snapshot_dir(app=None) -> str | None:
+    """Function returns the race directory of the snapshot read path of an app (the current one), None when it is
+    not set"""
+    return (app or current_app).config.get(SNAPSHOT_DIR)
+
+
+def snapshot_source(race: str = None, app=None) -> str | None:
+    """Function selects the source of every read of the report and the drivers list: the race directory of
+    REPORT_SNAPSHOT_DIR for a read without a race selector, None for the database"""
+    return snapshot_dir(app) if race is None else None
 
-        return report
+
+def snapshot_version(path: str) -> tuple[str, datetime]:
+    """Function returns the version of the race snapshot of a directory, a digest of the size and the modification
+    time of its source files, and the UTC time of their last change"""
+    stamp = snapshot_stamp(path)[1:]  # the source files, the snapshot file itself is rebuilt from them
+    changed_ns = max((file_stamp[1] for file_stamp in stamp if file_stamp), default=0)
+    return hashlib.sha256(repr(stamp).encode()).hexdigest()[:12], \
+        datetime.fromtimestamp(changed_ns // 10 ** 9, timezone.utc).replace(tzinfo=None)
+
+
+def snapshot_report_rows(path: str, asc: bool = True, driver: str = None, limit: int = None, slower_than: int = None,
+                         team: str = None, max_lap: int = None, after: tuple = None, fields: tuple = FIELDS) -> list:
+    """Function selects the rows of report_statement from the memory-mapped race snapshot of a directory, with the
+    position as the tie-break of the sort key"""
+    rows = []
+    for position, driver_id, name, team_name, best_lap_ms in load_snapshot(path).report(asc, driver):
+        key = (best_lap_ms, position)
+        if (team and team_name != team) or (slower_than is not None and best_lap_ms <= slower_than) \
+                or (max_lap is not None and best_lap_ms > max_lap) \
+                or (after is not None and (key <= tuple(after[:2]) if asc else key >= tuple(after[:2]))):
+            continue
+        values = {'position': position, 'driver_id': driver_id, 'name': name, 'team': team_name,
+                  'best_lap': format_timedelta(timedelta(milliseconds=best_lap_ms)), 'best_lap_ms': best_lap_ms}
+        rows.append((*(values[field] for field in fields), *key, position))
+        if limit and len(rows) == limit:
+            break
+    return rows
+
+
+def snapshot_batches(path: str, asc: bool = True, driver: str = None, limit: int = None, team: str = None,
+                     max_lap: int = None, cursor: str = None, fields: tuple = FIELDS,
+                     batch_size: int = STREAM_BATCH) -> list[list]:
+    """Function reads the rows of stream_statement from the race snapshot of a directory in batches of batch_size,
+    like the partitions of a database cursor, ValueError for an invalid cursor"""
+    after = decode_cursor(cursor) if cursor else None
+    rows = snapshot_report_rows(path, asc, driver, limit, None, team, max_lap, after, fields)
+    return [rows[start:start + batch_size] for start in range(0, len(rows), batch_size)]
+
+
+def report_page_source(asc: bool = True, driver: str = None, limit: int = None, slower_than: int = None,
+                       race: str = None, session: str = DEFAULT_SESSION, team: str = None, max_lap: int = None,
+                       cursor: str = None, fields: tuple = FIELDS, app=None) -> tuple[list | None, tuple | None]:
+    """Function selects the rows of a page of the report without I/O, shared by the synchronous and the asynchronous
+    (report_asgi) read paths: (rows, None) read from the race snapshot, or (None, (statement, params)) for the
+    database. ValueError for an invalid cursor."""
+    after = decode_cursor(cursor) if cursor else None
+    if path := snapshot_source(race, app):
+        return snapshot_report_rows(path, asc, driver, limit, slower_than, team, max_lap, after, fields), None
+    return None, report_statement(asc, driver, limit, slower_than, race, session, team, max_lap, after, fields)
+
+
+def report_page(rows, race: str = None, limit: int = None, fields: tuple = FIELDS) -> tuple[list[list], str | None]:
+    """Function turns the rows of a page into the report and the cursor of the next page (None on the last page)"""
+    return report_rows(rows, race, fields), encode_cursor(rows[-1]) if limit and len(rows) == limit else None
+
+
+def stream_source(asc: bool = True, driver: str = None, limit: int = None, race: str = None,
+                  session: str = DEFAULT_SESSION, team: str = None, max_lap: int = None, cursor: str = None,
+                  fields: tuple = FIELDS, batch_size: int = STREAM_BATCH, app=None) -> tuple[list | None, tuple | None]:
+    """Function selects the batches of rows of a streamed report without I/O: (batches, None) read from the race
+    snapshot, or (None, (statement, params)) for a server-side cursor. ValueError for an invalid cursor."""
+    if path := snapshot_source(race, app):
+        return snapshot_batches(path, asc, driver, limit, team, max_lap, cursor, fields, batch_size), None
+    return None, stream_statement(asc, driver, limit, race, session, team, max_lap, cursor, fields, batch_size)
+
+
+def drivers_source(asc: bool = True, race: str = None, session: str = DEFAULT_SESSION,
+                   app=None) -> tuple[list | None, tuple | None]:
+    """Function selects the drivers list without I/O: (drivers, None) read from the race snapshot, or
+    (None, (statement, params)) for the database, whose rows drivers_rows turns into the list"""
+    if path := snapshot_source(race, app):
+        return load_snapshot(path).drivers(asc), None
+    return None, drivers_statement(race, session)
+
+
+@timed(DB_QUERY_SECONDS, 'report')
+def get_report_page(asc: bool = True, driver: str = None, limit: int = None, slower_than: int = None,
+                    race: str = None, session: str = DEFAULT_SESSION, team: str = None, max_lap: int = None,
+                    cursor: str = None, fields: tuple = FIELDS) -> tuple[list[list], str | None]:
+    """Building one page of the report and the cursor of the next page (None on the last page)
+
+    Positions, ordering, "top N" (limit), "slower than X ms" (slower_than), "not slower than X ms" (max_lap),
+    team and the cursor run in SQL on the best_lap_ms index, only the requested fields are selected.
+    With a race selector the report is built from the laps of that race session, without one from the race snapshot
+    of REPORT_SNAPSHOT_DIR when the app sets it."""
+    try:
+        rows, statement = report_page_source(asc, driver, limit, slower_than, race, session, team, max_lap, cursor,
+                                             fields)
+        if statement is not None:
+            with read_connection() as connection:
+                rows = connection.execute(*statement).all()
+        return report_page(rows, race, limit, fields)
     except Exception as ex:
         logger.error(f"[ERROR] An error occurred in get_report: {ex}")
         raise
 
 
-def get_drivers(asc: bool = True) -> list[list]:
-    """Building a list of drivers on the Monaco race F1 2018 from monaco.db"""
-    try:
-        query = db.session.query(DriverModel).order_by(DriverModel.name)
+def get_report(asc: bool = True, driver: str = None, limit: int = None, slower_than: int = None,
+               race: str = None, session: str = DEFAULT_SESSION, team: str = None, max_lap: int = None) -> list[list]:
+    """Building an overall or separate report on the Monaco race F1 2018 from monaco.db"""
+    return get_report_page(asc, driver, limit, slower_than, race, session, team, max_lap)[0]
+
+
+def stream_statement(asc: bool = True, driver: str = None, limit: int = None, race: str = None,
+                     session: str = DEFAULT_SESSION, team: str = None, max_lap: int = None, cursor: str = None,
+                     fields: tuple = FIELDS, batch_size: int = STREAM_BATCH):
+    """Statement of a streamed report and its parameters, read from a server-side cursor batch_size rows at a time
+    (a named cursor on PostgreSQL), ValueError for an invalid cursor"""
+    after = decode_cursor(cursor) if cursor else None
+    statement, params = report_statement(asc, driver, limit, None, race, session, team, max_lap, after, fields)
+    return streamed_statement(statement, batch_size), params
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def streamed_statement(statement, batch_size: int):
+    """Function returns a statement read batch_size rows at a time, built once per statement"""
+    return statement.execution_options(yield_per=batch_size)
+
+
+def stream_report(asc: bool = True, driver: str = None, limit: int = None, race: str = None,
+                  session: str = DEFAULT_SESSION, team: str = None, max_lap: int = None, cursor: str = None,
+                  fields: tuple = FIELDS, batch_size: int = STREAM_BATCH):
+    """Function returns the report as a generator of batches of rows, memory stays bounded by batch_size.
+
+    The query is checked before the first batch, so a response can still fail with 400."""
+    snapshot, statement = stream_source(asc, driver, limit, race, session, team, max_lap, cursor, fields, batch_size)
+    if statement is None:
+        return (report_rows(rows, race, fields) for rows in snapshot)
 
-        drivers = [[driver.name, driver.driver_id] for driver in query.all()]
-        if not asc:
-            drivers.reverse()
+    def batches():
+        try:
+            with read_connection() as connection:
+                for rows in connection.execute(*statement).partitions():
+                    yield report_rows(rows, race, fields)
+        except Exception as ex:
+            logger.error(f"[ERROR] An error occurred in stream_report: {ex}")
+            raise
+    return batches()
 
-        return drivers
+
+@timed(DB_QUERY_SECONDS, 'drivers')
+def get_drivers(asc: bool = True, race: str = None, session: str = DEFAULT_SESSION) -> list[list]:
+    """Building a list of drivers on the Monaco race F1 2018 from monaco.db"""
+    try:
+        drivers, statement = drivers_source(asc, race, session)
+        if statement is None:
+            return drivers
+        with read_connection() as connection:
+            return drivers_rows(connection.execute(*statement).all(), asc)
     except Exception as ex:
         logger.error(f"[ERROR] An error occurred in get_drivers: {ex}")
         raise
 
+
+def get_data_version() -> int:
+    """Function returns the version of the stored data, 0 before the first import"""
+    return get_data_version_info()[0]
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def data_version_statement():
+    """Statement of the data version and the UTC time of its import"""
+    return select(DataVersion.version, DataVersion.updated_at).where(DataVersion.id == 1)
+
+
+@timed(DB_QUERY_SECONDS, 'data_version')
+def get_data_version_info() -> tuple[int, datetime | None]:
+    """Function returns the version of the stored data and the UTC time of its import, (0, None) before the first"""
+    with read_connection() as connection:
+        row = connection.execute(data_version_statement()).first()
+    return (row.version, row.updated_at) if row else (0, None)
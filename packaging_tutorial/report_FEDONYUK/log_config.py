@@ -0,0 +1,199 @@
+"""This module is the logging pipeline of the report of Monaco 2018 Racing, set up once per process
+
+A request thread only formats its line and puts it in a queue: a writer thread writes the queued lines in
+batches, rotates the file by size or by age and never calls fsync. The settings are read from the environment, e.g.:
+    $ export REPORT_LOG_JSON=1                       # one JSON object per line
+    $ export REPORT_LOG_SAMPLE_RATE=100              # 1 of 100 INFO lines of every call site
+    $ export REPORT_LOG_ROTATION_SIZE=10485760       # bytes
+    $ export REPORT_LOG_ROTATION_INTERVAL=86400      # seconds
+"""
+import glob
+import json
+import os
+import queue
+import sys
+import time
+from datetime import datetime
+from threading import Lock, Thread
+
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process writes the log
+    fcntl = None
+
+LOG_FILE = 'debug.log'
+LOG_FORMAT = '{time} {level} {message}'
+LOG_LEVEL = 'DEBUG'
+BATCH_SIZE = 512  # Lines written by one write call at most
+FLUSH_INTERVAL = 0.2  # Seconds the first line of a batch waits for more lines
+QUEUE_SIZE = 100_000  # Lines waiting for the writer, the next lines are dropped and counted
+ROTATION_SIZE = 10 * 1024 * 1024  # Bytes of a log file before it is rotated
+ROTATION_INTERVAL = None  # Seconds of a log file before it is rotated, None: rotated by size only
+RETENTION = 5  # Rotated files kept
+SAMPLE_RATE = 1  # 1 of SAMPLE_RATE INFO lines of a call site is written, 1: every line
+ENV_JSON, ENV_SAMPLE_RATE = 'REPORT_LOG_JSON', 'REPORT_LOG_SAMPLE_RATE'
+ENV_ROTATION_SIZE, ENV_ROTATION_INTERVAL = 'REPORT_LOG_ROTATION_SIZE', 'REPORT_LOG_ROTATION_INTERVAL'
+
+_STOP = object()
+_lock = Lock()
+_sink_id = None  # Loguru id of the debug.log sink, None before the first setup
+
+
+class BatchingSink:
+    """Loguru sink of a file: write() queues a line without blocking, a writer thread writes the lines in batches
+    and rotates the file. A forked process (a gunicorn worker) starts a writer thread of its own."""
+
+    def __init__(self, path: str, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 rotation_size: int = ROTATION_SIZE, rotation_interval: float = ROTATION_INTERVAL,
+                 retention: int = RETENTION, queue_size: int = QUEUE_SIZE):
+        self.path = os.path.abspath(path)
+        self.batch_size, self.flush_interval = batch_size, flush_interval
+        self.rotation_size, self.rotation_interval, self.retention = rotation_size, rotation_interval, retention
+        self.queue_size = queue_size
+        self.lock = Lock()
+        self.pid = None  # process of the writer thread
+        self.batches = self.dropped = 0
+        self.file = None
+
+    def start(self) -> None:
+        """Function starts the writer thread of the current process, which opens the log file again"""
+        self.file = None  # the file object of the parent process, its buffer is empty after every batch
+        self.queue = queue.Queue(self.queue_size)
+        self.thread = Thread(target=self.run, name='log-writer', daemon=True)
+        self.pid = os.getpid()
+        self.thread.start()
+
+    def write(self, message: str) -> None:
+        """Function queues a formatted line, a full queue drops it"""
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self) -> None:
+        """Writer thread: waits for a line, gathers the next ones for flush_interval at most, writes them at once"""
+        while True:
+            lines = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while lines[-1] is not _STOP and len(lines) < self.batch_size:
+                try:
+                    lines.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            stop = lines[-1] is _STOP
+            batch = lines[:-1] if stop else lines
+            try:
+                self.write_batch(batch)
+            except OSError as e:  # the batch is lost, the next one opens the file again
+                self.file = None
+                print(f"{datetime.now().isoformat()} ERROR [LOG] {len(batch)} lines not written to {self.path}: {e}",
+                      file=sys.stderr)
+            if stop:
+                return
+
+    def write_batch(self, lines: list[str]) -> None:
+        """Function writes a batch with one write call, flushed to the OS (no fsync), then rotates the file.
+
+        Every worker appends to the same file: the size is the one of the file, and a file another worker has
+        rotated is opened again before the batch."""
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append(f"{datetime.now().isoformat()} WARNING [LOG] {dropped} lines dropped, the queue was full\n")
+        if not lines:
+            return
+        if self.file is None or not self.is_current():
+            self.open()
+        self.file.write(''.join(lines))
+        self.file.flush()
+        self.batches += 1
+        if os.fstat(self.file.fileno()).st_size >= self.rotation_size or \
+                (self.rotate_at is not None and time.time() >= self.rotate_at):
+            self.rotate()
+
+    def is_current(self) -> bool:
+        """Function tells if the open file is still the file at the path, i.e. no worker has rotated it"""
+        try:
+            return os.path.samestat(os.stat(self.path), os.fstat(self.file.fileno()))
+        except FileNotFoundError:
+            return False
+
+    def open(self) -> None:
+        """Function opens the log file for appending"""
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.rotate_at = time.time() + self.rotation_interval if self.rotation_interval else None
+
+    def rotate(self) -> None:
+        """Function renames the log file after its time of rotation and removes the oldest rotated files.
+
+        The workers rotate under an exclusive lock of a .lock file, a worker whose file was already rotated by
+        another one only opens the new file."""
+        root, ext = os.path.splitext(self.path)
+        with open(f"{root}.lock", 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)  # released by closing the lock file
+            if self.is_current():
+                os.replace(self.path, f"{root}.{datetime.now():%Y-%m-%d_%H-%M-%S_%f}{ext}")
+                for old in sorted(glob.glob(f"{glob.escape(root)}.*{ext}"))[:-self.retention or None]:
+                    os.remove(old)
+            self.open()
+
+    def stop(self) -> None:
+        """Function writes the queued lines and closes the file, called by logger.remove() and at exit"""
+        if self.pid == os.getpid():
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.pid = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class InfoSampler:
+    """Filter of a sink: every line but INFO ones, and the first then 1 of every rate INFO lines of a call site"""
+
+    def __init__(self, rate: int = SAMPLE_RATE):
+        self.rate = rate
+        self.counts = {}  # (module, line) -> INFO lines seen
+
+    def __call__(self, record) -> bool:
+        if self.rate <= 1 or record['level'].name != 'INFO':
+            return True
+        key = (record['name'], record['line'])
+        count = self.counts[key] = self.counts.get(key, 0) + 1
+        if (count - 1) % self.rate:
+            return False
+        record['extra']['sample_rate'] = self.rate
+        return True
+
+
+def json_format(record) -> str:
+    """Format of a sink writing one JSON object per line: time, level, message, call site and the bound extra"""
+    line = {'time': record['time'].isoformat(), 'level': record['level'].name, 'message': record['message'],
+            'module': record['name'], 'function': record['function'], 'line': record['line'], **record['extra']}
+    if record['exception'] is not None:
+        line['exception'] = repr(record['exception'].value)
+    record['extra']['_json'] = json.dumps(line, default=str, ensure_ascii=False)
+    return "{extra[_json]}\n"
+
+
+def setup_logging() -> int:
+    """Function adds the debug.log sink on its first call and returns its id, the next calls only return the id.
+
+    The entry points (create_app, the CLI, the live mode) call it, importing a module adds no sink."""
+    global _sink_id
+    with _lock:
+        if _sink_id is None:
+            sink = BatchingSink(LOG_FILE, rotation_size=int(os.environ.get(ENV_ROTATION_SIZE) or ROTATION_SIZE),
+                                rotation_interval=float(os.environ.get(ENV_ROTATION_INTERVAL) or 0) or None)
+            log_format = json_format if os.environ.get(ENV_JSON) in ('1', 'true') else LOG_FORMAT
+            _sink_id = logger.add(sink, format=log_format, level=LOG_LEVEL,
+                                  filter=InfoSampler(int(os.environ.get(ENV_SAMPLE_RATE) or SAMPLE_RATE)))
+        return _sink_id
@@ -0,0 +1,34 @@
+"""This module is a memory-mapped parser backend for the log files of Monaco 2018 Racing F1"""
+import mmap
+import os
+
+START_LOG = "start.log"
+END_LOG = "end.log"
+CODE_LEN = 3  # Every record is a 3-letter driver code followed by a timestamp like 2018-05-24_12:02:58.917
+
+
+def map_log_file(file_name, path: str) -> dict[bytes, bytes]:
+    """Function maps a log file into memory and indexes the last raw record of every driver code.
+
+    Records stay as bytes taken straight from the mapped buffer, nothing is decoded at this step."""
+    file_path = os.path.join(path, file_name)
+    if not os.path.getsize(file_path):
+        return {}  # an empty file cannot be memory-mapped
+    records = {}
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        for line in iter(buffer.readline, b''):
+            if not line.isspace():
+                records[line[:CODE_LEN]] = line
+    return records
+
+
+def read_log_file(file_name, path: str) -> dict:
+    """Function for reading log files, same result as report.read_log_file."""
+    return {code.decode(): line[CODE_LEN:].strip().decode() for code, line in map_log_file(file_name, path).items()}
+
+
+def merged_laps(path: str) -> list[dict]:
+    """Function reads two log file and creates a list of dictionary with start and end lap times"""
+    start_laps = read_log_file(START_LOG, path)
+    return [{'driver_id': driver_id, 'end_lap': end_lap, 'start_lap': start_laps.get(driver_id)}
+            for driver_id, end_lap in read_log_file(END_LOG, path).items()]
@@ -0,0 +1,191 @@
+"""This module instruments the report of Monaco 2018 Racing: histograms and counters in the Prometheus text format,
+the '/metrics' endpoint and a per-request profiler
+
+Every worker process keeps its own series, a scrape reads the worker that answers it. With REPORT_METRICS=0 no hook
+is registered and every timer is a single flag check. Flask is imported by init_app only, the CLI does not need it.
+"""
+import cProfile
+import io
+import os
+import pstats
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+ENV_METRICS = 'REPORT_METRICS'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+IMPORT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)  # Seconds of an importer stage
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'  # Prometheus text exposition format
+PROFILE_CONFIG = 'PROFILE_REQUESTS'  # App config: ?profile=1 is answered outside of the debug mode too
+PROFILE_LINES = 40  # Functions listed by a cProfile dump
+
+
+def escape(value) -> str:
+    """Function escapes the backslashes, quotes and new lines of a label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(names: tuple, values: tuple, extra: str = None) -> str:
+    """Function writes the labels of a sample, e.g. {route="/report/",le="0.1"}"""
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Registry:
+    """Metrics of the worker, rendered in the order of their creation"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics = []
+
+    def render(self) -> str:
+        """Function renders every metric in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(os.environ.get(ENV_METRICS, '1') not in ('0', 'false'))
+
+
+class Histogram:
+    """Histogram of durations in seconds, one series of cumulative buckets per set of label values"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.documentation, self.labels, self.buckets = name, documentation, labels, buckets
+        self.series = {}  # label values -> [counts per bucket and +Inf, sum]
+        self.lock = Lock()
+        registry.metrics.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        """Function counts one observation"""
+        if not registry.enabled:
+            return
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1  # the first bucket whose upper bound is >= value
+            series[1] += value
+
+    def samples(self) -> list[str]:
+        """Function returns the bucket, sum and count samples of every series"""
+        lines = []
+        with self.lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self.series.items()}
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{label_text(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{label_text(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Counter or gauge read at scrape time from a callback returning {label values: value}"""
+
+    def __init__(self, name: str, documentation: str, kind: str, callback, labels: tuple = ()):
+        self.name, self.documentation, self.kind, self.labels = name, documentation, kind, labels
+        self.callback = callback
+        registry.metrics.append(self)
+
+    def samples(self) -> list[str]:
+        """Function returns one sample per set of label values"""
+        return [f"{self.name}{label_text(self.labels, labels)} {float(value)}"
+                for labels, value in self.callback().items()]
+
+
+REQUEST_SECONDS = Histogram('report_request_seconds', 'Latency of the requests by route, method and status.',
+                            ('route', 'method', 'status'))
+DB_QUERY_SECONDS = Histogram('report_db_query_seconds', 'Duration of the database reads by query.', ('query',))
+SERIALIZATION_SECONDS = Histogram('report_serialization_seconds', 'Duration of the serialization of a response by '
+                                  'format.', ('format',))
+CACHE_SECONDS = Histogram('report_cache_shared_seconds', 'Latency of the calls to the shared (Redis) cache tier.',
+                          ('method',))
+IMPORT_STAGE_SECONDS = Histogram('report_import_stage_seconds', 'Duration of the stages of the importers: parse, '
+                                 'validate, join, insert.', ('stage',), IMPORT_BUCKETS)
+
+
+@contextmanager
+def timer(histogram: Histogram, *labels):
+    """Context manager observes the duration of its block"""
+    if not registry.enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, *labels)
+
+
+def timed(histogram: Histogram, *labels):
+    """Decorator observes the duration of every call of a function"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorator
+
+
+def profile_dump(profiler: cProfile.Profile) -> str:
+    """Function writes the functions of a cProfile run by cumulative time"""
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return output.getvalue()
+
+
+def init_app(app) -> None:
+    """Function instruments an app: the latency of every request, the duration of the templates and '/metrics'.
+
+    In the debug mode (or with the PROFILE_REQUESTS config) a request with ?profile=1 returns the cProfile dump of
+    its view instead of its response. Nothing is registered when the metrics are disabled."""
+    if not registry.enabled:
+        return
+    from flask import Response, before_render_template, g, request, template_rendered
+
+    @app.before_request
+    def start_request():
+        g.metrics_started = time.perf_counter()
+        if request.args.get('profile') == '1' and (app.debug or app.config.get(PROFILE_CONFIG)):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def end_request(response):
+        if (profiler := g.pop('profiler', None)) is not None:
+            profiler.disable()
+            response = Response(profile_dump(profiler), content_type='text/plain; charset=utf-8')
+        if (started := g.pop('metrics_started', None)) is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+        return response
+
+    def template_started(sender, template, context, **extra):
+        g.template_started = time.perf_counter()
+
+    def template_ended(sender, template, context, **extra):
+        if (started := g.pop('template_started', None)) is not None:
+            SERIALIZATION_SECONDS.observe(time.perf_counter() - started, 'html')
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_ended, app, weak=False)
+    app.add_url_rule('/metrics', 'metrics', lambda: Response(registry.render(), content_type=CONTENT_TYPE))
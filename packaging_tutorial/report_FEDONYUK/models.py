@@ -1,17 +1,31 @@
 """This script that should parse and save data from files to a model in sqlite database"""
+import csv
+import io
 import os
-from datetime import datetime, timedelta
-from pydantic import BaseModel, Field
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pydantic import BaseModel, Field, model_validator
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, inspect, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import SQLAlchemyError
 from loguru import logger
 
-logger.add('debug.log', format='{time} {level} {message}', level='DEBUG')
+from packaging_tutorial.report_FEDONYUK import race_snapshot
+from packaging_tutorial.report_FEDONYUK.race_snapshot import file_digest
+from packaging_tutorial.report_FEDONYUK.metrics import IMPORT_STAGE_SECONDS, timer
+from packaging_tutorial.report_FEDONYUK.report import get_drivers as get_race_drivers, \
+    get_abbreviation as get_race_abbreviation, is_package_data, no_stage
 
 ABBREVIATION_TXT = "abbreviations.txt"
 START_LOG = "start.log"
 END_LOG = "end.log"
 _BASE_DIR = os.path.join(os.path.dirname(__file__), '../data/')
+DEFAULT_RACE = "monaco-2018"  # race selector of the data in _BASE_DIR
+DEFAULT_SESSION = "race"
+BULK_BATCH_SIZE = 1000  # Rows per executemany in the bulk load
+CHECKPOINT_CHUNK = 1024 * 1024  # Bytes read at a time to scan the imported part of a file
 
 db = SQLAlchemy()
 
@@ -22,10 +36,18 @@ class Driver(BaseModel):
     name: str = Field(..., pattern=r'^[A-Z]{1}\w+\W[A-Z]{1}\w+$')
     team: str = Field(..., pattern=r'^[A-Z\W]+$')
     best_lap: str
+    best_lap_ms: int = None
 
     class Config:
         from_attributes = True
 
+    @model_validator(mode='before')
+    def calculate_best_lap_ms(cls, values):
+        """Function to fill the best lap in milliseconds from the formatted best lap if it is not given"""
+        if isinstance(values, dict) and values.get('best_lap_ms') is None and 'best_lap' in values:
+            values['best_lap_ms'] = parse_lap_time(values['best_lap'])
+        return values
+
 
 class DriverModel(db.Model):
     """Class that creates a Model SQLAlchemy for our database"""
@@ -33,18 +55,105 @@ class DriverModel(db.Model):
     driver_id = db.Column(db.String(3), unique=True, nullable=False)
     name = db.Column(db.String(100), unique=True, nullable=False)
     team = db.Column(db.String(100), nullable=False)
-    best_lap = db.Column(db.String(50), nullable=False)
+    best_lap = db.Column(db.String(50), nullable=False)  # formatted lap time, only for display
+    best_lap_ms = db.Column(db.Integer, nullable=False, index=True)  # lap time for ordering and filtering
 
     def __init__(self, driver: Driver):
         self.driver_id = driver.driver_id
         self.name = driver.name
         self.team = driver.team
         self.best_lap = driver.best_lap
+        self.best_lap_ms = driver.best_lap_ms
 
     def __repr__(self):
         return f"{self.id}, {self.driver_id}, {self.name}, {self.team}, {self.best_lap}"
 
 
+class RaceModel(db.Model):
+    """Class that creates a Model SQLAlchemy for the races of a season"""
+    __tablename__ = 'races'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    slug = db.Column(db.String(100), unique=True, nullable=False)  # race selector, e.g. 'monaco-2018'
+    name = db.Column(db.String(100), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"{self.id}, {self.slug}, {self.name}, {self.year}"
+
+
+class SessionModel(db.Model):
+    """Class that creates a Model SQLAlchemy for the sessions of a race: practice, qualifying, race"""
+    __tablename__ = 'sessions'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    race_id = db.Column(db.Integer, db.ForeignKey('races.id'), nullable=False)
+    name = db.Column(db.String(50), nullable=False)  # session selector, e.g. 'practice-1', 'qualifying', 'race'
+    __table_args__ = (db.UniqueConstraint('race_id', 'name'),)
+
+    def __repr__(self):
+        return f"{self.id}, {self.race_id}, {self.name}"
+
+
+class TeamModel(db.Model):
+    """Class that creates a Model SQLAlchemy for the teams of a season"""
+    __tablename__ = 'teams'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+
+    def __repr__(self):
+        return f"{self.id}, {self.name}"
+
+
+class RacerModel(db.Model):
+    """Class that creates a Model SQLAlchemy for the drivers of a season"""
+    __tablename__ = 'drivers'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    code = db.Column(db.String(3), unique=True, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+
+    def __repr__(self):
+        return f"{self.id}, {self.code}, {self.name}"
+
+
+class LapModel(db.Model):
+    """Class that creates a Model SQLAlchemy for the laps of every session, partitioned by session"""
+    __tablename__ = 'laps'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    driver_id = db.Column(db.Integer, db.ForeignKey('drivers.id'), nullable=False)
+    team_id = db.Column(db.Integer, db.ForeignKey('teams.id'), nullable=False)
+    lap_time_ms = db.Column(db.Integer, nullable=False)
+    start_lap = db.Column(db.DateTime)
+    end_lap = db.Column(db.DateTime)
+    # A report of one session is a range scan of this index, whatever the number of stored races
+    __table_args__ = (db.Index('ix_laps_session_driver_lap_time', 'session_id', 'driver_id', 'lap_time_ms'),)
+
+    def __repr__(self):
+        return f"{self.id}, {self.session_id}, {self.driver_id}, {self.team_id}, {self.lap_time_ms}"
+
+
+class ImportCheckpoint(db.Model):
+    """Class that creates a Model SQLAlchemy for the imported part of every source file of a session"""
+    __tablename__ = 'import_checkpoints'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    source = db.Column(db.String(255), unique=True, nullable=False)  # '<race>/<session>/<file name>'
+    offset = db.Column(db.BigInteger, nullable=False)  # bytes of the file already imported
+    digest = db.Column(db.String(64), nullable=False)  # file_digest of the imported bytes
+
+    def __repr__(self):
+        return f"{self.id}, {self.source}, {self.offset}, {self.digest}"
+
+
+class DataVersion(db.Model):
+    """Class that creates a Model SQLAlchemy for the version of the stored data, bumped by every import"""
+    __tablename__ = 'data_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime)  # UTC time of the import that committed this version
+
+    def __repr__(self):
+        return f"{self.id}, {self.version}, {self.updated_at}"
+
+
 def get_abbreviation() -> list[dict]:
     """Function reads the file abbreviations.txt and creates a container to store Abbreviation"""
     with open(os.path.join(_BASE_DIR, ABBREVIATION_TXT), encoding='utf-8') as file:
@@ -61,25 +170,35 @@ def read_log_file(file_name) -> dict:
 def merged_laps() -> list[dict]:
     """Function reads two log file and creates a list of dictionary with start and end lap times"""
     merged_laps = []
+    start_laps = read_log_file(START_LOG)  # index of start times keyed by driver_id, read only once
     for driver_id, end_lap in read_log_file(END_LOG).items():
-        start_lap = read_log_file(START_LOG).get(driver_id)
+        start_lap = start_laps.get(driver_id)
         if start_lap and end_lap:
             best_lap = abs(datetime.fromisoformat(end_lap) - datetime.fromisoformat(start_lap))
-            driver = {'driver_id': driver_id, 'best_lap': format_timedelta(best_lap)}
+            driver = {'driver_id': driver_id, 'best_lap': format_timedelta(best_lap),
+                      'best_lap_ms': best_lap // timedelta(milliseconds=1)}
             merged_laps.append(driver)
     return merged_laps
 
 
-def get_drivers_all() -> list[Driver]:
-    """Function to create a class Driver from 3 files, comparing data by driver_id."""
-    drivers_all = []  # container list of class Driver
-    for abbrev in get_abbreviation():
-        for merged_lap in merged_laps():
-            if abbrev['driver_id'] == merged_lap['driver_id']:
-                driver = Driver(driver_id=abbrev['driver_id'], name=abbrev['name'],
-                                team=abbrev['team'], best_lap=merged_lap['best_lap'])
-                drivers_all.append(driver)
-    return drivers_all
+def stored_driver(driver_id: str, name: str, team: str, best_lap_ms: int) -> Driver:
+    """Function creates the class Driver of a row of DriverModel from data validated already, without validation"""
+    return Driver.model_construct(driver_id=driver_id, name=name, team=team, best_lap_ms=best_lap_ms,
+                                  best_lap=format_timedelta(timedelta(milliseconds=best_lap_ms)))
+
+
+def import_stage(name: str):
+    """Function times a stage of an importer: parse, join, validate or insert"""
+    return timer(IMPORT_STAGE_SECONDS, name)
+
+
+def get_drivers_all(stream: bool = False, trusted: bool = False, stage=no_stage) -> list[Driver]:
+    """Function to create a class Driver from 3 files, comparing data by driver_id.
+
+    The files are parsed, joined and validated by report.get_drivers (only a sample of rows in the trusted mode),
+    stage(name) is the context manager of every stage of the pipeline."""
+    return [stored_driver(dr.driver_id, dr.name, dr.team, dr.best_lap // timedelta(milliseconds=1))
+            for dr in get_race_drivers(_BASE_DIR, stream, trusted=trusted, stage=stage)]
 
 
 def format_timedelta(time_obj: timedelta) -> str:
@@ -87,18 +206,335 @@ def format_timedelta(time_obj: timedelta) -> str:
     return f"{time_obj.seconds // 60}:{time_obj.seconds % 60:02d}:{str(time_obj.microseconds)[:3]}"
 
 
-def model_creation():
+def parse_lap_time(best_lap: str) -> int:
+    """Function converts the lap time from the format_timedelta format back to milliseconds"""
+    minutes, seconds, milliseconds = best_lap.split(':')
+    return (int(minutes) * 60 + int(seconds)) * 1000 + int(milliseconds)
+
+
+def upsert(connection, table):
+    """Function returns an INSERT of the connection dialect that supports ON CONFLICT clauses"""
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as postgresql_insert  # loaded with the PostgreSQL backend
+        return postgresql_insert(table)
+    return sqlite_insert(table)
+
+
+def copy_buffer(rows: list[dict], columns: tuple) -> io.StringIO:
+    """Function writes rows as the CSV input of COPY FROM STDIN, None as an empty unquoted field (NULL)"""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows([[row[column] for column in columns] for row in rows])
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(connection, table_name: str, rows: list[dict], columns: tuple) -> None:
+    """Function bulk loads rows into a PostgreSQL table with COPY, in the transaction of the connection"""
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                           copy_buffer(rows, columns))
+    finally:
+        cursor.close()
+
+
+def copy_upsert(connection, table, rows: list[dict], columns: tuple, key: str) -> None:
+    """Function upserts rows into a PostgreSQL table by key: COPY into a temporary table, then one INSERT ... SELECT
+    ... ON CONFLICT"""
+    staging, names = f"{table.name}_load", ', '.join(columns)
+    connection.exec_driver_sql(f"DROP TABLE IF EXISTS {staging}")
+    connection.exec_driver_sql(f"CREATE TEMP TABLE {staging} (LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DROP")
+    copy_rows(connection, staging, rows, columns)
+    updates = ', '.join(f"{column} = EXCLUDED.{column}" for column in columns if column != key)
+    connection.exec_driver_sql(f"INSERT INTO {table.name} ({names}) SELECT {names} FROM {staging} "
+                               f"ON CONFLICT ({key}) DO UPDATE SET {updates}")
+
+
+def batched(rows: list, batch_size: int = BULK_BATCH_SIZE):
+    """Generator splits rows into batches of bounded size for executemany"""
+    for i in range(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
+
+
+@contextmanager
+def bulk_connection():
+    """Context manager opens a connection for loading: one transaction, on SQLite with a WAL journal and
+    synchronous=OFF until the load is committed."""
+    with db.engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            synchronous = connection.exec_driver_sql("PRAGMA synchronous").scalar()
+            connection.exec_driver_sql("PRAGMA journal_mode=WAL")
+            connection.exec_driver_sql("PRAGMA synchronous=OFF")
+            connection.commit()
+        try:
+            with connection.begin():
+                yield connection
+        finally:
+            if sqlite:
+                connection.exec_driver_sql(f"PRAGMA synchronous={synchronous}")
+                connection.commit()
+
+
+def bump_data_version(connection) -> None:
+    """The function increments the data version in the transaction of an import, so cached reports are invalidated
+    exactly when the imported data is committed"""
+    table = DataVersion.__table__
+    updated_at = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    connection.execute(upsert(connection, table).values(id=1, version=1, updated_at=updated_at).on_conflict_do_update(
+        index_elements=['id'], set_={'version': table.c.version + 1, 'updated_at': updated_at}))
+
+
+def get_ids(connection, table, column, values: set) -> dict:
+    """Function inserts the missing values of a unique column and returns the ids of all values"""
+    if values:
+        connection.execute(upsert(connection, table).on_conflict_do_nothing(index_elements=[column]),
+                           [{column: value} for value in values])
+    rows = connection.execute(select(table.c[column], table.c.id).where(table.c[column].in_(values)))
+    return dict(rows.all())
+
+
+def get_session_id(connection, race: str, name: str, year: int, session: str = DEFAULT_SESSION) -> int:
+    """Function upserts a race with one of its sessions and returns the id of the session"""
+    races, sessions = RaceModel.__table__, SessionModel.__table__
+    connection.execute(upsert(connection, races).values(slug=race, name=name, year=year)
+                       .on_conflict_do_update(index_elements=['slug'], set_={'name': name, 'year': year}))
+    race_id = connection.execute(select(races.c.id).where(races.c.slug == race)).scalar_one()
+    connection.execute(upsert(connection, sessions).values(race_id=race_id, name=session)
+                       .on_conflict_do_nothing(index_elements=['race_id', 'name']))
+    return connection.execute(select(sessions.c.id).where(sessions.c.race_id == race_id,
+                                                          sessions.c.name == session)).scalar_one()
+
+
+def store_laps(connection, rows: list[dict], session_id: int, batch_size: int = BULK_BATCH_SIZE) -> int:
+    """The function replaces the laps of the drivers of rows in one session, upserting their teams and drivers.
+    PostgreSQL loads the laps with COPY."""
+    racers, laps = RacerModel.__table__, LapModel.__table__
+    team_ids = get_ids(connection, TeamModel.__table__, 'name', {row['team'] for row in rows})
+    names = {row['driver_id']: row['name'] for row in rows}
+    if names:
+        connection.execute(upsert(connection, racers).on_conflict_do_nothing(index_elements=['code']),
+                           [{'code': code, 'name': name} for code, name in names.items()])
+    racer_ids = dict(connection.execute(select(racers.c.code, racers.c.id).where(racers.c.code.in_(names))).all())
+    connection.execute(laps.delete().where(laps.c.session_id == session_id,
+                                           laps.c.driver_id.in_(racer_ids.values())))
+    laps_rows = [{'session_id': session_id, 'driver_id': racer_ids[row['driver_id']], 'team_id': team_ids[row['team']],
+                  'lap_time_ms': row['best_lap_ms'], 'start_lap': row.get('start_lap'), 'end_lap': row.get('end_lap')}
+                 for row in rows]
+    if connection.dialect.name == 'postgresql':
+        if laps_rows:
+            copy_rows(connection, laps.name, laps_rows, tuple(laps_rows[0]))
+        return len(rows)
+    for batch in batched(laps_rows, batch_size):
+        connection.execute(laps.insert(), batch)
+    return len(rows)
+
+
+def store_race_laps(connection, rows: list[dict], race: str, name: str, year: int, session: str = DEFAULT_SESSION,
+                    batch_size: int = BULK_BATCH_SIZE) -> int:
+    """The function writes the laps of one session into the normalized models, replacing the previous import.
+
+    Every row needs driver_id, name, team and best_lap_ms, start_lap and end_lap are optional."""
+    session_id = get_session_id(connection, race, name, year, session)
+    connection.execute(LapModel.__table__.delete().where(LapModel.__table__.c.session_id == session_id))
+    return store_laps(connection, rows, session_id, batch_size)
+
+
+def store_drivers(connection, drivers: list, batch_size: int = BULK_BATCH_SIZE) -> int:
+    """The function upserts Driver data into DriverModel by driver_id, so a re-import is idempotent.
+    PostgreSQL loads the drivers with COPY."""
+    table = DriverModel.__table__
+    if connection.dialect.name == 'postgresql':
+        rows = [{'driver_id': dr.driver_id, 'name': dr.name, 'team': dr.team, 'best_lap': dr.best_lap,
+                 'best_lap_ms': dr.best_lap_ms} for dr in drivers]
+        if rows:
+            copy_upsert(connection, table, rows, tuple(rows[0]), 'driver_id')
+        return len(drivers)
+    statement = upsert(connection, table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['driver_id'], set_={column: statement.excluded[column]
+                                            for column in ('name', 'team', 'best_lap', 'best_lap_ms')})
+    for batch in batched(drivers, batch_size):
+        connection.execute(statement, [{'driver_id': dr.driver_id, 'name': dr.name, 'team': dr.team,
+                                        'best_lap': dr.best_lap, 'best_lap_ms': dr.best_lap_ms} for dr in batch])
+    return len(drivers)
+
+
+def write_race_snapshot(path: str, rows: list[dict]) -> None:
+    """The function writes the binary snapshot of an imported race next to its source files, so the CLI and the web
+    views read the race without parsing it again. The package data directory is never written, a read-only
+    directory only logs the error."""
+    if is_package_data(path):
+        return None
+    try:
+        race_snapshot.write_snapshot(path, [(row['driver_id'], row['name'], row['team'], row['best_lap_ms'])
+                                            for row in rows])
+    except OSError as e:
+        logger.error(f"[ERROR] The race snapshot of {path} is not written: {e}")
+
+
+def import_race(path: str, race: str, name: str, year: int, session: str = DEFAULT_SESSION,
+                trusted: bool = False) -> int:
+    """The function reads the 3 files of one session from path and writes them into the normalized models."""
+    try:
+        started = time.perf_counter()
+        db.create_all()
+        rows = [{'driver_id': dr.driver_id, 'name': dr.name, 'team': dr.team, 'start_lap': dr.start_lap,
+                 'end_lap': dr.end_lap, 'best_lap_ms': dr.best_lap // timedelta(milliseconds=1)}
+                for dr in get_race_drivers(path, trusted=trusted, stage=import_stage)]
+        with import_stage('insert'), bulk_connection() as connection:
+            count = store_race_laps(connection, rows, race, name, year, session)
+            bump_data_version(connection)
+        log_load_rate(f"{race}/{session}", count, started)
+        write_race_snapshot(path, rows)
+        return count
+    except SQLAlchemyError as e:
+        logger.error(f"[ERROR] An error occurred in import_race: {e}")
+        raise
+
+
+def complete_offset(file_path: str, size: int) -> int:
+    """Function returns the offset after the last line break in the first size bytes of a file, 0 without one.
+
+    A last line without a line break is still being written, the next import reads it again."""
+    with open(file_path, 'rb') as file:
+        while size > 0:
+            start = max(size - CHECKPOINT_CHUNK, 0)
+            file.seek(start)
+            if (index := file.read(size - start).rfind(b'\n')) >= 0:
+                return start + index + 1
+            size = start
+    return 0
+
+
+def read_appended_lines(file_path: str, offset: int) -> tuple[dict, int]:
+    """Function reads the complete lines written after offset and returns the last time of every driver
+    together with the new offset. A last line without a line break is left for the next import."""
+    records = {}
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            if not line.isspace():
+                records[line[:3].decode()] = line[3:].strip().decode()
+    return records, offset
+
+
+def store_checkpoints(connection, checkpoints: dict[str, tuple]) -> None:
+    """The function upserts the offset and the digest of every source file"""
+    table = ImportCheckpoint.__table__
+    statement = upsert(connection, table)
+    statement = statement.on_conflict_do_update(index_elements=['source'], set_={
+        'offset': statement.excluded.offset, 'digest': statement.excluded.digest})
+    connection.execute(statement, [{'source': source, 'offset': offset, 'digest': digest}
+                                   for source, (offset, digest) in checkpoints.items()])
+
+
+def refresh_race(path: str = _BASE_DIR, race: str = DEFAULT_RACE, name: str = 'Monaco', year: int = 2018,
+                 session: str = DEFAULT_SESSION) -> int:
+    """The function imports only the log lines appended since the last import of a session.
+
+    Every source file has a checkpoint (byte offset and digest). A missing checkpoint, a changed abbreviations.txt
+    or a truncated/rewritten log causes a full rebuild of the session. The legacy DriverModel is kept in sync
+    for the default race. Returns the number of drivers written."""
+    try:
+        started = time.perf_counter()
+        db.create_all()
+        files = {file_name: os.path.join(path, file_name) for file_name in (ABBREVIATION_TXT, START_LOG, END_LOG)}
+        sources = {file_name: f"{race}/{session}/{file_name}" for file_name in files}
+        saved = {checkpoint.source: checkpoint for checkpoint in
+                 db.session.query(ImportCheckpoint).filter(ImportCheckpoint.source.in_(sources.values()))}
+        db.session.close()
+        sizes = {file_name: os.path.getsize(file_path) for file_name, file_path in files.items()}
+        rebuild = any(
+            (checkpoint := saved.get(sources[file_name])) is None or sizes[file_name] < checkpoint.offset
+            or (file_name == ABBREVIATION_TXT and sizes[file_name] != checkpoint.offset)
+            or file_digest(file_path, checkpoint.offset) != checkpoint.digest
+            for file_name, file_path in files.items())
+        abbreviations = {abbrev['driver_id']: abbrev for abbrev in get_race_abbreviation(path)}
+        with bulk_connection() as connection:
+            session_id = get_session_id(connection, race, name, year, session)
+            if rebuild:
+                drivers = get_race_drivers(path, stage=import_stage)
+                offsets = {file_name: size if file_name == ABBREVIATION_TXT else complete_offset(files[file_name], size)
+                           for file_name, size in sizes.items()}
+                rows = [{'driver_id': dr.driver_id, 'name': dr.name, 'team': dr.team, 'start_lap': dr.start_lap,
+                         'end_lap': dr.end_lap, 'best_lap_ms': dr.best_lap // timedelta(milliseconds=1)}
+                        for dr in drivers]
+                connection.execute(LapModel.__table__.delete().where(LapModel.__table__.c.session_id == session_id))
+            else:
+                rows, offsets = refresh_rows(connection, session_id, files, saved, sources, abbreviations)
+            with import_stage('insert'):
+                store_laps(connection, rows, session_id)
+                if race == DEFAULT_RACE:
+                    if rebuild:
+                        connection.execute(DriverModel.__table__.delete())
+                    store_drivers(connection, [
+                        stored_driver(row['driver_id'], row['name'], row['team'], row['best_lap_ms']) for row in rows])
+                store_checkpoints(connection, {sources[file_name]: (offset, file_digest(files[file_name], offset))
+                                               for file_name, offset in offsets.items()})
+                if rebuild or rows:
+                    bump_data_version(connection)
+        log_load_rate(f"{race}/{session} ({'full rebuild' if rebuild else 'incremental'})", len(rows), started)
+        return len(rows)
+    except SQLAlchemyError as e:
+        logger.error(f"[ERROR] An error occurred in refresh_race: {e}")
+        raise
+
+
+def refresh_rows(connection, session_id: int, files: dict, saved: dict, sources: dict,
+                 abbreviations: dict) -> tuple[list[dict], dict]:
+    """Function folds the appended log lines into the stored laps of their drivers, returns the changed rows
+    and the new offsets of the source files"""
+    offsets = {ABBREVIATION_TXT: saved[sources[ABBREVIATION_TXT]].offset}
+    appended = {}
+    for file_name in (START_LOG, END_LOG):
+        appended[file_name], offsets[file_name] = read_appended_lines(files[file_name],
+                                                                      saved[sources[file_name]].offset)
+    changed = (appended[START_LOG].keys() | appended[END_LOG].keys()) & abbreviations.keys()
+    if not changed:
+        return [], offsets
+    racers, laps = RacerModel.__table__, LapModel.__table__
+    stored = {code: (start_lap, end_lap) for code, start_lap, end_lap in connection.execute(
+        select(racers.c.code, laps.c.start_lap, laps.c.end_lap).join(racers, racers.c.id == laps.c.driver_id)
+        .where(laps.c.session_id == session_id, racers.c.code.in_(changed)))}
+    rows = []
+    for code in sorted(changed):
+        start_lap, end_lap = stored.get(code, (None, None))
+        if code in appended[START_LOG]:
+            start_lap = datetime.fromisoformat(appended[START_LOG][code])
+        if code in appended[END_LOG]:
+            end_lap = datetime.fromisoformat(appended[END_LOG][code])
+        if start_lap and end_lap and (start_lap, end_lap) != stored.get(code):  # a line read again changes nothing
+            rows.append({'driver_id': code, 'name': abbreviations[code]['name'], 'team': abbreviations[code]['team'],
+                         'start_lap': start_lap, 'end_lap': end_lap,
+                         'best_lap_ms': abs(end_lap - start_lap) // timedelta(milliseconds=1)})
+    return rows, offsets
+
+
+def log_load_rate(target: str, count: int, started: float) -> None:
+    """Function logs the number of loaded rows and the load rate in rows per second"""
+    elapsed = time.perf_counter() - started
+    logger.info(f"[INFO] {count} rows of {target} loaded in {elapsed:.3f} s ({count / max(elapsed, 1e-9):.0f} rows/s).")
+
+
+def model_creation(stream: bool = False, trusted: bool = False):
     """The function creates a SQLite model and writes Driver data to this model."""
     try:
-        with db.session.begin():
-            logger.info("[INFO] SQLite connection opened.")
-            db.create_all()
-            drivers = sorted(get_drivers_all(), key=lambda x: x.best_lap)
-            for driver in drivers:
-                driver_model = DriverModel(driver)
-                db.session.add(driver_model)
-            logger.info("[INFO] model sqlalchemy 'DriverModel' create successful!")
-            db.session.commit()
+        started = time.perf_counter()
+        logger.info("[INFO] SQLite connection opened.")
+        db.create_all()
+        drivers = sorted(get_drivers_all(stream, trusted, import_stage), key=lambda x: x.best_lap_ms)
+        laps = [{'driver_id': dr.driver_id, 'name': dr.name, 'team': dr.team, 'best_lap_ms': dr.best_lap_ms}
+                for dr in drivers]
+        with import_stage('insert'), bulk_connection() as connection:
+            count = store_drivers(connection, drivers)
+            store_race_laps(connection, laps, DEFAULT_RACE, 'Monaco', 2018)
+            bump_data_version(connection)
+        logger.info("[INFO] model sqlalchemy 'DriverModel' create successful!")
+        log_load_rate('DriverModel', count, started)
     except SQLAlchemyError as e:
         logger.error(f"[ERROR] An error occurred in model_creation: {e}")
     finally:
@@ -107,6 +543,59 @@ def model_creation():
         return None
 
 
+def database_mtime() -> float:
+    """The function returns the modification time of the SQLite database file, or the current time"""
+    database = db.engine.url.database if db.engine.dialect.name == 'sqlite' else None
+    return os.path.getmtime(database) if database and os.path.isfile(database) else time.time()
+
+
+def seed_data_version(imported_at: float) -> None:
+    """The function gives a database imported before the table data_version its first version, dated imported_at,
+    so its reports are sent with a Last-Modified and their ETags change on the next import"""
+    updated_at = datetime.fromtimestamp(imported_at, timezone.utc).replace(tzinfo=None, microsecond=0)
+    with db.engine.begin() as connection:
+        if connection.execute(select(DataVersion.id)).first() is not None \
+                or connection.execute(select(DriverModel.id).limit(1)).first() is None:
+            return
+        connection.execute(DataVersion.__table__.insert().values(id=1, version=1, updated_at=updated_at))
+    logger.info(f"[INFO] Data version 1 of {updated_at} given to the stored data.")
+
+
+def migrate_best_lap_ms():
+    """The function migrates an existing database: adds the indexed column best_lap_ms filled from best_lap
+    and the table data_version, seeded for data imported without it."""
+    table = DriverModel.__table__
+    imported_at = database_mtime()  # taken before the migration touches the file
+    DataVersion.__table__.create(db.engine, checkfirst=True)
+    inspector = inspect(db.engine)
+    if 'updated_at' not in {c['name'] for c in inspector.get_columns(DataVersion.__tablename__)}:
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {DataVersion.__tablename__} ADD COLUMN updated_at DATETIME"))
+    if inspector.has_table(table.name):
+        seed_data_version(imported_at)
+    if not inspector.has_table(table.name) or 'best_lap_ms' in {c['name'] for c in inspector.get_columns(table.name)}:
+        return None
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN best_lap_ms INTEGER NOT NULL DEFAULT 0"))
+            rows = connection.execute(text(f"SELECT id, driver_id, best_lap FROM {table.name}")).all()
+            if rows:
+                # Exact lap times are taken from the source files when they match, as format_timedelta is lossy
+                exact = {dr.driver_id: dr for dr in get_drivers_all(trusted=True)} if os.path.isdir(_BASE_DIR) else {}
+                connection.execute(table.update().where(table.c.id == bindparam('row_id')),
+                                   [{'row_id': row.id, 'best_lap_ms': exact[row.driver_id].best_lap_ms
+                                     if row.driver_id in exact and exact[row.driver_id].best_lap == row.best_lap
+                                     else parse_lap_time(row.best_lap)} for row in rows])
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+            bump_data_version(connection)
+        logger.info(f"[INFO] Database migrated: column best_lap_ms added to {len(rows)} rows.")
+    except SQLAlchemyError as e:
+        logger.error(f"[ERROR] An error occurred in migrate_best_lap_ms: {e}")
+        raise
+    return None
+
+
 # if __name__ == "__main__":
 #     with app.app_context():
 #         model_creation()
@@ -0,0 +1,173 @@
+"""This module is a compact binary snapshot format of one race of Monaco 2018 Racing F1, read by memory-mapping
+
+Layout (little-endian), every column is an array of one value per driver in the order of the ranking:
+    header      magic b'F1RS', format version, flags, number of drivers, number of strings, source signature
+    lap_ms      int64    best lap times in milliseconds, ascending
+    code        uint32   string ids of the driver codes
+    name        uint32   string ids of the driver names
+    team        uint32   string ids of the teams
+    by_name     uint32   ranking indexes ordered by driver name
+    offsets     uint32   number of strings + 1 offsets into the string table
+    strings     UTF-8    string table, every name and team stored once
+
+Opening a snapshot maps the file and slices these arrays without reading them, so it takes microseconds whatever
+the size of the race; values are decoded only when a row is asked for.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+SNAPSHOT_FILE = "race.f1s"
+MAGIC = b'F1RS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHII32s')  # magic, version, flags, drivers, strings, signature
+SOURCE_FILES = ("abbreviations.txt", "start.log", "end.log")
+DIGEST_CHUNK = 1024 * 1024  # Bytes read at a time to hash a source file
+
+
+def file_digest(file_path: str, offset: int) -> str:
+    """Function hashes the first offset bytes of a file, read DIGEST_CHUNK bytes at a time.
+
+    Any rewrite of the hashed part of a file, truncation included, changes the digest."""
+    digest = hashlib.sha256(b'%d|' % offset)
+    with open(file_path, 'rb') as file:
+        while offset > 0 and (chunk := file.read(min(offset, DIGEST_CHUNK))):
+            digest.update(chunk)
+            offset -= len(chunk)
+    return digest.hexdigest()
+
+
+def source_signature(path: str) -> bytes:
+    """Function fingerprints the 3 source files of a race by the digest of their whole content, so a rewrite of any
+    byte, even one that keeps the size of a file, makes the snapshot stale"""
+    digest = hashlib.sha256()
+    for file_name in SOURCE_FILES:
+        file_path = os.path.join(path, file_name)
+        digest.update(file_digest(file_path, os.path.getsize(file_path)).encode())
+    return digest.digest()
+
+
+def column(values, typecode: str) -> bytes:
+    """Function packs a column as little-endian bytes"""
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def encode_snapshot(rows: list[tuple], signature: bytes = bytes(32)) -> bytes:
+    """Function encodes a snapshot from (driver_id, name, team, lap_ms) rows, ranked by lap time with ties in the
+    given order"""
+    ranked = sorted(rows, key=lambda row: row[3])
+    ids = {}  # string table: id of every distinct code, name and team, in the order of first use
+    for row in ranked:
+        for value in row[:3]:
+            ids.setdefault(value, len(ids))
+    encoded = [value.encode() for value in ids]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    by_name = sorted(range(len(ranked)), key=lambda index: ranked[index][1])
+    return b''.join([HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(ranked), len(ids), signature),
+                     column([row[3] for row in ranked], 'q'),
+                     *(column([ids[row[index]] for row in ranked], 'I') for index in range(3)),
+                     column(by_name, 'I'), column(offsets, 'I'), *encoded])
+
+
+def write_snapshot(path: str, rows: list[tuple]) -> str:
+    """Function writes the snapshot of a race directory, signed with its source files, and returns its file path.
+    The file is replaced atomically, a reader never maps a half-written snapshot."""
+    file_path = os.path.join(path, SNAPSHOT_FILE)
+    with open(file_path + '.tmp', 'wb') as file:
+        file.write(encode_snapshot(rows, source_signature(path)))
+    os.replace(file_path + '.tmp', file_path)
+    return file_path
+
+
+class RaceSnapshot:
+    """Memory-mapped snapshot of a race, queried in place"""
+
+    def __init__(self, buffer: mmap.mmap | bytes):
+        magic, version, _, self.count, strings, self.signature = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Not a race snapshot of version {FORMAT_VERSION}")
+        self.buffer = buffer
+        view, start = memoryview(buffer), HEADER.size
+        self.lap_ms, start = self.array(view, start, self.count, 'q'), start + 8 * self.count
+        self.code, self.name, self.team, self.by_name = (
+            self.array(view, start + 4 * self.count * index, self.count, 'I') for index in range(4))
+        start += 16 * self.count
+        self.offsets = self.array(view, start, strings + 1, 'I')
+        self.strings = view[start + 4 * (strings + 1):]
+
+    @staticmethod
+    def array(view: memoryview, start: int, length: int, typecode: str):
+        """Function returns a column in place, a copy only on a big-endian machine"""
+        size = array(typecode).itemsize
+        values = view[start:start + size * length]
+        if sys.byteorder == 'little':
+            return values.cast(typecode)
+        swapped = array(typecode, values.tobytes())
+        swapped.byteswap()
+        return swapped
+
+    def __len__(self) -> int:
+        return self.count
+
+    def string(self, string_id: int) -> str:
+        """Function decodes one string of the string table"""
+        return str(self.strings[self.offsets[string_id]:self.offsets[string_id + 1]], 'utf-8')
+
+    def row(self, index: int) -> list:
+        """Function returns the row of a ranking index: position, driver_id, name, team, lap time in ms"""
+        return [index + 1, self.string(self.code[index]), self.string(self.name[index]),
+                self.string(self.team[index]), self.lap_ms[index]]
+
+    def find(self, driver_id: str) -> int | None:
+        """Function returns the ranking index of a driver code, None for an unknown one"""
+        encoded = driver_id.encode()
+        return next((index for index in range(self.count) if self.strings[
+            self.offsets[self.code[index]]:self.offsets[self.code[index] + 1]] == encoded), None)
+
+    def report(self, asc: bool = True, driver: str = None) -> list[list]:
+        """Function returns the ranking, or the row of one driver, with lap times in ms"""
+        if driver:
+            index = self.find(driver)
+            return [] if index is None else [self.row(index)]
+        indexes = range(self.count) if asc else range(self.count - 1, -1, -1)
+        return [self.row(index) for index in indexes]
+
+    def drivers(self, asc: bool = True) -> list[list]:
+        """Function returns the list of drivers ordered by name: name, driver_id"""
+        indexes = self.by_name if asc else reversed(self.by_name)
+        return [[self.string(self.name[index]), self.string(self.code[index])] for index in indexes]
+
+    def close(self) -> None:
+        """Function releases the mapping"""
+        for name in ('lap_ms', 'code', 'name', 'team', 'by_name', 'offsets', 'strings'):
+            value = getattr(self, name)
+            if isinstance(value, memoryview):
+                value.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+def read_snapshot(path: str, check: bool = True) -> RaceSnapshot | None:
+    """Function maps the snapshot of a race directory, None when it is missing, invalid or older than the source
+    files. A directory shipped without its source files, or check=False, skips the comparison."""
+    file_path = os.path.join(path, SNAPSHOT_FILE)
+    try:
+        with open(file_path, 'rb') as file:
+            snapshot = RaceSnapshot(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, TypeError, ValueError, struct.error):  # missing, empty, truncated or of another format
+        return None
+    try:
+        if check and snapshot.signature != source_signature(path):
+            snapshot.close()
+            return None
+    except FileNotFoundError:
+        pass
+    return snapshot
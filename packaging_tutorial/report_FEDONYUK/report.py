@@ -1,18 +1,47 @@
 """This module is creation --Report of Monaco 2018 Racing F1"""
 import os
+import re
+from collections.abc import Iterator
+from contextlib import nullcontext
 from datetime import datetime, timedelta
+from threading import Lock
 from pydantic import BaseModel, Field, model_validator
 from tabulate import tabulate
 from loguru import logger
 
+
+from packaging_tutorial.report_FEDONYUK import log_mmap, race_snapshot
+
 ABBREVIATION_TXT = "abbreviations.txt"
 START_LOG = "start.log"
 END_LOG = "end.log"
 _BASE_DIR = os.path.join(os.path.dirname(__file__), '../data/')
+LOG_BATCH_SIZE = 10_000  # Max records held in memory per batch in the streaming mode
+TRUSTED_SAMPLE_SIZE = 32  # Rows fully validated per file in the trusted ingest mode
+LOG_LINE = re.compile(r'[A-Z]{3}\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}\.\d{3}')
+HEADER_LINES = {ABBREVIATION_TXT: re.compile(r'[A-Z]{3}_[^_]+_[^_]+'), START_LOG: LOG_LINE, END_LOG: LOG_LINE}
 SEPARATOR_FOR_REPORT = 18  # For this type of tabulate = 15 drivers
 SEPARATOR_REPORT_DESC = 7
 HEADERS = ["№/RACE", "CODE", "NAME DRIVER", "TEAM FORMULA 1", "BEST LAP"]
 HEADERS2 = ["NAME DRIVER", "CODE"]
+_PENDING = object()
+_snapshots = {}  # race directory -> (snapshot_stamp, RaceSnapshot) of load_snapshot
+_retired_snapshots = {}  # race directory -> the RaceSnapshot replaced last, closed by the next replacement
+_snapshots_lock = Lock()
+np = _PENDING  # NumPy, imported by the first columnar report; None when it is not installed
+
+
+def load_numpy():
+    """Function imports NumPy on first use, so the CLI starts without it. NumPy is optional, the columnar engine
+    falls back to the pure Python report"""
+    global np
+    if np is _PENDING:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = None
+    return np
 
 
 class Driver(BaseModel):
@@ -32,6 +61,22 @@ class Driver(BaseModel):
         return values
 
 
+class DriverRecord:
+    """Lightweight record with the attributes of class Driver, created without validation for trusted sources"""
+    __slots__ = ('driver_id', 'name', 'team', 'start_lap', 'end_lap', 'best_lap')
+
+    def __init__(self, driver_id: str, name: str, team: str, start_lap: datetime, end_lap: datetime):
+        self.driver_id = driver_id
+        self.name = name
+        self.team = team
+        self.start_lap = start_lap
+        self.end_lap = end_lap
+        self.best_lap = abs(end_lap - start_lap)
+
+    def __repr__(self):
+        return f"DriverRecord({self.driver_id}, {self.name}, {self.team}, {self.best_lap})"
+
+
 def get_abbreviation(path: str) -> list[dict]:
     """Function reads the file abbreviations.txt and creates a container to store Abbreviation"""
     with open(os.path.join(path, ABBREVIATION_TXT), encoding='utf-8') as file:
@@ -47,28 +92,118 @@ def read_log_file(file_name, path: str) -> dict:
 
 def merged_laps(path: str) -> list[dict]:
     """Function reads two log file and creates a list of dictionary with start and end lap times"""
-    merged_laps = []
-    for driver_id, end_lap in read_log_file(END_LOG, path).items():
-        start_lap = read_log_file(START_LOG, path).get(driver_id)
-        merged_laps.append({'driver_id': driver_id, 'end_lap': end_lap, 'start_lap': start_lap})
-    return merged_laps
-
-
-def get_drivers(path: str) -> list[Driver]:
-    """Function to create a class Driver from 3 files, comparing data by driver_id."""
-    drivers_all = []  # container list of class Driver
-    for abbrev in get_abbreviation(path):
-        for merged_lap in merged_laps(path):
-            if abbrev['driver_id'] == merged_lap['driver_id']:
-                driver = Driver(driver_id=abbrev['driver_id'], name=abbrev['name'], team=abbrev['team'],
-                                end_lap=datetime.fromisoformat(merged_lap['end_lap']),
-                                start_lap=datetime.fromisoformat(merged_lap['start_lap']))
-                drivers_all.append(driver)
-    return drivers_all
-
-
-def get_list_drivers(asc: bool, path: str = _BASE_DIR) -> list[list]:
+    start_laps = read_log_file(START_LOG, path)  # index of start times keyed by driver_id, read only once
+    return [{'driver_id': driver_id, 'end_lap': end_lap, 'start_lap': start_laps.get(driver_id)}
+            for driver_id, end_lap in read_log_file(END_LOG, path).items()]
+
+
+def iter_log_batches(file_name, path: str, batch_size: int = LOG_BATCH_SIZE) -> Iterator[list[tuple]]:
+    """Generator reads a log file lazily and yields batches of (driver_id, lap time) of bounded size"""
+    with open(os.path.join(path, file_name), encoding='utf-8') as file:
+        batch = []
+        for line in file:
+            if line.strip():
+                batch.append((line[:3], line[3:].strip()))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+
+def stream_laps(path: str, driver_ids=None, batch_size: int = LOG_BATCH_SIZE) -> dict[str, dict]:
+    """Function joins start and end logs batch by batch, keeping only the last lap of every known driver.
+
+    Memory is bounded by the number of drivers, not by the number of lines in the logs."""
+    laps = {}
+    for file_name, key in ((START_LOG, 'start_lap'), (END_LOG, 'end_lap')):
+        for batch in iter_log_batches(file_name, path, batch_size):
+            for driver_id, lap_time in batch:
+                if driver_ids is None or driver_id in driver_ids:
+                    lap = laps.setdefault(driver_id, {'driver_id': driver_id, 'end_lap': None, 'start_lap': None})
+                    lap[key] = lap_time
+    return laps
+
+
+def sample_indexes(size: int, sample_size: int = TRUSTED_SAMPLE_SIZE) -> set[int]:
+    """Function picks evenly spaced row indexes, always including the first and the last row"""
+    if size <= sample_size:
+        return set(range(size))
+    step = (size - 1) / (sample_size - 1)
+    return {round(i * step) for i in range(sample_size)}
+
+
+def check_source_file(path: str, file_name: str) -> tuple[int, str]:
+    """Function checks the first line of a source file against its format and returns the number of its lines
+    and the digest of its content, ValueError for a file of another format"""
+    file_path = os.path.join(path, file_name)
+    with open(file_path, 'rb') as file:
+        lines = [line for line in file if line.strip()]
+    if not lines or not HEADER_LINES[file_name].fullmatch(lines[0].decode('utf-8').strip()):
+        raise ValueError(f"{file_path} is not a {file_name} file")
+    return len(lines), race_snapshot.file_digest(file_path, os.path.getsize(file_path))
+
+
+def check_source_files(path: str) -> dict[str, tuple[int, str]]:
+    """Function checks the 3 source files of a race once before a trusted ingest: the first line of every file,
+    the same number of lines in the start and end logs. The line count and the digest of every file are logged,
+    so a trusted import records what it did not validate row by row. ValueError for a file that fails a check"""
+    checks = {file_name: check_source_file(path, file_name) for file_name in race_snapshot.SOURCE_FILES}
+    if checks[START_LOG][0] != checks[END_LOG][0]:
+        raise ValueError(f"{START_LOG} has {checks[START_LOG][0]} lines and {END_LOG} {checks[END_LOG][0]} in {path}")
+    for file_name, (lines, digest) in checks.items():
+        logger.info(f"[INFO] Trusted {file_name} of {path}: {lines} lines, sha256 {digest}")
+    return checks
+
+
+def build_drivers(rows: list[dict], trusted: bool = False) -> list[Driver | DriverRecord]:
+    """Function creates a class Driver for every row.
+
+    In the trusted mode only a sample of rows is validated by class Driver (a ValidationError rejects
+    the whole file) and every row is built as a lightweight DriverRecord."""
+    if not trusted:
+        return [Driver(**row) for row in rows]
+    for i in sample_indexes(len(rows)):
+        Driver(**rows[i])
+    return [DriverRecord(**row) for row in rows]
+
+
+def no_stage(name: str):
+    """Function times no stage of get_drivers, the importers pass a stage timer of their own"""
+    return nullcontext()
+
+
+def get_drivers(path: str, stream: bool = False, use_mmap: bool = False,
+                trusted: bool = False, stage=no_stage) -> list[Driver | DriverRecord]:
+    """Function to create a class Driver from 3 files, comparing data by driver_id.
+
+    stage(name) is the context manager of every stage: 'parse', 'join' and 'validate'. The trusted mode first
+    checks every source file once by check_source_files."""
+    with stage('parse'):
+        if trusted:
+            check_source_files(path)
+        abbreviations = get_abbreviation(path)
+        if stream:  # Streaming mode: lap logs are folded in bounded batches against the abbreviation index
+            laps = {driver_id: lap for driver_id, lap in
+                    stream_laps(path, {abbrev['driver_id'] for abbrev in abbreviations}).items()
+                    if lap['start_lap'] and lap['end_lap']}
+        elif use_mmap:  # Memory-mapped mode: only the last record of every driver is decoded
+            laps = {lap['driver_id']: lap for lap in log_mmap.merged_laps(path)}
+        else:
+            laps = {lap['driver_id']: lap for lap in merged_laps(path)}  # join index keyed by driver_id
+    with stage('join'):
+        rows = [{'driver_id': abbrev['driver_id'], 'name': abbrev['name'], 'team': abbrev['team'],
+                 'end_lap': datetime.fromisoformat(merged_lap['end_lap']),
+                 'start_lap': datetime.fromisoformat(merged_lap['start_lap'])}
+                for abbrev in abbreviations if (merged_lap := laps.get(abbrev['driver_id'])) is not None]
+    with stage('validate'):
+        return build_drivers(rows, trusted)
+
+
+def get_list_drivers(asc: bool, path: str = _BASE_DIR, use_snapshot: bool = False) -> list[list]:
     """Building a list of drivers on the Monaco race F1 2018."""
+    if use_snapshot:
+        return load_snapshot(path).drivers(asc)
     sorted_drivers = sorted(get_drivers(path), key=lambda x: x.name)
     list_drivers = [[dr.name, dr.driver_id] for dr in sorted_drivers]
     if not asc:
@@ -76,9 +211,110 @@ def get_list_drivers(asc: bool, path: str = _BASE_DIR) -> list[list]:
     return list_drivers
 
 
-def build_report(asc: bool = True, driver: str = None, path: str = _BASE_DIR) -> list[list]:
+def snapshot_rows(drivers: list[Driver | DriverRecord]) -> list[tuple]:
+    """Function converts drivers to the rows of a race snapshot: driver_id, name, team, lap time in ms"""
+    return [(dr.driver_id, dr.name, dr.team, dr.best_lap // timedelta(milliseconds=1)) for dr in drivers]
+
+
+def is_package_data(path: str) -> bool:
+    """Function tells if path is the data directory shipped in the package, which is never written"""
+    return os.path.realpath(path) == os.path.realpath(_BASE_DIR)
+
+
+def snapshot_stamp(path: str) -> tuple:
+    """Function returns the size and the modification time of the snapshot and the source files of a directory"""
+    stamp = []
+    for file_name in (race_snapshot.SNAPSHOT_FILE, *race_snapshot.SOURCE_FILES):
+        try:
+            stat = os.stat(os.path.join(path, file_name))
+            stamp.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def open_snapshot(path: str) -> race_snapshot.RaceSnapshot:
+    """Function memory-maps the binary snapshot of a race, written once from the 3 files when it is missing or stale.
+    The package data directory, or a directory that cannot be written, gets a snapshot in memory."""
+    snapshot = race_snapshot.read_snapshot(path)
+    if snapshot is None:
+        rows = snapshot_rows(get_drivers(path))
+        if not is_package_data(path):
+            try:
+                race_snapshot.write_snapshot(path, rows)
+                snapshot = race_snapshot.read_snapshot(path, check=False)
+            except OSError as e:
+                logger.error(f"[ERROR] The race snapshot of {path} is not written: {e}")
+        snapshot = snapshot or race_snapshot.RaceSnapshot(race_snapshot.encode_snapshot(rows))
+    return snapshot
+
+
+def load_snapshot(path: str = _BASE_DIR) -> race_snapshot.RaceSnapshot:
+    """Function returns the race snapshot of a directory, opened once per process and opened again only when the
+    snapshot or a source file changes (size or modification time). The snapshot is shared: callers never close it.
+
+    A replaced snapshot is closed by the next replacement of its directory, a request still reading it ends first."""
+    stamp = snapshot_stamp(path)
+    if (opened := _snapshots.get(path)) is not None and opened[0] == stamp:
+        return opened[1]
+    with _snapshots_lock:
+        if (opened := _snapshots.get(path)) is not None and opened[0] == stamp:
+            return opened[1]
+        snapshot = open_snapshot(path)
+        if (retired := _retired_snapshots.pop(path, None)) is not None:
+            retired.close()
+        if opened is not None:
+            _retired_snapshots[path] = opened[1]
+        _snapshots[path] = (snapshot_stamp(path), snapshot)  # the stamp after a snapshot written just now
+    return snapshot
+
+
+def build_report_snapshot(asc: bool = True, driver: str = None, path: str = _BASE_DIR) -> list[list]:
+    """Building the same report as build_report from the memory-mapped race snapshot, the 3 files are not parsed."""
+    return [[*row[:4], format_timedelta(timedelta(milliseconds=row[4]))]
+            for row in load_snapshot(path).report(asc, driver)]
+
+
+def load_lap_columns(path: str) -> dict:
+    """Function loads the joined race data as NumPy columns, with lap times as datetime64[ms] arrays"""
+    np = load_numpy()
+    start_laps, end_laps = read_log_file(START_LOG, path), read_log_file(END_LOG, path)
+    rows = [(abbrev['driver_id'], abbrev['name'], abbrev['team'],
+             start_laps[abbrev['driver_id']].replace('_', 'T'), end_laps[abbrev['driver_id']].replace('_', 'T'))
+            for abbrev in get_abbreviation(path) if abbrev['driver_id'] in start_laps.keys() & end_laps.keys()]
+    driver_ids, names, teams, start_lap, end_lap = zip(*rows) if rows else ((),) * 5
+    return {'driver_id': np.array(driver_ids, dtype='U3'), 'name': np.array(names, dtype=object),
+            'team': np.array(teams, dtype=object), 'start_lap': np.array(start_lap, dtype='datetime64[ms]'),
+            'end_lap': np.array(end_lap, dtype='datetime64[ms]')}
+
+
+def build_report_columnar(asc: bool = True, driver: str = None, path: str = _BASE_DIR) -> list[list]:
+    """Building the same report as build_report with one vectorized subtraction and an argsort ranking."""
+    if load_numpy() is None:
+        return build_report(asc, driver, path)
+    columns = load_lap_columns(path)
+    best_laps = np.abs(columns['end_lap'] - columns['start_lap']).astype(np.int64)  # lap times in ms
+    ranking = np.argsort(best_laps, kind='stable')
+    positions = np.arange(1, len(ranking) + 1)
+    if driver:
+        selected = columns['driver_id'][ranking] == driver
+        ranking, positions = ranking[selected], positions[selected]
+    table = [[position, driver_id, name, team, format_timedelta(timedelta(milliseconds=lap))]
+             for position, driver_id, name, team, lap in zip(positions.tolist(), columns['driver_id'][ranking].tolist(),
+                                                              columns['name'][ranking].tolist(),
+                                                              columns['team'][ranking].tolist(),
+                                                              best_laps[ranking].tolist())]
+    if not asc:
+        table.reverse()
+    return table
+
+
+def build_report(asc: bool = True, driver: str = None, path: str = _BASE_DIR, stream: bool = False,
+                 use_mmap: bool = False, trusted: bool = False, use_snapshot: bool = False) -> list[list]:
     """Building an overall or separate report on the Monaco race F1 2018."""
-    sorted_drivers = sorted(get_drivers(path), key=lambda x: x.best_lap)
+    if use_snapshot:
+        return build_report_snapshot(asc, driver, path)
+    sorted_drivers = sorted(get_drivers(path, stream, use_mmap, trusted), key=lambda x: x.best_lap)
     table = []
     for i, dr in enumerate(sorted_drivers, start=1):
         table.append([i, dr.driver_id, dr.name, dr.team, format_timedelta(dr.best_lap)])
@@ -89,14 +325,23 @@ def build_report(asc: bool = True, driver: str = None, path: str = _BASE_DIR) ->
     return table
 
 
-def print_report(asc: bool = True, driver: str = None, path: str = _BASE_DIR) -> None:
+def print_report(asc: bool = True, driver: str = None, path: str = _BASE_DIR, use_mmap: bool = False,
+                 columnar: bool = False, use_snapshot: bool = False) -> None:
     """this function Prints general or specific driver report"""
-    number_separate = SEPARATOR_FOR_REPORT
-    if not asc:
-        number_separate = SEPARATOR_REPORT_DESC
-    table_sep = tabulate(build_report(asc, driver, path), HEADERS, tablefmt="rounded_outline")
+    if use_snapshot:
+        table = build_report_snapshot(asc, driver, path)
+    elif columnar:
+        table = build_report_columnar(asc, driver, path)
+    else:
+        table = build_report(asc, driver, path, use_mmap=use_mmap)
     print("    -----------   Report of Monaco 2018 Racing F1   -----------")
-    return print(insert_separator(table_sep, number_separate))
+    return print(format_report(table, asc))
+
+
+def format_report(table: list[list], asc: bool = True) -> str:
+    """Function tabulates a report with the separator after the 15th racer"""
+    number_separate = SEPARATOR_FOR_REPORT if asc else SEPARATOR_REPORT_DESC
+    return insert_separator(tabulate(table, HEADERS, tablefmt="rounded_outline"), number_separate)
 
 
 def print_list_drivers(asc: bool = True) -> None:
@@ -1,53 +1,124 @@
 """This module is creation REST API report of Monaco 2018 Racing"""
+import json
 from flask import request, make_response
 from flask_restful import Resource
-from dicttoxml import dicttoxml
 from loguru import logger
 
-from packaging_tutorial.report_FEDONYUK.db_util import get_report, get_drivers
+from packaging_tutorial.report_FEDONYUK.columnar import COLUMNAR_FORMATS, export_report, export_drivers, \
+    columnar_response
+from packaging_tutorial.report_FEDONYUK.cache_util import cached_query, conditional_get
+from packaging_tutorial.report_FEDONYUK.metrics import SERIALIZATION_SECONDS, timer
+from packaging_tutorial.report_FEDONYUK.db_util import get_report_page, get_drivers, stream_report, FIELDS
+from packaging_tutorial.report_FEDONYUK.snapshots import API_FORMATS, CONTENT_TYPES, served_from_snapshot, \
+    serialize_body
+from packaging_tutorial.report_FEDONYUK.streaming import streamed, stream_format, stream_response
+from packaging_tutorial.report_FEDONYUK.models import DEFAULT_SESSION
 
-logger.add('debug.log', format='{time} {level} {message}', level='DEBUG')
 
+def error_response(status: int, message: str) -> tuple[int, bytes, dict]:
+    """Function serializes an error of the REST resources"""
+    return status, (json.dumps({'error': message}) + "\n").encode(), {'Content-Type': CONTENT_TYPES['json']}
 
-def generate_response(report, report_format):
-    """this function helps to create api response server"""
-    if report_format == 'json':
-        return report, 200
-    elif report_format == 'xml':
-        xml = dicttoxml(report).decode()
-        headers = {'Content-Type': 'application/xml'}
-        response = make_response(xml)
-        response.headers = headers
-        return response
-    logger.error("[ERROR] Invalid format requested.")
-    return {'error': 'Invalid format'}, 400
+
+def render_data(data: list, args, kind: str, data_format: str = None, cursor: str = None) -> tuple[int, bytes, dict]:
+    """Function serializes the data of a query into status, body and headers, the same way for the views (the fixed
+    format 'html'), the REST resources (data_format None, the format of the query) and report_asgi. An HTML page is
+    rendered in the current request context, timed by the template signals of metrics."""
+    if data_format is None and args.get('format', 'json') not in API_FORMATS:
+        logger.error("[ERROR] Invalid format requested.")
+        return error_response(400, 'Invalid format')
+    data_format = data_format or args.get('format', 'json')
+    if data_format == 'html':
+        template = 'report.html' if kind == 'report' or 'driver_id' in args else 'drivers.html'
+        body = serialize_body(data, 'html', template, report=data, drivers=data)
+    else:
+        with timer(SERIALIZATION_SECONDS, data_format):
+            body = serialize_body(data, data_format)
+    return 200, body, {'Content-Type': CONTENT_TYPES[data_format], **({'X-Next-Cursor': cursor} if cursor else {})}
+
+
+def write_response(status: int, body: bytes, headers: dict):
+    """Function writes the status, body and headers of render_data as a Flask response"""
+    return make_response(body, status, headers)
+
+
+def report_query(args) -> dict:
+    """Function reads the paging (limit, cursor), projection (fields) and filter (team, max_lap) parameters of
+    the report, ValueError for an invalid one"""
+    query = {'team': args.get('team') or None, 'cursor': args.get('cursor') or None}
+    for name in ('limit', 'max_lap'):
+        if args.get(name):
+            if not args[name].isdigit() or (name == 'limit' and int(args[name]) == 0):
+                raise ValueError(f"Invalid {name}")
+            query[name] = int(args[name])
+    if args.get('fields'):
+        query['fields'] = tuple(args['fields'].split(','))
+        if not set(query['fields']) <= set(FIELDS):
+            raise ValueError(f"Invalid fields, allowed: {','.join(FIELDS)}")
+    return query
+
+
+def data_query(args, kind: str, data_format: str = None) -> tuple[str, dict]:
+    """Function maps the query of a request to the data it reads, the same way for the views, the REST resources
+    (data_format None) and report_asgi: ('report', arguments of get_report_page) or ('drivers', arguments of
+    get_drivers). Only the report of the REST API is paged, projected and filtered. ValueError for an invalid
+    parameter."""
+    query = {'asc': args.get('order', 'asc') != 'desc', 'race': args.get('race', None),
+             'session': args.get('session', DEFAULT_SESSION)}
+    if kind == 'report' and data_format is None:
+        return 'report', {**query, 'driver': args.get('driver_id', None), **report_query(args)}
+    if kind == 'report' or 'driver_id' in args:  # a driver_id selects the report slice of that driver
+        return 'report', {**query, 'driver': args.get('driver_id', None)}
+    return 'drivers', query
+
+
+def read_data(args, kind: str, data_format: str = None) -> tuple[list[list], str | None]:
+    """Function reads the data of a query of data_query and the cursor of its next page"""
+    name, query = data_query(args, kind, data_format)
+    return get_report_page(**query) if name == 'report' else (get_drivers(**query), None)
 
 
 class ReportResource(Resource):
+    method_decorators = [cached_query, served_from_snapshot('report'), conditional_get]
+
     def get(self):
         try:
             report_format = request.args.get('format', 'json')
-            order = request.args.get('order', 'asc')
-            driver_id = request.args.get('driver_id', None)
-            report = get_report(asc=(order != 'desc'), driver=driver_id)
+            if streamed(request.args):  # a full-season export: rows are sent as the database cursor reads them
+                data_format = stream_format(request.args)
+                batches = stream_report(**data_query(request.args, 'report')[1])
+                return stream_response(batches, data_format, request.accept_encodings)
+            if report_format in COLUMNAR_FORMATS:  # analytics exports, lap times as int64 ms
+                body, cursor = export_report(report_format, **data_query(request.args, 'report')[1])
+                return columnar_response(body, report_format, cursor)
+            report, cursor = read_data(request.args, 'report')
             logger.info("[INFO] Report data retrieved successfully.")
-            return generate_response(report, report_format)
+            return write_response(*render_data(report, request.args, 'report', cursor=cursor))
+        except ValueError as e:
+            logger.error(f"[ERROR] Invalid query in ReportResource: {e}")
+            return {'error': str(e)}, 400
         except Exception as e:
             logger.error(f"[ERROR] An error occurred in ReportResource: {e}")
             return {'error': 'An error occurred'}, 500
 
 
 class DriversResource(Resource):
+    method_decorators = [cached_query, served_from_snapshot('drivers'), conditional_get]
+
     def get(self):
         try:
             report_format = request.args.get('format', 'json')
-            order = request.args.get('order', 'asc')
-            drivers_list = get_drivers(asc=(order != 'desc'))
-            driver_id = request.args.get('driver_id', None)
-            if 'driver_id' in request.args:
-                drivers_list = get_report(driver=driver_id)
+            if report_format in COLUMNAR_FORMATS:
+                name, query = data_query(request.args, 'drivers')
+                body = export_report(report_format, **query)[0] if name == 'report' else \
+                    export_drivers(report_format, **query)
+                return columnar_response(body, report_format)
+            drivers_list = read_data(request.args, 'drivers')[0]
             logger.info("[INFO] Drivers data retrieved successfully.")
-            return generate_response(drivers_list, report_format)
+            return write_response(*render_data(drivers_list, request.args, 'drivers'))
+        except ValueError as e:
+            logger.error(f"[ERROR] Invalid query in DriversResource: {e}")
+            return {'error': str(e)}, 400
         except Exception as e:
             logger.error(f"[ERROR] An error occurred in DriversResource: {e}")
             return {'error': 'An error occurred'}, 500
@@ -0,0 +1,336 @@
+"""This module is an asynchronous ASGI serving mode of the Web and REST API report of Monaco 2018 Racing
+
+The report routes run on the event loop with aiosqlite and redis.asyncio, every other path (Swagger UI, static
+files, errors) is served by the Flask app of report_web, so routes and the Swagger contract stay the same.
+
+    Example:
+        $ uvicorn packaging_tutorial.report_FEDONYUK.report_asgi:application --workers 4
+"""
+import asyncio
+import json
+import time
+from asgiref.wsgi import WsgiToAsgi
+from flask import redirect, render_template, url_for
+from loguru import logger
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import Headers
+from werkzeug.sansio.request import Request
+
+from packaging_tutorial.report_FEDONYUK.columnar import COLUMNAR_FORMATS, DRIVER_COLUMNS, check_format, \
+    columnar_headers, encode_columns, encode_report, report_export
+from packaging_tutorial.report_FEDONYUK.cache_util import entity_tag, not_modified, validators, version_memo, \
+    source_version
+from packaging_tutorial.report_FEDONYUK.db_util import report_page_source, report_page, report_rows, \
+    drivers_source, drivers_rows, stream_source, data_version_statement, reader_pragmas, FIELDS
+from packaging_tutorial.report_FEDONYUK.metrics import DB_QUERY_SECONDS, REQUEST_SECONDS, timer
+from packaging_tutorial.report_FEDONYUK.models import DEFAULT_SESSION
+from packaging_tutorial.report_FEDONYUK.report_api import data_query, render_data, error_response
+from packaging_tutorial.report_FEDONYUK.report_live import LIVE_CHANNEL
+from packaging_tutorial.report_FEDONYUK.report_web import app as flask_app, REDIS_TIMEOUT, LIVE_KEEPALIVE, \
+    LIVE_RETRY
+from packaging_tutorial.report_FEDONYUK.snapshots import ORDERS, CONTENT_TYPES, SnapshotStore, race_snapshots, \
+    snapshot_context, snapshot_key
+from packaging_tutorial.report_FEDONYUK.storage import READ_DATABASE_URL, PREPARED, async_database_url, \
+    prepare_database
+from packaging_tutorial.report_FEDONYUK.streaming import StreamEncoder, StreamCompressor, streamed, stream_format, \
+    stream_encoding, stream_headers
+
+ROUTES = {  # path -> (kind, fixed format of an HTML view, report slices by driver_id)
+    '/report/': ('report', 'html', False),
+    '/report/drivers/': ('drivers', 'html', True),
+    '/api/v1/report/': ('report', None, True),
+    '/api/v1/report/drivers/': ('drivers', None, True),
+}
+LIVE_ROUTE = '/report/live/'
+
+engine = create_async_engine(async_database_url(flask_app.config[READ_DATABASE_URL]))
+if engine.dialect.name == 'sqlite':
+    event.listen(engine.sync_engine, 'connect', reader_pragmas)  # the read path of db_util
+redis_client = aioredis.Redis(host='localhost', port=6379, socket_connect_timeout=REDIS_TIMEOUT)
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def database_batches(statement):
+    """Generator of the batches of rows of stream_statement, read from a server-side cursor on the event loop"""
+    async with engine.connect() as connection:
+        async for rows in (await connection.stream(*statement)).partitions():
+            yield rows
+
+
+async def listed_batches(batches: list):
+    """Generator of the batches of rows read from a race snapshot, streamed like database_batches"""
+    for rows in batches:
+        yield rows
+
+
+async def fetch_report_page(asc: bool = True, driver: str = None, race: str = None, session: str = DEFAULT_SESSION,
+                            team: str = None, max_lap: int = None, limit: int = None, cursor: str = None,
+                            fields: tuple = FIELDS) -> tuple[list[list], str | None]:
+    """Function reads a page of the report without blocking the event loop, the I/O of db_util.get_report_page"""
+    with timer(DB_QUERY_SECONDS, 'report'):
+        rows, statement = report_page_source(asc, driver, limit, None, race, session, team, max_lap, cursor, fields,
+                                             flask_app)
+        if statement is not None:
+            async with engine.connect() as connection:
+                rows = (await connection.execute(*statement)).all()
+        return report_page(rows, race, limit, fields)
+
+
+async def fetch_report(asc: bool = True, driver: str = None, race: str = None,
+                       session: str = DEFAULT_SESSION) -> list[list]:
+    """Function reads the report without blocking the event loop, same result as db_util.get_report"""
+    return (await fetch_report_page(asc, driver, race, session))[0]
+
+
+async def fetch_drivers(asc: bool = True, race: str = None, session: str = DEFAULT_SESSION) -> list[list]:
+    """Function reads the drivers list without blocking the event loop, the I/O of db_util.get_drivers"""
+    with timer(DB_QUERY_SECONDS, 'drivers'):
+        drivers, statement = drivers_source(asc, race, session, flask_app)
+        if statement is None:
+            return drivers
+        async with engine.connect() as connection:
+            return drivers_rows((await connection.execute(*statement)).all(), asc)
+
+
+async def fetch_data(args, kind: str, data_format: str = None) -> tuple[list[list], str | None]:
+    """Function reads the data of a query of report_api.data_query and the cursor of its next page, like
+    report_api.read_data"""
+    name, query = data_query(args, kind, data_format)
+    return await fetch_report_page(**query) if name == 'report' else (await fetch_drivers(**query), None)
+
+
+async def data_version() -> tuple:
+    """Function returns (version, updated_at) of the stored data, read at most once per ttl like cache_util does"""
+    value = version_memo.cached()
+    if value is None:
+        with timer(DB_QUERY_SECONDS, 'data_version'):
+            async with engine.connect() as connection:
+                row = (await connection.execute(data_version_statement())).first()
+        value = version_memo.update((row.version, row.updated_at) if row else (0, None))
+    return value
+
+
+class AsyncSnapshotStore(SnapshotStore):
+    """snapshots.SnapshotStore whose race sessions are read on the event loop"""
+    lock_type = asyncio.Lock
+
+    async def build_race(self, race: str, session: str) -> dict:
+        """Function reads the data of a race session and serializes its snapshots, like snapshots.build_snapshots"""
+        race_session = session or DEFAULT_SESSION
+        reports = {order: await fetch_report(order == 'asc', race=race, session=race_session) for order in ORDERS}
+        drivers = {order: await fetch_drivers(order == 'asc', race, race_session) for order in ORDERS} \
+            if reports['asc'] else {}
+        return race_snapshots(reports, drivers, race, session, flask_app)
+
+    async def get(self, version: int, race: str, session: str, key: tuple):
+        """Function returns the snapshot of a key, None for a race session without data"""
+        snapshots = self.cached(version, (race, session))
+        if snapshots is None:
+            async with self.build_lock(version, (race, session)):
+                if (snapshots := self.cached(version, (race, session))) is None:
+                    snapshots = self.store(version, (race, session), await self.build_race(race, session))
+        return snapshots.get(key)
+
+
+snapshot_store = AsyncSnapshotStore()
+
+
+def make_request(scope) -> Request:
+    """Function parses the query and the headers of an ASGI request"""
+    headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+    return Request(scope['method'], scope.get('scheme', 'http'), scope.get('server'), scope.get('root_path', ''),
+                   scope['path'], scope['query_string'], headers, (scope.get('client') or (None,))[0])
+
+
+async def respond(send, status: int, body: bytes = b'', headers: dict = None) -> None:
+    """Function sends a complete response"""
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                            for name, value in (headers or {}).items()]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def fetch_columns(args, kind: str) -> tuple[int, bytes, dict]:
+    """Function exports the data of a query in a columnar format, the I/O of the columnar REST resources"""
+    data_format = args['format']
+    try:
+        name, query = data_query(args, kind)
+        if name == 'report':
+            names, batches, statement = report_export(data_format, **query, app=flask_app)
+            if statement is not None:
+                batches = [rows async for rows in database_batches(statement)]
+            body, cursor = encode_report(batches, names, data_format, query.get('limit'))
+        else:
+            check_format(data_format)
+            body, cursor = encode_columns([await fetch_drivers(**query)], DRIVER_COLUMNS, data_format), None
+    except ValueError as e:
+        logger.error(f"[ERROR] Invalid query in report_asgi: {e}")
+        return error_response(400, str(e))
+    except Exception as e:
+        logger.error(f"[ERROR] An error occurred in report_asgi: {e}")
+        return error_response(500, 'An error occurred')
+    return 200, body, columnar_headers(data_format, cursor)
+
+
+async def stream_export(request: Request, send, etag: str, updated_at) -> None:
+    """Function streams the report chunk by chunk from the database cursor, the I/O of the streamed ReportResource"""
+    try:
+        data_format = stream_format(request.args)
+        query = data_query(request.args, 'report')[1]
+        batches, statement = stream_source(**query, app=flask_app)
+    except ValueError as e:
+        logger.error(f"[ERROR] Invalid query in report_asgi: {e}")
+        return await respond(send, *error_response(400, str(e)))
+    batches = listed_batches(batches) if statement is None else database_batches(statement)
+    encoding = stream_encoding(request.accept_encodings)
+    headers = {**stream_headers(data_format, encoding),
+               **validators(f"{etag}-{encoding}" if encoding else etag, updated_at)}
+    encoder, compressor = StreamEncoder(data_format), StreamCompressor(encoding)
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers.items()]})
+    await send({'type': 'http.response.body', 'body': compressor.compress(encoder.start()), 'more_body': True})
+    async for rows in batches:
+        chunk = encoder.encode(report_rows(rows, query['race'], query.get('fields', FIELDS)))
+        await send({'type': 'http.response.body', 'body': compressor.compress(chunk), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': compressor.compress(encoder.end()) + compressor.finish()})
+
+
+async def serve_report(request: Request, send) -> None:
+    """Function serves the routes of the report: 304 from the data version, then a snapshot, then the database"""
+    kind, data_format, slices = ROUTES[request.path]
+    args = request.args
+    version, updated_at = source_version(await data_version(), flask_app)
+    etag = entity_tag(version, request.path, args)
+    if (held := not_modified(etag, updated_at, request.if_none_match, request.if_modified_since)) is not None:
+        return await respond(send, 304, headers=validators(held, updated_at))
+    if kind == 'report' and data_format is None and streamed(args):
+        return await stream_export(request, send, etag, updated_at)
+    if data_format is None and args.get('format') in COLUMNAR_FORMATS:
+        status, body, headers = await fetch_columns(args, kind)
+        if status == 200:
+            headers.update(validators(etag, updated_at))
+        return await respond(send, status, body, headers)
+    if not slices and 'driver_id' in args:  # '/report/' passes a driver to '/report/drivers/'
+        with flask_app.test_request_context(request.path, query_string=request.query_string.decode()):
+            response = redirect(url_for('show_drivers', **args))
+        return await respond(send, response.status_code, response.get_data(), dict(response.headers))
+
+    key = snapshot_key(args, kind, data_format, slices)
+    snapshot = key and await snapshot_store.get(version, args.get('race'), args.get('session'), key)
+    if snapshot is not None:
+        gzipped = request.accept_encodings['gzip'] > 0
+        headers = {'Content-Type': snapshot.content_type, 'Vary': 'Accept-Encoding'}
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+        status, body = 200, snapshot.gzip_body if gzipped else snapshot.body
+    else:
+        try:
+            data, cursor = await fetch_data(args, kind, data_format)
+            with snapshot_context(args.get('race'), args.get('session'), flask_app):  # the links of a page
+                status, body, headers = render_data(data, args, kind, data_format, cursor)
+        except ValueError as e:
+            logger.error(f"[ERROR] Invalid query in report_asgi: {e}")
+            status, body, headers = error_response(400, str(e))
+        except Exception as e:
+            logger.error(f"[ERROR] An error occurred in report_asgi: {e}")
+            if data_format == 'html':
+                with flask_app.app_context():
+                    body = render_template('error.html', error_message="Database error").encode()
+                return await respond(send, 500, body, {'Content-Type': CONTENT_TYPES['html']})
+            status, body, headers = error_response(500, 'An error occurred')
+    if status == 200:
+        headers.update(validators(f"{etag}-gzip" if 'Content-Encoding' in headers else etag, updated_at))
+    await respond(send, status, body, headers)
+
+
+async def wait_disconnect(receive) -> None:
+    """Function waits until the client of a stream goes away"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream_live(request: Request, receive, send) -> None:
+    """Function streams the live standings as Server-Sent Events, like the '/report/live/' view of report_web.
+    Without Redis the stream ends after the full report with a retry hint."""
+    race, race_session = request.args.get('race', None), request.args.get('session', DEFAULT_SESSION)
+    snapshot = json.dumps(await fetch_report(race=race, session=race_session), ensure_ascii=False)
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    try:
+        await pubsub.subscribe(LIVE_CHANNEL)
+        subscribed = True
+    except RedisError as e:
+        logger.error(f"[ERROR] The live stream has no Redis: {e}")
+        subscribed = False
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': f"event: snapshot\ndata: {snapshot}\n\n".encode(),
+                    'more_body': True})
+        try:
+            while subscribed:
+                message = asyncio.ensure_future(pubsub.get_message(timeout=LIVE_KEEPALIVE))
+                await asyncio.wait((message, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    message.cancel()
+                    return
+                event = ": keep-alive\n\n" if message.result() is None else \
+                    f"event: update\ndata: {message.result()['data'].decode()}\n\n"
+                await send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+        except RedisError as e:
+            logger.error(f"[ERROR] The live stream lost Redis: {e}")
+        await send({'type': 'http.response.body', 'body': f"retry: {LIVE_RETRY}\n\n".encode()})
+    finally:
+        disconnected.cancel()
+        await pubsub.aclose()
+
+
+async def lifespan(receive, send) -> None:
+    """Function closes the database pool and the Redis connections when the server shuts down"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await redis_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def observed(scope, send):
+    """Function wraps the send of a report route to observe the latency of its response by route, method and status
+    when the response starts, as metrics.init_app does for the Flask app"""
+    started = time.perf_counter()
+
+    async def send_observed(message) -> None:
+        if message['type'] == 'http.response.start':
+            REQUEST_SECONDS.observe(time.perf_counter() - started, scope['path'], scope['method'],
+                                    str(message['status']))
+        await send(message)
+    return send_observed
+
+
+async def application(scope, receive, send) -> None:
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and not flask_app.extensions.get(PREPARED):  # the first request of the worker
+        await asyncio.to_thread(prepare_database, flask_app)
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        if scope['path'] in ROUTES:
+            return await serve_report(make_request(scope), observed(scope, send))
+        if scope['path'] == LIVE_ROUTE:
+            return await stream_live(make_request(scope), receive, observed(scope, send))
+    await wsgi_app(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn  # the ASGI server is needed only to run this module directly
+
+    uvicorn.run(application, host='127.0.0.1', port=5000)
@@ -1,18 +1,122 @@
 """This module create CLI for application"""
+import csv
+import glob
+import io
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
 import click
 from loguru import logger
 
-from packaging_tutorial.report_FEDONYUK.report import get_drivers, print_report
+from packaging_tutorial.report_FEDONYUK.log_config import setup_logging
+from packaging_tutorial.report_FEDONYUK.report import get_drivers, print_report, build_report, \
+    build_report_columnar, format_report, load_snapshot
+
+BATCH_FORMATS = {'text': 'txt', 'csv': 'csv', 'json': 'json'}  # Output format -> file extension
+CSV_HEADERS = ['position', 'driver_id', 'name', 'team', 'best_lap']
+
+
+def race_dirs(patterns: tuple = (), manifest: str = None) -> list[str]:
+    """Function lists the race directories of glob patterns and of a manifest (one directory per line, relative to
+    the manifest, '#' for comments), every directory once and in the given order"""
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding='utf-8') as lines:
+            paths.extend(os.path.join(base, line.strip()) for line in lines if line.strip()
+                         and not line.lstrip().startswith('#'))
+    return list(dict.fromkeys(os.path.normpath(path) for path in paths if os.path.isdir(path)))
+
+
+def output_names(dirs: list[str], data_format: str) -> list[str]:
+    """Function names the report file of every race directory after it, a suffix tells same names apart"""
+    names, seen = [], {}
+    for path in dirs:
+        name = os.path.basename(path) or 'race'
+        seen[name] = seen.get(name, 0) + 1
+        names.append(f"{name}-{seen[name]}" if seen[name] > 1 else name)
+    return [f"{name}.{BATCH_FORMATS[data_format]}" for name in names]
+
 
-logger.add('debug.log', format='{time} {level} {message}', level='DEBUG')
+def render_report(table: list[list], data_format: str, asc: bool = True) -> str:
+    """Function serializes a report as a table (text), CSV or JSON"""
+    if data_format == 'json':
+        return json.dumps(table, ensure_ascii=False) + "\n"
+    if data_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(CSV_HEADERS)
+        writer.writerows(table)
+        return buffer.getvalue()
+    return format_report(table, asc) + "\n"
+
+
+def process_race(task: tuple) -> tuple[str, int, str | None]:
+    """Worker builds the report of one race directory, parsing its files once, and writes it to its target.
+    Returns (race directory, number of rows, error or None): a bad directory does not stop the batch."""
+    path, target, data_format, asc, use_mmap, columnar, use_snapshot = task
+    try:
+        table = build_report_columnar(asc, None, path) if columnar else build_report(asc, None, path,
+                                                                                      use_mmap=use_mmap,
+                                                                                      use_snapshot=use_snapshot)
+        with open(target, 'w', encoding='utf-8', newline='') as output:
+            output.write(render_report(table, data_format, asc))
+        return path, len(table), None
+    except (OSError, ValueError) as e:
+        return path, 0, f"{type(e).__name__}: {e}"
+
+
+def run_batch(dirs: list[str], output: str, data_format: str = 'text', asc: bool = True, workers: int = None,
+              use_mmap: bool = False, columnar: bool = False, use_snapshot: bool = False) -> dict:
+    """Function builds the reports of many race directories on a process pool and returns the throughput summary.
+
+    Tasks are handed out in chunks, so the pool stays busy with hundreds of small races and scales with the cores."""
+    os.makedirs(output, exist_ok=True)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(dirs) or 1))
+    tasks = [(path, os.path.join(output, name), data_format, asc, use_mmap, columnar, use_snapshot)
+             for path, name in zip(dirs, output_names(dirs, data_format))]
+    chunksize = max(1, len(tasks) // (workers * 8))
+    started, rows, failures = time.perf_counter(), 0, []
+    with Pool(workers) as pool, click.progressbar(length=len(tasks), label='Reports', file=sys.stderr) as progress:
+        for path, count, error in pool.imap_unordered(process_race, tasks, chunksize):
+            rows += count
+            if error:
+                failures.append((path, error))
+                logger.error(f"[BATCH] {path}: {error}")
+            progress.update(1)
+    elapsed = time.perf_counter() - started
+    summary = {'races': len(tasks) - len(failures), 'failed': len(failures), 'rows': rows, 'workers': workers,
+               'seconds': round(elapsed, 3), 'races_per_second': round(len(tasks) / max(elapsed, 1e-9), 1)}
+    logger.info(f"[BATCH] {summary}")
+    return summary
 
 
 @click.command()
-@click.option('--file', type=click.Path(exists=True), required=True, help='Specify the path to the source files.')
+@click.option('--file', type=click.Path(exists=True), help='Specify the path to the source files.')
 @click.option('--asc', is_flag=True, help='Get the F1 Monaco report in ascending lap time.')
 @click.option('--desc', is_flag=True, help='Get the F1 Monaco report by descending lap times.')
 @click.option('--driver', help='Get the F1 Monaco report for a specific rider')
-def main_cli(file: str, asc: bool, desc: bool, driver: str = None) -> None:
+@click.option('--mmap', 'use_mmap', is_flag=True, help='Parse the race log files through memory-mapping.')
+@click.option('--numpy', 'columnar', is_flag=True, help='Rank the lap times with the NumPy columnar engine.')
+@click.option('--snapshot', 'use_snapshot', is_flag=True,
+              help='Read the binary race snapshot, written next to the source files on the first run '
+                   '(kept in memory for the data shipped in the package).')
+@click.option('--races', multiple=True, help='Batch mode: a glob of race directories, e.g. "archive/*/" (repeatable).')
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False),
+              help='Batch mode: a file of race directories, one per line.')
+@click.option('--output', type=click.Path(file_okay=False), default='reports', show_default=True,
+              help='Batch mode: the target directory of the reports.')
+@click.option('--format', 'data_format', type=click.Choice(list(BATCH_FORMATS)), default='text', show_default=True,
+              help='Batch mode: the format of the reports.')
+@click.option('--workers', type=click.IntRange(min=1), help='Batch mode: worker processes, default the CPU count.')
+def main_cli(file: str, asc: bool, desc: bool, driver: str = None, use_mmap: bool = False, columnar: bool = False,
+             use_snapshot: bool = False, races: tuple = (), manifest: str = None, output: str = 'reports',
+             data_format: str = 'text', workers: int = None) -> None:
     """Create and report the results of the F1 Monaco 2018 race from the input race log files.
 
         Args:
@@ -20,6 +124,14 @@ def main_cli(file: str, asc: bool, desc: bool, driver: str = None) -> None:
             asc (bool): Get the F1 Monaco report in ascending lap time.
             desc (bool): Get the F1 Monaco report by descending lap times.
             driver (str): Get the F1 Monaco report for a specific rider.
+            use_mmap (bool): Parse the race log files through memory-mapping.
+            columnar (bool): Rank the lap times with the NumPy columnar engine.
+            use_snapshot (bool): Read the binary race snapshot instead of parsing the race log files.
+            races (tuple): Batch mode, glob patterns of race directories.
+            manifest (str): Batch mode, a file listing race directories.
+            output (str): Batch mode, the target directory of the reports.
+            data_format (str): Batch mode, text, csv or json.
+            workers (int): Batch mode, the number of worker processes.
 
         Raises:
             click.UsageError: Raised if the provided options are invalid.
@@ -33,8 +145,23 @@ def main_cli(file: str, asc: bool, desc: bool, driver: str = None) -> None:
 
             To generate a report for a specific driver (e.g., Lewis Hamilton):
             $ python report_cli.py --file path/to/files --driver "Lewis Hamilton"
+
+            To generate the CSV reports of every archived race on all cores:
+            $ python report_cli.py --races "archive/*/" --format csv --output reports/
     """
+    setup_logging()
     try:
+        if races or manifest:
+            if file or driver or (asc and desc):
+                logger.error("[CLI] The batch mode takes no --file, --driver or both --asc and --desc!")
+                raise click.UsageError("--Options --file,--driver cannot be used with --races,--manifest!--")
+            dirs = race_dirs(races, manifest)
+            if not dirs:
+                raise click.UsageError("--No race directory found!--")
+            summary = run_batch(dirs, output, data_format, not desc, workers, use_mmap, columnar, use_snapshot)
+            click.echo(f"{summary['races']} reports in {summary['seconds']} s ({summary['races_per_second']} races/s, "
+                       f"{summary['workers']} workers), {summary['failed']} failed.")
+            return None
         if not file:
             logger.error("[CLI] Option --file is required!")
             raise click.UsageError("---Option --file is required!!!---")
@@ -42,16 +169,20 @@ def main_cli(file: str, asc: bool, desc: bool, driver: str = None) -> None:
             logger.error("[CLI] Options --asc,--desc,--driver cannot be used together!")
             raise click.UsageError("--Options --asc,--desc,--driver cannot be used together!--")
         elif driver:
-            if driver in (dr.name for dr in get_drivers(file)):
-                driver_id = [dr.driver_id for dr in get_drivers(file) if dr.name == driver][0]
-                print_report(True, driver_id, file)  # Call a function to get a separate report.
+            drivers = load_snapshot(file).drivers() if use_snapshot else \
+                [[dr.name, dr.driver_id] for dr in get_drivers(file, use_mmap=use_mmap)]
+            driver_id = next((code for name, code in drivers if name == driver), None)
+            if driver_id:
+                # Call a function to get a separate report.
+                print_report(True, driver_id, file, use_mmap, columnar, use_snapshot)
             else:
                 logger.error("[CLI] No such driver name!")
                 raise click.UsageError("--Please enter a valid driver name!--")
         else:
             if not asc and not desc:
                 asc = True  # Default to ascending order if neither --asc nor --desc is provided.
-            print_report(asc, None, file)  # Call a function to get the overall report.
+            # Call a function to get the overall report.
+            print_report(asc, None, file, use_mmap, columnar, use_snapshot)
     except FileNotFoundError:
         logger.error("[CLI] the file at the specified path does not exist!")
         raise click.UsageError(f"File not found: {file}")
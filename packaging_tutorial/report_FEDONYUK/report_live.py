@@ -0,0 +1,163 @@
+"""This module is a live ingest mode: it tails the race logs and pushes the changed standings of Monaco 2018 Racing"""
+import json
+import os
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+import click
+from loguru import logger
+
+from packaging_tutorial.report_FEDONYUK.log_config import setup_logging
+from packaging_tutorial.report_FEDONYUK.models import DEFAULT_RACE, DEFAULT_SESSION, START_LOG, END_LOG, \
+    format_timedelta, read_appended_lines, refresh_race
+from packaging_tutorial.report_FEDONYUK.report import get_abbreviation
+
+LIVE_CHANNEL = "report:live"  # Redis channel of the changed standings rows
+POLL_INTERVAL = 1.0  # Seconds between two reads of the logs
+
+
+class LiveStandings:
+    """In-memory ranking of the drivers, kept sorted by lap time and updated one lap event at a time"""
+
+    def __init__(self, abbreviations: list[dict]):
+        self.drivers = {abbrev['driver_id']: abbrev for abbrev in abbreviations}
+        self.start_laps, self.end_laps = {}, {}
+        self.laps = {}  # driver_id -> lap time in ms
+        self.ranking = []  # sorted list of (lap time in ms, driver_id)
+
+    def row(self, index: int) -> list:
+        """Function returns one row of the standings in the format of the report"""
+        lap, driver_id = self.ranking[index]
+        driver = self.drivers[driver_id]
+        return [index + 1, driver_id, driver['name'], driver['team'], format_timedelta(timedelta(milliseconds=lap))]
+
+    def rows(self) -> list[list]:
+        """Function returns the full standings"""
+        return [self.row(index) for index in range(len(self.ranking))]
+
+    def update(self, driver_id: str, start_lap: datetime = None, end_lap: datetime = None) -> list[list]:
+        """Function applies a lap event and returns only the rows whose position or lap time changed"""
+        if driver_id not in self.drivers:
+            return []
+        if start_lap is not None:
+            self.start_laps[driver_id] = start_lap
+        if end_lap is not None:
+            self.end_laps[driver_id] = end_lap
+        if driver_id not in self.start_laps or driver_id not in self.end_laps:
+            return []
+        lap = abs(self.end_laps[driver_id] - self.start_laps[driver_id]) // timedelta(milliseconds=1)
+        old_lap = self.laps.get(driver_id)
+        if old_lap == lap:
+            return []
+        if old_lap is None:
+            old_index = len(self.ranking)  # every row after the new driver moves one position down
+        else:
+            old_index = bisect_left(self.ranking, (old_lap, driver_id))
+            del self.ranking[old_index]
+        self.laps[driver_id] = lap
+        insort(self.ranking, (lap, driver_id))
+        new_index = bisect_left(self.ranking, (lap, driver_id))
+        last = min(max(old_index, new_index), len(self.ranking) - 1)
+        return [self.row(index) for index in range(min(old_index, new_index), last + 1)]
+
+    def apply(self, start_laps: dict, end_laps: dict) -> list[list]:
+        """Function applies the start and end times read from the logs, returns the changed rows once each"""
+        changed = {}
+        for driver_id in start_laps.keys() | end_laps.keys():
+            start_lap, end_lap = start_laps.get(driver_id), end_laps.get(driver_id)
+            for row in self.update(driver_id, start_lap and datetime.fromisoformat(start_lap),
+                                   end_lap and datetime.fromisoformat(end_lap)):
+                changed[row[1]] = row
+        return sorted(changed.values())
+
+
+def load_standings(path: str) -> tuple[LiveStandings, dict]:
+    """Function builds the standings from the complete lines of the logs and returns them with the offsets after
+    the last complete line, so a line appended meanwhile or still being written is read by the next poll"""
+    standings = LiveStandings(get_abbreviation(path))
+    laps, offsets = {}, {}
+    for file_name in (START_LOG, END_LOG):
+        file_path = os.path.join(path, file_name)
+        laps[file_name], offsets[file_name] = read_appended_lines(file_path, 0)
+        laps[file_name].update(read_last_record(file_path, offsets[file_name]))
+    standings.apply(laps[START_LOG], laps[END_LOG])
+    return standings, offsets
+
+
+def read_last_record(file_path: str, offset: int) -> dict:
+    """Function reads the last line of a log that has no line break, {} unless it is a complete record.
+
+    Its offset is not consumed: the next poll reads the line again once its line break is written."""
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        line = file.readline().decode(errors='replace').strip()
+    try:
+        datetime.fromisoformat(line[3:])
+    except ValueError:  # no line or a line still being written
+        return {}
+    return {line[:3]: line[3:]}
+
+
+def poll_logs(path: str, standings: LiveStandings, offsets: dict) -> list[list]:
+    """Function reads the lines appended to the logs since offsets and returns the changed standings rows.
+    A log shorter than its offset was truncated or rotated: it is read again from its start."""
+    appended = {}
+    for file_name in (START_LOG, END_LOG):
+        file_path = os.path.join(path, file_name)
+        if os.path.getsize(file_path) < offsets[file_name]:
+            logger.info(f"[LIVE] {file_name} was truncated or rotated, read from its start.")
+            offsets[file_name] = 0
+        appended[file_name], offsets[file_name] = read_appended_lines(file_path, offsets[file_name])
+    return standings.apply(appended[START_LOG], appended[END_LOG])
+
+
+def publish(redis_client, rows: list[list], channel: str = LIVE_CHANNEL) -> bool:
+    """Function publishes the changed standings rows as one JSON message, False when Redis fails: the rows are
+    still in monaco.db and in the full report a client gets when it reconnects"""
+    from redis.exceptions import RedisError  # imported with the client, the web app imports this module without it
+    try:
+        redis_client.publish(channel, json.dumps(rows, ensure_ascii=False))
+    except RedisError as e:
+        logger.error(f"[ERROR] {len(rows)} changed standings rows are not published: {e}")
+        return False
+    return True
+
+
+@click.command()
+@click.option('--file', type=click.Path(exists=True), required=True, help='Specify the path to the source files.')
+@click.option('--race', default=DEFAULT_RACE, show_default=True, help='Race selector of the data in monaco.db.')
+@click.option('--name', default='Monaco', show_default=True, help='Name of the race.')
+@click.option('--year', default=2018, show_default=True, help='Year of the race.')
+@click.option('--session', 'race_session', default=DEFAULT_SESSION, show_default=True, help='Session of the race.')
+@click.option('--interval', default=POLL_INTERVAL, show_default=True, help='Seconds between two reads of the logs.')
+def main_live(file: str, race: str, name: str, year: int, race_session: str, interval: float) -> None:
+    """Tail start.log and end.log, keep the standings up to date, write them to monaco.db and push the changed rows.
+
+        Example:
+            $ python report_live.py --file path/to/files
+    """
+    from packaging_tutorial.report_FEDONYUK.report_web import app, get_redis  # the web app only in live mode
+
+    setup_logging()
+
+    standings, offsets = load_standings(file)
+    with app.app_context():
+        refresh_race(file, race, name, year, race_session)
+    logger.info(f"[LIVE] Tailing {file} for {race}/{race_session}.")
+    while True:
+        try:
+            changed = poll_logs(file, standings, offsets)
+        except OSError as e:  # a log being rotated
+            logger.error(f"[ERROR] The logs of {file} are not read: {e}")
+            changed = []
+        if changed:
+            with app.app_context():
+                refresh_race(file, race, name, year, race_session)  # persists only the appended lines
+            publish(get_redis(), changed)
+            logger.info(f"[LIVE] {len(changed)} standings rows changed.")
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    main_live()
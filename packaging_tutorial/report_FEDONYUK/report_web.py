@@ -1,85 +1,203 @@
-"""This module create Web Report of Monaco 2018 Racing using Flask framework"""
+"""This module create Web Report of Monaco 2018 Racing using Flask framework
+
+create_app() is the application factory, e.g. `gunicorn "report_web:create_app()"`. Redis, the Swagger UI and
+the database connections are set up by the first request that needs them, so a new worker starts quickly.
+The shared app of `flask run`, `gunicorn report_web:app`, report_asgi and report_live is created by the first read of
+report_web.app, importing the module creates none."""
+import json
 import os
-from flask import Flask, render_template, request, redirect
+from threading import Lock
+from flask import Flask, Response, render_template, request, redirect, stream_with_context, url_for
 from flask_restful import Api
-from flasgger import Swagger
-from flask_caching import Cache
-import redis
+from flask_restful.representations.json import output_json
 from loguru import logger
 from sqlalchemy.exc import SQLAlchemyError
 
-from packaging_tutorial.report_FEDONYUK.models import db, model_creation
-from packaging_tutorial.report_FEDONYUK.db_util import get_report, get_drivers
-from packaging_tutorial.report_FEDONYUK.report_api import ReportResource, DriversResource
+from packaging_tutorial.report_FEDONYUK.models import model_creation, DEFAULT_SESSION
+from packaging_tutorial.report_FEDONYUK.db_util import get_report
+from packaging_tutorial.report_FEDONYUK.cache_util import cache, cached_query, conditional_get
+from packaging_tutorial.report_FEDONYUK import metrics
+from packaging_tutorial.report_FEDONYUK.log_config import setup_logging
+from packaging_tutorial.report_FEDONYUK.metrics import SERIALIZATION_SECONDS, timed
+from packaging_tutorial.report_FEDONYUK.snapshots import served_from_snapshot
+from packaging_tutorial.report_FEDONYUK.report_api import ReportResource, DriversResource, read_data, render_data, \
+    write_response
+from packaging_tutorial.report_FEDONYUK.report_live import LIVE_CHANNEL
+from packaging_tutorial.report_FEDONYUK.storage import init_storage
 
 _BASE_DIR = os.path.join(os.path.dirname(__file__), '../data/')
 DATABASE_FILE = os.path.join(_BASE_DIR, 'monaco.db')
+SWAGGER_FILE = 'Swagger/swagger.yml'
+SWAGGER_PATHS = ('/apidocs', '/apispec', '/flasgger_static', '/oauth2-redirect.html')  # Routes of flasgger
+REDIS_TIMEOUT = 0.25  # Seconds, a slow Redis counts as a failure of the cache circuit breaker
+LIVE_KEEPALIVE = 15  # Seconds between two keep-alive comments of the live stream
+LIVE_RETRY = 5000  # Milliseconds a client of the live stream waits before it reconnects, after Redis failed
+
+redis_client = None  # Client of the cache and of the live channel, created by get_redis
+_redis_lock = Lock()
+_app = None  # The shared app, created by get_app
+_app_lock = Lock()
+
+
+def get_redis():
+    """Function returns the Redis client of the worker, the redis package is imported by the first call"""
+    global redis_client
+    if redis_client is not None:  # created: no lock on the path of every cache call
+        return redis_client
+    with _redis_lock:
+        if redis_client is None:
+            import redis
+            redis_client = redis.StrictRedis(host='localhost', port=6379, socket_connect_timeout=REDIS_TIMEOUT,
+                                             socket_timeout=REDIS_TIMEOUT)
+        return redis_client
+
+
+class LazySwagger:
+    """WSGI middleware of the Swagger UI and contract (SWAGGER_PATHS): flasgger is imported and swagger.yml is
+    parsed by their first request, by an app of its own; every other request goes to the report app"""
+
+    def __init__(self, wsgi_app, template_file: str = SWAGGER_FILE):
+        self.wsgi_app = wsgi_app
+        self.template_file = template_file
+        self.docs = None
+        self.lock = Lock()
+
+    def docs_app(self) -> Flask:
+        """Function returns the app of the Swagger UI, created once"""
+        with self.lock:
+            if self.docs is None:
+                from flasgger import Swagger
+                docs = Flask(__name__)
+                Swagger(docs, template_file=self.template_file)
+                self.docs = docs
+                logger.info("[INFO] Swagger UI loaded.")
+        return self.docs
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').startswith(SWAGGER_PATHS):
+            return self.docs_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+
+def create_app(config: dict = None) -> Flask:
+    """Function creates the web app of the report: storage, REST API, cache, views, error handlers and metrics.
+
+    Nothing is connected or parsed here: the engines connect on the first query, the Redis cache and the Swagger UI
+    are built by the first request that uses them."""
+    setup_logging()
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.update(config or {})
+    init_storage(app, 'sqlite:///' + DATABASE_FILE)  # SQLite unless REPORT_DATABASE_URL selects another backend
+
+    api = Api(app, prefix='/api/v1/')
+    api.add_resource(ReportResource, 'report/')
+    api.add_resource(DriversResource, 'report/drivers/')
+    api.representations['application/json'] = timed(SERIALIZATION_SECONDS, 'json')(output_json)
+    app.wsgi_app = LazySwagger(app.wsgi_app)
+
+    cache.init_app(app, config={'CACHE_TYPE': 'packaging_tutorial.report_FEDONYUK.cache_util.lazy_redis_cache',
+                                'CACHE_REDIS_CLIENT': get_redis, 'CACHE_KEY_PREFIX': 'report:'})
+
+    app.register_error_handler(404, handle_not_found_error)
+    app.register_error_handler(SQLAlchemyError, handle_db_error)
+    app.add_url_rule('/report/', view_func=show_report)
+    app.add_url_rule('/report/drivers/', view_func=show_drivers)
+    app.add_url_rule('/report/live/', view_func=stream_live)
+    metrics.init_app(app)
+    return app
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DATABASE_FILE
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
-
-logger.add('debug.log', colorize=True, format='{time} {level} {message}', level='DEBUG')
-
-api = Api(app, prefix='/api/v1/')
-swagger = Swagger(app, template_file='Swagger/swagger.yml')
-
-api.add_resource(ReportResource, 'report/')
-api.add_resource(DriversResource, 'report/drivers/')
-
-redis_client = redis.StrictRedis(host='localhost', port=6379)
-
-cache_report = Cache(app, config={'CACHE_TYPE': 'redis', 'CACHE_REDIS': redis_client, 'CACHE_KEY_PREFIX': 'report'})
-cache_drivers = Cache(app, config={'CACHE_TYPE': 'redis', 'CACHE_REDIS': redis_client, 'CACHE_KEY_PREFIX': 'drivers'})
 
-cache_report.init_app(app)
-cache_drivers.init_app(app)
-
-
-@app.errorhandler(404)
 def handle_not_found_error(error):
     """Handle 404 Not Found error"""
     logger.info("[INFO] File Not Found!")
     return redirect('/apidocs/'), 404
 
 
-@app.errorhandler(SQLAlchemyError)
 def handle_db_error(error):
     """Handle database-related errors."""
     logger.error(f"[ERROR] Database error: {error}")
     return render_template('error.html', error_message="Database error"), 500
 
 
-@app.route('/report/')
-@cache_report.cached(timeout=30, key_prefix='report')
+@conditional_get
+@served_from_snapshot('report', 'html', slices=False)
+@cached_query
 def show_report():
-    """The function processes end-points '/' & '/report/' with query-parameters order and driver_id."""
-    order = request.args.get('order', 'asc')  # Get the 'order' parameter from the request, default 'asc'
-    asc = (order != 'desc')  # If order is not equal to 'desc' then asc=True, otherwise asc=False
-
+    """The function processes end-points '/' & '/report/' with query-parameters order, driver_id, race, session."""
     if 'driver_id' in request.args:  # If we get 'driver_id' then redirect it to '/report/drivers/' for processing
-        driver_id = request.args['driver_id']
-        return redirect('/report/drivers/' + '?driver_id=' + driver_id)
+        return redirect(url_for('show_drivers', **request.args))
 
-    return render_template('report.html', report=get_report(asc))
+    report = read_data(request.args, 'report', 'html')[0]  # order, race and session as report_api.data_query reads them
+    return write_response(*render_data(report, request.args, 'report', 'html'))
 
 
-@app.route('/report/drivers/')
-@cache_drivers.cached(timeout=30, key_prefix='drivers')
+@conditional_get
+@served_from_snapshot('drivers', 'html')
+@cached_query
 def show_drivers():
-    """The function processes end-point '/report/drivers/' with query-parameters order and driver_id."""
-    order = request.args.get('order', 'asc')  # Get the 'order' parameter from the request, default 'asc'
-    asc = (order != 'desc')  # If order is not equal to 'desc' then asc=True, otherwise asc=False
-
-    if 'driver_id' in request.args:  # Getting and processing query parameter 'driver_id'
-        driver_id = request.args['driver_id']
-        return render_template('report.html', report=get_report(driver=driver_id))
-
-    return render_template('drivers.html', drivers=get_drivers(asc))
+    """The function processes end-point '/report/drivers/' with query-parameters order, driver_id, race, session."""
+    data = read_data(request.args, 'drivers', 'html')[0]  # the report slice of a driver_id, or the drivers list
+    return write_response(*render_data(data, request.args, 'drivers', 'html'))
+
+
+def stream_live():
+    """The function processes end-point '/report/live/': Server-Sent Events with the full report first,
+    then only the rows changed by the live ingest mode (report_live).
+
+    Without Redis the client gets the full report and a retry hint: it reconnects after LIVE_RETRY ms."""
+    race = request.args.get('race', None)
+    race_session = request.args.get('session', DEFAULT_SESSION)
+    snapshot = json.dumps(get_report(race=race, session=race_session), ensure_ascii=False)
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    from redis.exceptions import RedisError  # imported with the client by get_redis
+    try:
+        pubsub.subscribe(LIVE_CHANNEL)
+        subscribed = True
+    except RedisError as e:
+        logger.error(f"[ERROR] The live stream has no Redis: {e}")
+        subscribed = False
+
+    def events():
+        yield f"event: snapshot\ndata: {snapshot}\n\n"
+        try:
+            while subscribed:
+                message = pubsub.get_message(timeout=LIVE_KEEPALIVE)
+                if message is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: update\ndata: {message['data'].decode()}\n\n"
+        except RedisError as e:
+            logger.error(f"[ERROR] The live stream lost Redis: {e}")
+        finally:
+            pubsub.close()
+        yield f"retry: {LIVE_RETRY}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def get_app() -> Flask:
+    """Function returns the shared app of the worker, created by the first call"""
+    global _app
+    if _app is not None:
+        return _app
+    with _app_lock:
+        if _app is None:
+            _app = create_app()
+        return _app
+
+
+def __getattr__(name: str):
+    """Function creates report_web.app on its first read: `flask run`, `gunicorn report_web:app`, report_asgi and
+    report_live use it, `gunicorn "report_web:create_app()"` builds only the app of its factory call"""
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == '__main__':
+    app = get_app()
     # with app.app_context():   # to create and populate a database model
     #     model_creation()
-    app.run(debug=False)
+    app.run(debug=False)  # the first request migrates the database and enables WAL (storage.prepare_database)
@@ -0,0 +1,183 @@
+"""This module serves the report of Monaco 2018 Racing from pre-serialized snapshots of every data version"""
+import gzip
+import json
+from functools import wraps
+from threading import Lock
+from types import MappingProxyType
+from flask import Response, current_app, render_template, request
+from dicttoxml import dicttoxml
+from loguru import logger
+
+from packaging_tutorial.report_FEDONYUK.cache_util import source_version
+from packaging_tutorial.report_FEDONYUK.db_util import get_report, get_drivers
+from packaging_tutorial.report_FEDONYUK.models import DEFAULT_SESSION
+
+SNAPSHOT_QUERY = {'order', 'driver_id', 'format', 'race', 'session'}  # Query parameters a snapshot can answer
+ORDERS = ('asc', 'desc')
+FORMATS = ('json', 'xml', 'html')
+API_FORMATS = ('json', 'xml')
+EMPTY_RACES = 256  # Race sessions without data remembered per data version
+NO_SNAPSHOTS = MappingProxyType({})  # Snapshots of a race session without data
+CONTENT_TYPES = {'json': 'application/json', 'xml': 'application/xml', 'html': 'text/html; charset=utf-8'}
+
+
+class Snapshot:
+    """Immutable serialized response with its gzip variant computed once"""
+    __slots__ = ('body', 'gzip_body', 'content_type')
+
+    def __init__(self, body: bytes, content_type: str):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+        self.content_type = content_type
+
+
+def serialize_body(data: list, data_format: str, template: str = None, **context) -> bytes:
+    """Function serializes a report or a list of drivers, shared by the snapshots, the views, the REST resources and
+    report_asgi. An HTML template is rendered in the current request context."""
+    if data_format == 'json':
+        return (json.dumps(data) + "\n").encode()  # the output of flask_restful
+    if data_format == 'xml':
+        return dicttoxml(data)
+    return render_template(template, **context).encode()
+
+
+def serialize(data: list, data_format: str, template: str = None, **context) -> Snapshot:
+    """Function serializes a report or a list of drivers into a snapshot"""
+    return Snapshot(serialize_body(data, data_format, template, **context), CONTENT_TYPES[data_format])
+
+
+def snapshot_context(race: str = None, session: str = None, app=None):
+    """Function returns the request context the templates of a race session are rendered in (their links)"""
+    query_string = {key: value for key, value in (('race', race), ('session', session)) if value is not None}
+    return (app or current_app).test_request_context('/report/', query_string=query_string)
+
+
+def render_snapshots(reports: dict[str, list], drivers: dict[str, list]) -> dict[tuple, Snapshot]:
+    """Function serializes every order and format of the report and of the drivers list, plus the report slice
+    of every driver. Keys are (kind, order or driver_id, format)."""
+    snapshots = {}
+    for order in ORDERS:
+        for data_format in FORMATS:
+            snapshots['report', order, data_format] = serialize(reports[order], data_format, 'report.html',
+                                                                report=reports[order])
+            snapshots['drivers', order, data_format] = serialize(drivers[order], data_format, 'drivers.html',
+                                                                 drivers=drivers[order])
+    for row in reports['asc']:
+        for data_format in FORMATS:
+            snapshots['driver', row[1], data_format] = serialize([row], data_format, 'report.html', report=[row])
+    return snapshots
+
+
+def race_snapshots(reports: dict[str, list], drivers: dict[str, list], race: str = None, session: str = None,
+                   app=None) -> dict[tuple, Snapshot]:
+    """Function serializes the snapshots of one race session from its data read by the synchronous (build_snapshots)
+    or the asynchronous (report_asgi) read path, no snapshots for a race session without data"""
+    if not reports['asc']:
+        return {}
+    with snapshot_context(race, session, app):
+        return render_snapshots(reports, drivers)
+
+
+def build_snapshots(race: str = None, session: str = None) -> dict[tuple, Snapshot]:
+    """Function builds the snapshots of one race session, the drivers list is read only for a race session with data"""
+    race_session = session or DEFAULT_SESSION
+    reports = {order: get_report(order == 'asc', race=race, session=race_session) for order in ORDERS}
+    drivers = {order: get_drivers(order == 'asc', race=race, session=race_session) for order in ORDERS} \
+        if reports['asc'] else {}
+    return race_snapshots(reports, drivers, race, session)
+
+
+class SnapshotStore:
+    """Snapshots of the current data version, built on the first request of every race session.
+
+    A race session without data is kept as NO_SNAPSHOTS (at most EMPTY_RACES of them), so an unknown race costs
+    one build per data version. Every race session is built under its own lock, outside of the lock of the store."""
+    lock_type = Lock  # lock of a build, report_asgi builds under an asyncio.Lock
+
+    def __init__(self):
+        self.version = None
+        self.races = {}  # (race, session) -> {key: Snapshot}, NO_SNAPSHOTS without data
+        self.builds = {}  # (race, session) -> lock of the build in progress
+        self.lock = Lock()  # guards version, races and builds, never held by a build
+
+    def cached(self, version: int, race_session: tuple) -> dict[tuple, Snapshot] | None:
+        """Function returns the snapshots of a race session built for version, None when they must be built"""
+        return self.races.get(race_session) if self.version == version else None
+
+    def build_lock(self, version: int, race_session: tuple):
+        """Function returns the lock of the build of a race session, a new data version drops every snapshot"""
+        with self.lock:
+            if self.version != version:
+                self.version, self.races, self.builds = version, {}, {}
+            return self.builds.setdefault(race_session, self.lock_type())
+
+    def store(self, version: int, race_session: tuple, snapshots: dict[tuple, Snapshot]) -> dict[tuple, Snapshot]:
+        """Function keeps the snapshots just built for a race session unless the data version changed meanwhile"""
+        snapshots = snapshots or NO_SNAPSHOTS
+        with self.lock:
+            if self.version == version:
+                empty = [k for k, value in self.races.items() if value is NO_SNAPSHOTS]
+                if snapshots is NO_SNAPSHOTS and len(empty) >= EMPTY_RACES:
+                    del self.races[empty[0]]  # the oldest race session without data
+                self.races[race_session] = snapshots
+                self.builds.pop(race_session, None)
+        if snapshots:
+            logger.info(f"[INFO] {len(snapshots)} snapshots of {race_session[0] or 'report'} built, version {version}.")
+        return snapshots
+
+    def get(self, race: str, session: str, key: tuple) -> Snapshot | None:
+        """Function returns the snapshot of a key, None for a race session without data"""
+        version = source_version()[0]
+        snapshots = self.cached(version, (race, session))
+        if snapshots is None:
+            snapshots = self.build(version, race, session)
+        return snapshots.get(key)
+
+    def build(self, version: int, race: str, session: str) -> dict[tuple, Snapshot]:
+        """Function builds the snapshots of a race session once, concurrent requests of it wait for that build"""
+        with self.build_lock(version, (race, session)):
+            if (snapshots := self.cached(version, (race, session))) is not None:
+                return snapshots  # built by the request this one waited for
+            return self.store(version, (race, session), build_snapshots(race, session))
+
+
+snapshot_store = SnapshotStore()
+
+
+def snapshot_key(args, kind: str, data_format: str = None, slices: bool = True) -> tuple | None:
+    """Function maps the query of a request to a snapshot key, None when a snapshot cannot answer it"""
+    if not args.keys() <= SNAPSHOT_QUERY:
+        return None
+    if data_format is None:  # the REST resources take the format from the query
+        data_format = args.get('format', 'json')
+        if data_format not in API_FORMATS:
+            return None
+    if 'driver_id' in args:
+        return ('driver', args['driver_id'], data_format) if slices else None
+    return kind, 'desc' if args.get('order') == 'desc' else 'asc', data_format
+
+
+def snapshot_response(snapshot: Snapshot) -> Response:
+    """Function writes the bytes of a snapshot, the gzip variant when the client accepts it"""
+    gzipped = request.accept_encodings['gzip'] > 0
+    response = Response(snapshot.gzip_body if gzipped else snapshot.body, content_type=snapshot.content_type)
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def served_from_snapshot(kind: str, data_format: str = None, slices: bool = True):
+    """Decorator serves a view from the snapshots of its kind ('report' or 'drivers'), the view runs only for
+    queries that have no snapshot. data_format fixes the format of an HTML view, slices=False leaves the queries
+    with a driver_id to the view."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = snapshot_key(request.args, kind, data_format, slices)
+            snapshot = key and snapshot_store.get(request.args.get('race'), request.args.get('session'), key)
+            if snapshot is None:
+                return view(*args, **kwargs)
+            return snapshot_response(snapshot)
+        return wrapper
+    return decorator
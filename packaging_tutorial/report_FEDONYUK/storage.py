@@ -0,0 +1,79 @@
+"""This module selects the storage backend of the report of Monaco 2018 Racing: SQLite by default or PostgreSQL
+
+The URLs are read from the config of the app, then from the environment, e.g.:
+    $ export REPORT_DATABASE_URL=postgresql://report@db-primary/monaco
+    $ export REPORT_READ_DATABASE_URL=postgresql://report@db-replica/monaco
+    $ export REPORT_SNAPSHOT_DIR=/srv/races/monaco-2018
+Every web node reads from the replica (or the primary) and the imports write to the primary. With a snapshot
+directory every read without a race selector (pages, streams, columnar exports, the ASGI mode) comes from the binary
+race snapshot of that directory, and the caches and the ETags follow its version (db_util.snapshot_source).
+"""
+import os
+from threading import Lock
+from loguru import logger
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+
+from packaging_tutorial.report_FEDONYUK.db_util import init_read_path, enable_wal, SNAPSHOT_DIR
+from packaging_tutorial.report_FEDONYUK.models import db, migrate_best_lap_ms
+
+DATABASE_URL = 'REPORT_DATABASE_URL'  # Primary database, the imports write to it
+READ_DATABASE_URL = 'REPORT_READ_DATABASE_URL'  # Database of the report reads, the primary when it is not set
+SERVER_ENGINE_OPTIONS = {'pool_size': 10, 'max_overflow': 20, 'pool_pre_ping': True, 'pool_recycle': 1800}
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+PREPARED = 'report_database_prepared'  # Key of the flag of prepare_database in the extensions of an app
+_prepare_lock = Lock()
+
+
+def normalize_url(url: str) -> str:
+    """Function selects psycopg2 for a PostgreSQL URL without a driver (the COPY of the bulk load uses its cursor),
+    the postgres:// scheme of the hosting providers included"""
+    for scheme in ('postgres://', 'postgresql://'):
+        if url.startswith(scheme):
+            return 'postgresql+psycopg2://' + url[len(scheme):]
+    return url
+
+
+def database_urls(config, default_url: str) -> tuple[str, str]:
+    """Function returns the URLs of the primary database and of the read path, the default one when none is set"""
+    url = normalize_url(config.get(DATABASE_URL) or os.environ.get(DATABASE_URL) or default_url)
+    return url, normalize_url(config.get(READ_DATABASE_URL) or os.environ.get(READ_DATABASE_URL) or url)
+
+
+def async_database_url(url: str) -> str:
+    """Function returns the URL of a database for the asynchronous driver of its backend"""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]).render_as_string(hide_password=False)
+
+
+def init_storage(app, default_url: str) -> None:
+    """Function connects an app to the configured storage backend and gives it its read path"""
+    url, read_url = database_urls(app.config, default_url)
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config[DATABASE_URL], app.config[READ_DATABASE_URL] = url, read_url
+    app.config.setdefault(SNAPSHOT_DIR, os.environ.get(SNAPSHOT_DIR))
+    if make_url(url).get_backend_name() != 'sqlite':
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', SERVER_ENGINE_OPTIONS)
+    db.init_app(app)
+    init_read_path(app, read_url)
+    app.before_request(lambda: prepare_database(app))
+    logger.info(f"[INFO] Storage backend: {make_url(url).get_backend_name()}, "
+                f"reads from {make_url(read_url).render_as_string()}.")
+
+
+def prepare_database(app) -> None:
+    """Function migrates the database of an app to the current schema and switches SQLite to the WAL journal, once
+    per app: the first request of every entry point (flask run, gunicorn, report_asgi) runs it, creating an app
+    still connects to nothing. A database that cannot be migrated (e.g. read-only) is served as it is."""
+    if app.extensions.get(PREPARED):
+        return
+    with _prepare_lock:
+        if app.extensions.get(PREPARED):
+            return
+        try:
+            with app.app_context():
+                migrate_best_lap_ms()
+                enable_wal()  # imports do not block the readers
+        except SQLAlchemyError as e:
+            logger.error(f"[ERROR] The database is not migrated: {e}")
+        app.extensions[PREPARED] = True
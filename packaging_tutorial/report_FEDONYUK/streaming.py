@@ -0,0 +1,114 @@
+"""This module streams large report payloads of Monaco 2018 Racing as JSON arrays, NDJSON or XML chunks"""
+import json
+import zlib
+from flask import Response, stream_with_context
+from dicttoxml import dicttoxml
+
+try:
+    import brotli  # optional: 'br' is offered only when the brotli package is installed
+except ImportError:
+    brotli = None
+
+STREAM_FORMATS = ('json', 'ndjson', 'xml')
+STREAM_TYPES = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'xml': 'application/xml'}
+XML_START = b'<?xml version="1.0" encoding="UTF-8" ?><root>'  # the prolog and the root element of dicttoxml
+
+
+def streamed(args) -> bool:
+    """Function tells if a query asks for a streamed report: stream=1 or the NDJSON format"""
+    return args.get('stream') in ('1', 'true') or args.get('format') == 'ndjson'
+
+
+def stream_format(args) -> str:
+    """Function returns the format of a streamed report, ValueError for a format that is not streamed"""
+    data_format = args.get('format', 'json')
+    if data_format not in STREAM_FORMATS:
+        raise ValueError("Invalid format")
+    return data_format
+
+
+class StreamEncoder:
+    """Serializer of a report chunk by chunk, one chunk per batch of rows, with the bytes of the buffered formats"""
+
+    def __init__(self, data_format: str):
+        self.data_format = data_format
+        self.rows = 0
+
+    def start(self) -> bytes:
+        """Function returns the opening of the document"""
+        return {'json': b'[', 'ndjson': b'', 'xml': XML_START}[self.data_format]
+
+    def encode(self, rows: list[list]) -> bytes:
+        """Function serializes one batch of rows"""
+        if self.data_format == 'xml':
+            chunk = dicttoxml(rows, root=False) if rows else b''
+        elif self.data_format == 'ndjson':
+            chunk = ''.join(json.dumps(row) + "\n" for row in rows).encode()
+        else:
+            separator = ", " if self.rows and rows else ""  # between the last row of a batch and the next one
+            chunk = (separator + ", ".join(json.dumps(row) for row in rows)).encode()
+        self.rows += len(rows)
+        return chunk
+
+    def end(self) -> bytes:
+        """Function returns the closing of the document"""
+        return {'json': b']\n', 'ndjson': b'', 'xml': b'</root>'}[self.data_format]
+
+
+class StreamCompressor:
+    """Compressor of a stream, every chunk is flushed so a client can decode the rows it has received"""
+
+    def __init__(self, encoding: str = None):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+        elif encoding == 'br':
+            self.compressor = brotli.Compressor(quality=5)
+
+    def compress(self, chunk: bytes) -> bytes:
+        """Function compresses and flushes one chunk"""
+        if self.encoding == 'gzip':
+            return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == 'br':
+            return self.compressor.process(chunk) + self.compressor.flush()
+        return chunk
+
+    def finish(self) -> bytes:
+        """Function returns the end of the compressed stream"""
+        if self.encoding == 'gzip':
+            return self.compressor.flush()
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return b''
+
+
+def stream_encoding(accept_encodings) -> str | None:
+    """Function picks the content coding of a stream: brotli when it is installed and accepted, then gzip"""
+    if brotli is not None and accept_encodings['br'] > 0:
+        return 'br'
+    return 'gzip' if accept_encodings['gzip'] > 0 else None
+
+
+def encode_stream(batches, data_format: str, encoding: str = None):
+    """Generator of the encoded and compressed chunks of a report given as batches of rows"""
+    encoder, compressor = StreamEncoder(data_format), StreamCompressor(encoding)
+    yield compressor.compress(encoder.start())
+    for rows in batches:
+        if chunk := encoder.encode(rows):
+            yield compressor.compress(chunk)
+    yield compressor.compress(encoder.end()) + compressor.finish()
+
+
+def stream_headers(data_format: str, encoding: str = None) -> dict:
+    """Function returns the headers of a streamed report"""
+    headers = {'Content-Type': STREAM_TYPES[data_format], 'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return headers
+
+
+def stream_response(batches, data_format: str, accept_encodings) -> Response:
+    """Function writes a report with chunked transfer as the database cursor produces its rows"""
+    encoding = stream_encoding(accept_encodings)
+    return Response(stream_with_context(encode_stream(batches, data_format, encoding)),
+                    headers=stream_headers(data_format, encoding))
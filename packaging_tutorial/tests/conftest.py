@@ -0,0 +1,25 @@
+"""--Fixtures shared by the pytest modules of the Web and REST API report of Monaco 2018 Racing--"""
+import pytest
+from cachelib import SimpleCache
+
+from packaging_tutorial.report_FEDONYUK import snapshots
+from packaging_tutorial.report_FEDONYUK.cache_util import cache, tiered_cache, CircuitBreaker, LocalCache
+from packaging_tutorial.report_FEDONYUK.report_web import app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Test client of the app on an empty in-memory cache: a SimpleCache as the shared tier, a new local tier and
+    a closed circuit breaker"""
+    app.config['TESTING'] = True
+    monkeypatch.setitem(app.extensions['cache'], cache, SimpleCache())
+    monkeypatch.setattr(tiered_cache, 'local', LocalCache())
+    monkeypatch.setattr(tiered_cache, 'breaker', CircuitBreaker())
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def no_snapshots(monkeypatch):
+    """No snapshot answers a request: the cached views and the REST resources run"""
+    monkeypatch.setattr(snapshots.snapshot_store, 'get', lambda *args: None)
@@ -29,6 +29,32 @@ class TestReportResource(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.headers['Content-Type'], 'application/json')
 
+    def test_get_report_race_session(self):
+        response = self.client.get('/api/v1/report/?race=monaco-2018&session=race&driver_id=KRF')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [[4, "KRF", "Kimi Räikkönen", "FERRARI", "1:12:639"]])
+
+    def test_get_report_pages(self):
+        response = self.client.get('/api/v1/report/?limit=3&fields=position,driver_id')
+        self.assertEqual(response.json, [[1, 'SVF'], [2, 'VBM'], [3, 'SVM']])
+        response = self.client.get(f"/api/v1/report/?limit=3&fields=position,driver_id"
+                                   f"&cursor={response.headers['X-Next-Cursor']}")
+        self.assertEqual(response.json, [[4, 'KRF'], [5, 'FAM'], [6, 'CLS']])
+        response = self.client.get('/api/v1/report/?format=xml&limit=1')
+        self.assertEqual(response.headers['Content-Type'], 'application/xml')
+        self.assertIn('X-Next-Cursor', response.headers)
+        self.assertNotIn('X-Next-Cursor', self.client.get('/api/v1/report/').headers)
+
+    def test_get_report_filters(self):
+        response = self.client.get('/api/v1/report/?team=FERRARI&max_lap=70000&fields=driver_id')
+        self.assertEqual(response.json, [['SVF']])
+
+    def test_get_report_invalid_query(self):
+        for query in ('limit=0', 'limit=ten', 'max_lap=-1', 'fields=position,speed', 'cursor=abc'):
+            response = self.client.get(f'/api/v1/report/?{query}')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid', response.json['error'])
+
     def test_get_report_driver_xml(self):
         response = self.client.get('/api/v1/report/?format=xml&driver_id=LHM')
         self.assertEqual(response.status_code, 200)
@@ -50,6 +76,11 @@ class TestDriversResource(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.headers['Content-Type'], 'application/xml')
 
+    def test_get_drivers_race(self):
+        response = self.client.get('/api/v1/report/drivers/?race=monaco-2018&order=desc')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json[0], ['Valtteri Bottas', 'VBM'])
+
     def test_get_drivers_invalid_format(self):
         response = self.client.get('/api/v1/report/drivers/?format=txt')
         self.assertEqual(response.status_code, 400)
@@ -0,0 +1,167 @@
+"""--Pytest for the asynchronous ASGI serving mode of Monaco 2018 Racing--"""
+import asyncio
+import json
+import os
+import shutil
+
+import fakeredis
+import pytest
+
+from packaging_tutorial.report_FEDONYUK import race_snapshot, report_asgi, snapshots
+from packaging_tutorial.report_FEDONYUK.db_util import SNAPSHOT_DIR
+from packaging_tutorial.report_FEDONYUK.metrics import DB_QUERY_SECONDS, REQUEST_SECONDS
+from packaging_tutorial.report_FEDONYUK.report import _BASE_DIR
+from packaging_tutorial.report_FEDONYUK.report_live import publish
+
+URLS = ['/api/v1/report/', '/api/v1/report/?order=desc&format=xml', '/api/v1/report/?driver_id=SVF',
+        '/api/v1/report/?format=csv', '/api/v1/report/?limit=3', '/api/v1/report/drivers/?order=desc',
+        '/api/v1/report/drivers/?driver_id=LHM&format=xml', '/api/v1/report/?race=monaco-2018&session=race',
+        '/api/v1/report/?race=unknown-race', '/report/', '/report/?order=desc', '/report/drivers/',
+        '/report/drivers/?driver_id=SVF', '/report/drivers/?driver_id=XXX', '/report/?driver_id=SVF&order=desc',
+        '/report/drivers/?race=monaco-2018', '/api/v1/report/?limit=3&fields=driver_id,best_lap&format=xml',
+        '/api/v1/report/?team=FERRARI&max_lap=70000&race=monaco-2018', '/api/v1/report/?limit=ten',
+        '/api/v1/report/?stream=1', '/api/v1/report/?format=ndjson&order=desc&race=monaco-2018',
+        '/api/v1/report/?stream=1&format=xml&limit=5', '/api/v1/report/?format=ndjson&cursor=abc',
+        '/api/v1/report/?stream=1&format=html', '/api/v1/report/?format=arrow&limit=3&fields=driver_id,best_lap',
+        '/api/v1/report/?format=parquet&race=monaco-2018&order=desc', '/api/v1/report/drivers/?format=msgpack',
+        '/api/v1/report/drivers/?format=arrow&driver_id=SVF', '/api/v1/report/?format=msgpack&max_lap=bad']
+
+
+def call(path: str, headers: dict = None, receive=None, send=None) -> dict:
+    """Function runs one GET request through the ASGI application, returns status, headers and body"""
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(), 'root_path': '',
+             'scheme': 'http', 'server': ('localhost', 80), 'client': ('127.0.0.1', 5000), 'http_version': '1.1',
+             'headers': [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]}
+    messages = []
+
+    async def default_receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def default_send(message):
+        messages.append(message)
+
+    async def run():
+        report_asgi.version_memo.expires = 0.0  # every test reads the data version of its own event loop
+        await report_asgi.application(scope, receive or default_receive, send or default_send)
+        await report_asgi.engine.dispose()
+    asyncio.run(run())
+    start = messages[0]
+    return {'status': start['status'], 'headers': {name.decode(): value.decode() for name, value in start['headers']},
+            'body': b''.join(message.get('body', b'') for message in messages[1:])}
+
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setattr(report_asgi, 'snapshot_store', report_asgi.AsyncSnapshotStore())
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    """REPORT_SNAPSHOT_DIR set to a copy of the race files, whose snapshot has 2 drivers with every lap at 0:00:0"""
+    for file_name in race_snapshot.SOURCE_FILES:
+        shutil.copy(os.path.join(_BASE_DIR, file_name), tmp_path)
+    race_snapshot.write_snapshot(str(tmp_path), [('SVF', 'Sebastian Vettel', 'FERRARI', 0),
+                                                  ('LHM', 'Lewis Hamilton', 'MERCEDES', 0)])
+    monkeypatch.setitem(report_asgi.flask_app.config, SNAPSHOT_DIR, str(tmp_path))
+
+
+def assert_same_response(client, url: str) -> None:
+    """Function checks that the ASGI application answers a request like the Flask app"""
+    served = call(url)
+    expected = client.get(url)
+    assert served['status'] == expected.status_code
+    assert served['body'] == expected.data
+    for header in ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'X-Next-Cursor'):
+        assert served['headers'].get(header.lower()) == expected.headers.get(header)
+    if expected.status_code == 302:
+        assert served['headers']['location'] == expected.location
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_same_responses_as_flask(client, store, url):
+    assert_same_response(client, url)
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_same_responses_from_the_snapshot_dir(client, store, snapshot_dir, url):
+    assert_same_response(client, url)
+
+
+def test_snapshot_dir_is_served(store, snapshot_dir):
+    assert json.loads(call('/api/v1/report/?limit=1')['body']) == [[1, 'SVF', 'Sebastian Vettel', 'FERRARI', '0:00:0']]
+    assert json.loads(call('/api/v1/report/drivers/')['body']) == [['Lewis Hamilton', 'LHM'],
+                                                                    ['Sebastian Vettel', 'SVF']]
+
+
+def test_metrics_are_recorded(store):
+    route = ('/api/v1/report/', 'GET', '200')
+    requests = sum(REQUEST_SECONDS.series.get(route, [[0]])[0])
+    reads = sum(DB_QUERY_SECONDS.series.get(('report',), [[0]])[0])
+    call('/api/v1/report/?limit=3')
+    assert sum(REQUEST_SECONDS.series[route][0]) == requests + 1
+    assert sum(DB_QUERY_SECONDS.series[('report',)][0]) == reads + 1
+
+
+def test_conditional_request_and_gzip(store):
+    response = call('/api/v1/report/', {'Accept-Encoding': 'gzip'})
+    assert response['headers']['content-encoding'] == 'gzip'
+    assert response['headers']['etag'].endswith('-gzip"')
+    revalidated = call('/api/v1/report/', {'If-None-Match': response['headers']['etag']})
+    assert revalidated['status'] == 304
+    assert not revalidated['body']
+
+
+def test_unknown_race_is_built_once_per_version(store):
+    assert call('/report/?race=unknown-2000')['status'] == 200
+    version = report_asgi.version_memo.value[0]
+    assert report_asgi.snapshot_store.races == {('unknown-2000', None): snapshots.NO_SNAPSHOTS}
+    assert report_asgi.snapshot_store.version == version and not report_asgi.snapshot_store.builds
+
+
+def test_other_paths_are_served_by_flask(store):
+    assert call('/apispec_1.json')['status'] == 200  # the Swagger contract of report_web
+    assert call('/unknown/')['headers']['location'] == '/apidocs/'
+
+
+def test_live_stream(store, monkeypatch):
+    redis_client = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(report_asgi, 'redis_client', redis_client)
+    events = []
+    disconnect = None
+
+    async def receive():
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            events.append(message['body'].decode())
+            if len(events) == 1:
+                await publish_async()
+            elif events[-1].startswith('event: update'):
+                disconnect.set()
+
+    async def publish_async():
+        await redis_client.publish(report_asgi.LIVE_CHANNEL, json.dumps([[1, 'SVF']]))
+
+    async def run():
+        nonlocal disconnect
+        disconnect = asyncio.Event()
+        await report_asgi.application({'type': 'http', 'method': 'GET', 'path': '/report/live/', 'query_string': b'',
+                                       'headers': []}, receive, send)
+        await report_asgi.engine.dispose()
+    asyncio.run(asyncio.wait_for(run(), timeout=10))
+    assert events[0].startswith('event: snapshot')
+    assert len(json.loads(events[0].split('data: ', 1)[1])) == 19
+    assert json.loads(next(event for event in events if event.startswith('event: update')).split('data: ')[1]) == \
+        [[1, 'SVF']]
+
+
+def test_live_stream_without_redis(store, monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(report_asgi, 'redis_client', fakeredis.FakeAsyncRedis(server=server))
+    events = call('/report/live/')['body'].decode().split('\n\n')
+    assert events[0].startswith('event: snapshot')
+    assert events[1:] == [f'retry: {report_asgi.LIVE_RETRY}', '']
@@ -0,0 +1,76 @@
+"""--Pytest for the parallel batch mode of the CLI report of Monaco 2018 Racing--"""
+import csv
+import json
+import os
+import shutil
+
+import pytest
+from click.testing import CliRunner
+
+from packaging_tutorial.report_FEDONYUK import report_cli
+from packaging_tutorial.report_FEDONYUK.report import build_report, format_report, _BASE_DIR
+from packaging_tutorial.report_FEDONYUK.report_cli import main_cli, race_dirs, output_names, render_report, run_batch
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """Three copies of the Monaco 2018 race and a directory without logs"""
+    for season in ('2016', '2017', '2018'):
+        os.makedirs(tmp_path / 'archive' / season)
+        for file_name in ('abbreviations.txt', 'start.log', 'end.log'):
+            shutil.copy(os.path.join(_BASE_DIR, file_name), tmp_path / 'archive' / season)
+    os.makedirs(tmp_path / 'archive' / 'broken')
+    return tmp_path / 'archive'
+
+
+def test_race_dirs_from_globs_and_manifest(archive):
+    manifest = archive / 'manifest.txt'
+    manifest.write_text("# nightly\n2018\n\n2016\nmissing\n", encoding='utf-8')
+    assert race_dirs((str(archive / '201[78]'),), str(manifest)) == \
+        [str(archive / '2017'), str(archive / '2018'), str(archive / '2016')]  # every directory once
+
+
+def test_output_names():
+    assert output_names(['a/race', 'b/race', 'c/other'], 'csv') == ['race.csv', 'race-2.csv', 'other.csv']
+
+
+def test_render_report():
+    table = build_report(path=_BASE_DIR)
+    assert json.loads(render_report(table, 'json')) == table
+    rows = list(csv.reader(render_report(table, 'csv').splitlines()))
+    assert rows[0] == report_cli.CSV_HEADERS
+    assert rows[1] == [str(value) for value in table[0]]
+    assert render_report(table, 'text') == format_report(table) + "\n"
+
+
+def test_run_batch(archive, tmp_path):
+    dirs = race_dirs((str(archive / '*'),))
+    summary = run_batch(dirs, str(tmp_path / 'reports'), 'json', asc=False, workers=2)
+    assert (summary['races'], summary['failed'], summary['rows'], summary['workers']) == (3, 1, 57, 2)
+    assert sorted(os.listdir(tmp_path / 'reports')) == ['2016.json', '2017.json', '2018.json']
+    with open(tmp_path / 'reports' / '2017.json', encoding='utf-8') as report:
+        assert json.load(report) == build_report(False, path=_BASE_DIR)
+
+
+def test_batch_cli(archive, tmp_path):
+    result = CliRunner().invoke(main_cli, ['--races', str(archive / '*'), '--format', 'text', '--workers', '1',
+                                           '--output', str(tmp_path / 'reports')])
+    assert result.exit_code == 0
+    assert '3 reports' in result.output
+    assert '1 failed' in result.output
+    assert CliRunner().invoke(main_cli, ['--races', str(archive / '*'), '--driver', 'Sebastian Vettel']).exit_code == 2
+    assert CliRunner().invoke(main_cli, ['--races', str(tmp_path / 'nothing*')]).exit_code == 2
+
+
+def test_driver_report_parses_once(monkeypatch):
+    calls = []
+    original = report_cli.get_drivers
+
+    def get_drivers(*args, **kwargs):
+        calls.append(args)
+        return original(*args, **kwargs)
+    monkeypatch.setattr(report_cli, 'get_drivers', get_drivers)
+    result = CliRunner().invoke(main_cli, ['--file', _BASE_DIR, '--driver', 'Sebastian Vettel'])
+    assert result.exit_code == 0
+    assert 'SVF' in result.output
+    assert len(calls) == 1
@@ -0,0 +1,213 @@
+"""--Pytest for the query-aware cache of the Web and REST API report of Monaco 2018 Racing--"""
+from datetime import datetime
+
+import fakeredis
+import pytest
+from cachelib import RedisCache
+
+from packaging_tutorial.report_FEDONYUK import cache_util, report_api
+from packaging_tutorial.report_FEDONYUK.cache_util import cache, tiered_cache, version_memo, LocalCache, \
+    CircuitBreaker, TieredCache, VersionMemo
+from packaging_tutorial.report_FEDONYUK.report_web import app
+
+pytestmark = pytest.mark.usefixtures('no_snapshots')
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def shared(server):
+    """Shared tier on a fake Redis, outside of a Flask application"""
+    return RedisCache(host=fakeredis.FakeStrictRedis(server=server), key_prefix='test:')
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def get_report_page(*args, **kwargs):
+        calls.append(kwargs)
+        return original(*args, **kwargs)
+    original = report_api.get_report_page
+    monkeypatch.setattr(report_api, 'get_report_page', get_report_page)
+    return calls
+
+
+def test_queries_do_not_share_entries(client):
+    asc = client.get('/api/v1/report/').json
+    desc = client.get('/api/v1/report/', query_string={'order': 'desc'}).json
+    assert asc == desc[::-1]
+    assert client.get('/api/v1/report/', query_string={'driver_id': 'SVF'}).json == [asc[0]]
+    assert client.get('/report/drivers/', query_string={'driver_id': 'SVF'}).data != \
+        client.get('/report/drivers/', query_string={'driver_id': 'LHM'}).data
+
+
+def test_repeated_query_is_a_hit(client, calls):
+    first = client.get('/api/v1/report/', query_string={'order': 'desc', 'format': 'xml'})
+    second = client.get('/api/v1/report/', query_string={'format': 'xml', 'order': 'desc'})
+    assert len(calls) == 1
+    assert second.data == first.data
+    assert second.content_type == 'application/xml'
+    client.get('/api/v1/report/', query_string={'order': 'DESC'})  # any order but 'desc' is 'asc'
+    client.get('/api/v1/report/', query_string={'order': 'asc'})
+    assert len(calls) == 2
+
+
+def test_data_version_invalidates_entries(client, calls, monkeypatch):
+    client.get('/api/v1/report/')
+    client.get('/api/v1/report/')
+    assert len(calls) == 1
+    version, updated_at = version_memo.get()
+    monkeypatch.setattr(version_memo, 'get', lambda: (version + 1, updated_at))  # an import bumped the data version
+    client.get('/api/v1/report/')
+    assert len(calls) == 2
+
+
+def test_hit_makes_no_database_query(client, version, monkeypatch):
+    first = client.get('/api/v1/report/', query_string={'limit': 2})
+
+    def untouchable(*args, **kwargs):
+        raise AssertionError('A cache hit must not reach the database')
+    monkeypatch.setattr(cache_util, 'get_data_version_info', untouchable)
+    monkeypatch.setattr(report_api, 'get_report_page', untouchable)
+    assert client.get('/api/v1/report/', query_string={'limit': 2}).json == first.json
+
+
+def test_errors_are_not_cached(client):
+    assert client.get('/api/v1/report/', query_string={'format': 'csv'}).status_code == 400
+    assert not cache.cache._cache
+
+
+def test_redirect_keeps_the_query(client):
+    response = client.get('/report/', query_string={'driver_id': 'SVF', 'order': 'desc'})
+    assert response.status_code == 302
+    assert client.get('/report/', query_string={'driver_id': 'LHM'}).location.endswith('driver_id=LHM')
+
+
+def test_local_cache_evicts_least_recently_used():
+    local = LocalCache(size=2)
+    local.set('a', 1)
+    local.set('b', 2)
+    assert local.get('a') == 1  # 'b' is now the least recently used
+    local.set('c', 3)
+    assert (local.get('a'), local.get('b'), local.get('c')) == (1, None, 3)
+
+
+def test_local_cache_expires_entries(monkeypatch):
+    local = LocalCache(ttl=10)
+    local.set('a', 1)
+    now = cache_util.time.monotonic()
+    monkeypatch.setattr(cache_util.time, 'monotonic', lambda: now + 11)
+    assert local.get('a') is None
+    assert not local.entries
+
+
+def test_tiers_share_entries_between_workers(shared):
+    worker, other_worker = TieredCache(shared), TieredCache(shared)
+    assert worker.get('key') is None
+    worker.set('key', ('value', [1]))
+    assert other_worker.get('key') == ('value', [1])  # read from Redis, then kept locally
+    assert other_worker.get('key') == ('value', [1])
+    assert other_worker.stats()['shared_hits'] == 1
+    assert other_worker.stats()['local_hits'] == 1
+    assert worker.stats()['misses'] == 1
+    assert worker.stats()['shared_latency_ms'] >= 0
+
+
+def test_half_open_circuit_lets_one_probe_through(monkeypatch):
+    breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.failure(ConnectionError('down'))
+    assert not breaker.allow()
+    now = cache_util.time.monotonic()
+    monkeypatch.setattr(cache_util.time, 'monotonic', lambda: now + 31)
+    assert not breaker.is_open()
+    assert breaker.allow()  # the probe
+    assert not breaker.allow()  # every other call waits for the probe
+    assert breaker.is_open()
+    breaker.failure(ConnectionError('still down'))  # a failed probe opens the circuit again
+    assert not breaker.allow()
+    monkeypatch.setattr(cache_util.time, 'monotonic', lambda: now + 62)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_circuit_breaker_falls_back_to_local_cache(shared, server, monkeypatch):
+    tiers = TieredCache(shared, breaker=CircuitBreaker(threshold=2, reset_timeout=30))
+    server.connected = False  # Redis is down
+    tiers.set('key', 'value')
+    assert tiers.get('key') == 'value'  # served by the local tier
+    assert tiers.get('other') is None
+    assert tiers.stats()['shared_errors'] == 2
+    assert tiers.stats()['circuit_open']
+    assert tiers.get('other') is None  # the open circuit skips Redis
+    assert tiers.stats()['shared_calls'] == 2
+
+    server.connected = True
+    now = cache_util.time.monotonic()
+    monkeypatch.setattr(cache_util.time, 'monotonic', lambda: now + 31)  # half-open: one call may try Redis
+    tiers.set('other', 'value')
+    assert not tiers.stats()['circuit_open']
+    assert shared.get('other') == 'value'
+
+
+def test_view_is_served_when_redis_is_down(client, server, monkeypatch):
+    server.connected = False
+    monkeypatch.setitem(app.extensions['cache'], cache, RedisCache(host=fakeredis.FakeStrictRedis(server=server)))
+    first = client.get('/api/v1/report/')
+    assert first.status_code == 200
+    assert client.get('/api/v1/report/').json == first.json
+    assert tiered_cache.stats()['local_hits'] >= 1
+
+
+@pytest.fixture
+def version(monkeypatch):
+    """Data version 3 imported at 2024-05-01 12:00:00 UTC"""
+    monkeypatch.setattr(version_memo, 'get', lambda: (3, datetime(2024, 5, 1, 12)))
+
+
+@pytest.mark.parametrize('url', ['/report/', '/report/drivers/', '/api/v1/report/?format=xml',
+                                 '/api/v1/report/drivers/'])
+def test_conditional_get(client, version, monkeypatch, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['ETag'].startswith('"v3-')
+    assert response.headers['Last-Modified'] == 'Wed, 01 May 2024 12:00:00 GMT'
+    assert response.headers['Cache-Control'] == 'public, max-age=0, must-revalidate'
+
+    def untouchable(*args, **kwargs):
+        raise AssertionError('A conditional request must not reach the data')
+    monkeypatch.setattr(cache_util, 'get_data_version_info', untouchable)
+    monkeypatch.setattr(report_api, 'get_report_page', untouchable)
+    revalidated = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert not revalidated.data
+    assert revalidated.headers['ETag'] == response.headers['ETag']
+    assert client.get(url, headers={'If-Modified-Since': 'Wed, 01 May 2024 12:00:00 GMT'}).status_code == 304
+
+
+def test_conditional_get_sends_changed_data(client, version, monkeypatch):
+    etag = client.get('/api/v1/report/').headers['ETag']
+    assert client.get('/api/v1/report/?order=desc', headers={'If-None-Match': etag}).status_code == 200
+    assert client.get('/api/v1/report/', headers={'If-Modified-Since': 'Wed, 01 May 2024 11:59:59 GMT'}).json
+    monkeypatch.setattr(version_memo, 'get', lambda: (4, datetime(2024, 5, 2)))  # an import
+    response = client.get('/api/v1/report/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'].startswith('"v4-')
+
+
+def test_errors_have_no_validators(client, version):
+    response = client.get('/api/v1/report/', query_string={'format': 'csv'})
+    assert response.status_code == 400
+    assert 'ETag' not in response.headers
+
+
+def test_version_memo_reads_the_database_once_per_ttl(monkeypatch):
+    reads = []
+    monkeypatch.setattr(cache_util, 'get_data_version_info', lambda: reads.append(1) or (1, None))
+    memo = VersionMemo(ttl=60)
+    assert memo.get() == memo.get() == (1, None)
+    assert len(reads) == 1
@@ -0,0 +1,78 @@
+"""--Pytest for the binary columnar exports of the REST API report of Monaco 2018 Racing--"""
+import io
+import os
+import shutil
+
+import pytest
+
+from packaging_tutorial.report_FEDONYUK import columnar, race_snapshot
+from packaging_tutorial.report_FEDONYUK.db_util import SNAPSHOT_DIR
+from packaging_tutorial.report_FEDONYUK.report import _BASE_DIR
+
+pyarrow = pytest.importorskip('pyarrow')
+msgpack = pytest.importorskip('msgpack')
+import pyarrow.parquet  # noqa: E402  (after the optional dependency is known to be installed)
+
+
+def read(response) -> dict:
+    """Function decodes an export into a map of column name to values"""
+    if response.content_type == 'application/msgpack':
+        return msgpack.unpackb(response.data)
+    if response.content_type == 'application/vnd.apache.parquet':
+        return pyarrow.parquet.read_table(io.BytesIO(response.data)).to_pydict()
+    assert response.content_type == 'application/vnd.apache.arrow.stream'
+    return pyarrow.ipc.open_stream(response.data).read_all().to_pydict()
+
+
+@pytest.mark.parametrize('data_format', columnar.COLUMNAR_FORMATS)
+def test_exports_have_the_rows_of_the_report(client, data_format):
+    report = client.get('/api/v1/report/?order=desc').json
+    columns = read(client.get(f'/api/v1/report/?order=desc&format={data_format}'))
+    assert list(columns) == ['position', 'driver_id', 'name', 'team', 'best_lap_ms']
+    assert [list(row[:4]) for row in zip(*columns.values())] == [row[:4] for row in report]
+    assert columns['best_lap_ms'][-1] == 64415  # 1:04.415 as int64 ms, not a formatted string
+
+
+def test_arrow_schema(client):
+    table = pyarrow.ipc.open_stream(client.get('/api/v1/report/?format=arrow&race=monaco-2018').data).read_all()
+    assert table.schema.field('best_lap_ms').type == pyarrow.int64()
+    assert table.schema.field('driver_id').type == pyarrow.string()
+
+
+def test_export_pages_and_projection(client):
+    first = client.get('/api/v1/report/?format=parquet&limit=3&fields=driver_id,best_lap')
+    assert read(first) == {'driver_id': ['SVF', 'VBM', 'SVM'], 'best_lap_ms': [64415, 72434, 72463]}
+    second = client.get(f"/api/v1/report/?format=parquet&limit=3&fields=driver_id"
+                        f"&cursor={first.headers['X-Next-Cursor']}")
+    assert read(second) == {'driver_id': ['KRF', 'FAM', 'CLS']}
+
+
+@pytest.mark.parametrize('data_format', columnar.COLUMNAR_FORMATS)
+def test_drivers_exports(client, data_format):
+    drivers = client.get('/api/v1/report/drivers/?order=desc').json
+    assert read(client.get(f'/api/v1/report/drivers/?order=desc&format={data_format}')) == \
+        {'name': [name for name, _ in drivers], 'driver_id': [driver_id for _, driver_id in drivers]}
+    assert read(client.get(f'/api/v1/report/drivers/?driver_id=SVF&format={data_format}'))['position'] == [1]
+
+
+def test_empty_export(client):
+    assert read(client.get('/api/v1/report/?format=arrow&driver_id=XXX'))['driver_id'] == []
+
+
+def test_unavailable_format(client, monkeypatch):
+    monkeypatch.setattr(columnar, 'pyarrow', None)
+    response = client.get('/api/v1/report/?format=parquet')
+    assert response.status_code == 400
+    assert response.json == {'error': 'Unavailable format: parquet'}
+    assert client.get('/api/v1/report/?format=msgpack').status_code == 200
+
+
+def test_exports_read_the_snapshot_dir(client, tmp_path, monkeypatch):
+    for file_name in race_snapshot.SOURCE_FILES:
+        shutil.copy(os.path.join(_BASE_DIR, file_name), tmp_path)
+    race_snapshot.write_snapshot(str(tmp_path), [('SVF', 'Sebastian Vettel', 'FERRARI', 1)])  # one lap of 1 ms
+    monkeypatch.setitem(client.application.config, SNAPSHOT_DIR, str(tmp_path))
+    assert read(client.get('/api/v1/report/?format=msgpack&fields=driver_id,best_lap')) == \
+        {'driver_id': ['SVF'], 'best_lap_ms': [1]}
+    assert read(client.get('/api/v1/report/drivers/?format=arrow')) == \
+        {'name': ['Sebastian Vettel'], 'driver_id': ['SVF']}
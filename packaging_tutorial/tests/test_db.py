@@ -1,11 +1,20 @@
 """--UnitTest for models.py and db_util.py modules for creating and working with a database model--"""
+import base64
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
-from datetime import timedelta
+from datetime import datetime, timedelta
 from flask import Flask
 
 from packaging_tutorial.report_FEDONYUK.models import db, Driver, DriverModel, model_creation, get_abbreviation, \
-    read_log_file, merged_laps, get_drivers_all, format_timedelta
-from packaging_tutorial.report_FEDONYUK.db_util import get_report, get_drivers
+    read_log_file, merged_laps, get_drivers_all, format_timedelta, parse_lap_time, migrate_best_lap_ms, \
+    import_race, LapModel, RaceModel, DEFAULT_RACE, _BASE_DIR, batched, refresh_race, ImportCheckpoint, file_digest, \
+    complete_offset
+from packaging_tutorial.report_FEDONYUK.db_util import get_report, get_report_page, get_drivers, get_data_version, \
+    get_data_version_info, init_read_path, enable_wal, read_connection, report_statement, decode_cursor, READER_ENGINE
 
 ONE_DRIVER = [4, "KRF", "Kimi Räikkönen", "FERRARI", "1:12:639"]
 EXPECTED_LIST = [['Valtteri Bottas', 'VBM'], ['Stoffel Vandoorne', 'SVM'], ['Sergio Perez', 'SPF'],
@@ -69,6 +78,14 @@ class TestModels(unittest.TestCase):
         self.assertTrue(all(isinstance(driver, Driver) for driver in drivers))
         self.assertGreater(len(drivers), 15)
 
+    def test_get_drivers_all_stream(self):
+        self.assertEqual(get_drivers_all(stream=True), get_drivers_all())
+
+    def test_get_drivers_all_trusted(self):
+        trusted = [(dr.driver_id, dr.name, dr.team, dr.best_lap) for dr in get_drivers_all(trusted=True)]
+        strict = [(dr.driver_id, dr.name, dr.team, dr.best_lap) for dr in get_drivers_all()]
+        self.assertEqual(trusted, strict)
+
     def test_format_timedelta(self):
         time_obj = timedelta(minutes=1, seconds=45, microseconds=500000)
         formatted_time = format_timedelta(time_obj)
@@ -90,6 +107,65 @@ class TestModels(unittest.TestCase):
             self.assertEqual(drivers_list, EXPECTED_LIST)
             self.assertEqual(len(drivers_list), 19)
 
+    def test_get_report_limit_and_slower_than(self):
+        with self.app.app_context():
+            self.assertEqual(get_report(limit=4)[-1], ONE_DRIVER)
+            self.assertEqual([dr[1] for dr in get_report(False, limit=2)], ['LHM', 'EOF'])
+            self.assertEqual([dr[1] for dr in get_report(slower_than=200_000)], ['SSW', 'EOF', 'LHM'])
+
+    def test_get_report_page_keyset_cursor(self):
+        with self.app.app_context():
+            for asc, race in ((True, None), (False, None), (True, DEFAULT_RACE), (False, DEFAULT_RACE)):
+                pages, cursor = [], None
+                while True:
+                    page, cursor = get_report_page(asc, limit=5, race=race, cursor=cursor)
+                    pages.extend(page)
+                    if cursor is None:
+                        break
+                self.assertEqual(pages, get_report(asc, race=race))
+            self.assertEqual(get_report_page(limit=19)[1] is None, False)  # a full last page still has a cursor
+            self.assertEqual(get_report_page(limit=19, cursor=get_report_page(limit=19)[1]), ([], None))
+            with self.assertRaises(ValueError):
+                get_report_page(cursor='not-a-cursor')
+
+    def test_get_report_page_cursor_carries_the_position(self):
+        with self.app.app_context():
+            for asc, query in ((True, {'slower_than': 70_000}), (False, {'max_lap': 100_000}), (False, {})):
+                first, cursor = get_report_page(asc, limit=3, **query)
+                self.assertEqual(first + get_report_page(asc, limit=20, cursor=cursor, **query)[0],
+                                 get_report(asc, **query))
+            best_lap_ms, tie_break, position = decode_cursor(get_report_page(limit=4)[1])
+            self.assertEqual(position, 4)
+            old_cursor = base64.urlsafe_b64encode(json.dumps([best_lap_ms, tie_break]).encode()).decode()
+            self.assertEqual(get_report_page(limit=2, cursor=old_cursor)[0], get_report(limit=6)[4:])
+
+    def test_get_report_page_fields_and_filters(self):
+        with self.app.app_context():
+            for race in (None, DEFAULT_RACE):
+                self.assertEqual(get_report_page(limit=2, race=race, fields=('driver_id', 'best_lap'))[0],
+                                 [['SVF', '1:04:415'], ['VBM', '1:12:434']])
+                self.assertEqual(get_report(team='FERRARI', race=race), [get_report(driver='SVF')[0], ONE_DRIVER])
+                self.assertEqual([dr[1] for dr in get_report(race=race, max_lap=72_500)], ['SVF', 'VBM', 'SVM'])
+
+    def test_best_lap_ms_saved_and_indexed(self):
+        with self.app.app_context():
+            saved_driver = DriverModel.query.filter_by(driver_id='NHR').first()
+            self.assertEqual(saved_driver.best_lap_ms, 73065)
+            self.assertTrue(any(index.columns.keys() == ['best_lap_ms'] for index in DriverModel.__table__.indexes))
+
+    def test_parse_lap_time(self):
+        self.assertEqual(parse_lap_time("1:12:639"), 72639)
+        self.assertEqual(Driver(driver_id="ABC", name="John Doe", team="TEAM A", best_lap="1:30:123").best_lap_ms,
+                         90123)
+
+    def test_get_report_race_selector(self):
+        with self.app.app_context():
+            self.assertEqual(get_report(race=DEFAULT_RACE), get_report())
+            self.assertEqual(get_report(driver='KRF', race=DEFAULT_RACE), [ONE_DRIVER])
+            self.assertEqual(get_drivers(False, race=DEFAULT_RACE), EXPECTED_LIST)
+            self.assertEqual(get_report(race=DEFAULT_RACE, session='qualifying'), [])
+            self.assertEqual(get_report(race='unknown-2018'), [])
+
     def test_model_creation(self):
         """Testing if the data is saved correctly in the database"""
         with self.app.app_context():
@@ -121,5 +197,206 @@ class TestModels(unittest.TestCase):
             self.assertTrue('UNIQUE constraint failed' in str(context.exception))
 
 
+class TestRaceImport(unittest.TestCase):
+    """Several races and sessions are stored side by side in the normalized models."""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        db.init_app(self.app)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_import_race_keeps_races_apart(self):
+        with self.app.app_context():
+            self.assertEqual(import_race(_BASE_DIR, DEFAULT_RACE, 'Monaco', 2018), 19)
+            self.assertEqual(import_race(_BASE_DIR, 'monaco-2019', 'Monaco', 2019, 'qualifying'), 19)
+            self.assertEqual(import_race(_BASE_DIR, 'monaco-2019', 'Monaco', 2019, 'qualifying'), 19)  # re-import
+            self.assertEqual(LapModel.query.count(), 38)
+            self.assertEqual(RaceModel.query.count(), 2)
+            self.assertEqual(get_report(race='monaco-2019', session='qualifying'), get_report(race=DEFAULT_RACE))
+            self.assertEqual(get_report(driver='KRF', race='monaco-2019', session='qualifying'), [ONE_DRIVER])
+            self.assertEqual(get_report(race='monaco-2019'), [])
+
+    def test_model_creation_is_idempotent(self):
+        with self.app.app_context():
+            model_creation()
+            model_creation()  # the bulk load upserts, a re-import does not duplicate or fail
+            self.assertEqual(get_data_version(), 2)
+            self.assertEqual(DriverModel.query.count(), 19)
+            self.assertEqual(LapModel.query.count(), 19)
+            self.assertEqual(get_report(driver='KRF'), [ONE_DRIVER])
+
+    def test_refresh_race_incremental(self):
+        with tempfile.TemporaryDirectory() as path, self.app.app_context():
+            for file_name in ('abbreviations.txt', 'start.log', 'end.log'):
+                shutil.copy(os.path.join(_BASE_DIR, file_name), path)
+            self.assertEqual(refresh_race(path), 19)  # no checkpoint yet: full import
+            self.assertEqual(refresh_race(path), 0)  # nothing appended
+            self.assertEqual(get_data_version(), 1)  # an empty refresh keeps the cached reports
+            self.assertEqual(ImportCheckpoint.query.count(), 3)
+            with open(os.path.join(path, 'start.log'), 'a', encoding='utf-8') as file:
+                file.write("\nKRF2018-05-24_13:00:00.000\nSVF2018-05-24_13:00:00.0")  # SVF line is incomplete
+            with open(os.path.join(path, 'end.log'), 'a', encoding='utf-8') as file:
+                file.write("\nKRF2018-05-24_13:01:00.000\n")
+            self.assertEqual(refresh_race(path), 1)
+            self.assertEqual(get_data_version(), 2)
+            self.assertEqual(get_report(driver='KRF'), [[1, 'KRF', 'Kimi Räikkönen', 'FERRARI', '1:00:0']])
+            self.assertEqual(get_report(race=DEFAULT_RACE), get_report())
+            self.assertEqual(refresh_race(path), 0)
+
+    def test_refresh_race_rewritten_file(self):
+        with tempfile.TemporaryDirectory() as path, self.app.app_context():
+            for file_name in ('abbreviations.txt', 'start.log', 'end.log'):
+                shutil.copy(os.path.join(_BASE_DIR, file_name), path)
+            self.assertEqual(refresh_race(path), 19)
+            with open(os.path.join(path, 'end.log'), 'r+', encoding='utf-8') as file:
+                content = file.read()
+                file.seek(0)
+                file.write(content.replace('MES2018-05-24_12:05:58.778', 'MES2018-05-24_12:05:59.778'))
+            self.assertEqual(refresh_race(path), 19)  # same size, different content: full rebuild
+            self.assertEqual(get_report(driver='MES', race=DEFAULT_RACE)[0][4], '1:14:265')
+            with open(os.path.join(path, 'end.log'), 'w', encoding='utf-8') as file:
+                file.write(''.join(content.splitlines(keepends=True)[:3]))
+            self.assertEqual(refresh_race(path), 3)  # truncated: full rebuild with the remaining laps
+            self.assertEqual(LapModel.query.count(), 3)
+
+    def test_refresh_race_keeps_the_last_line_without_break(self):
+        with tempfile.TemporaryDirectory() as path, self.app.app_context():
+            for file_name in ('abbreviations.txt', 'start.log', 'end.log'):
+                shutil.copy(os.path.join(_BASE_DIR, file_name), path)
+            end_log = os.path.join(path, 'end.log')
+            with open(end_log, 'rb') as file:
+                last_line = file.read().rsplit(b'\n', 1)[1]  # the shipped end.log ends without a line break
+            self.assertEqual(refresh_race(path), 19)
+            checkpoint = ImportCheckpoint.query.filter(ImportCheckpoint.source.endswith('end.log')).one()
+            self.assertEqual(checkpoint.offset, os.path.getsize(end_log) - len(last_line))
+            with open(end_log, 'a', encoding='utf-8') as file:
+                file.write("\n")
+            self.assertEqual(refresh_race(path), 0)  # the line read again changes no lap
+            self.assertEqual(get_data_version(), 1)
+
+    def test_file_digest_covers_the_whole_prefix(self):
+        with tempfile.TemporaryDirectory() as path:
+            file_path = os.path.join(path, 'end.log')
+            lines = [f"D{i:02d}2018-05-24_12:00:00.000\n" for i in range(100)] * 20  # larger than any window
+            with open(file_path, 'w', encoding='utf-8') as file:
+                file.write(''.join(lines))
+            size = os.path.getsize(file_path)
+            digest = file_digest(file_path, size)
+            with open(file_path, 'r+b') as file:
+                file.seek(size // 2)
+                file.write(b'X')
+            self.assertNotEqual(file_digest(file_path, size), digest)
+            self.assertEqual(complete_offset(file_path, size - 5), size - len(lines[-1]))
+
+    def test_batched(self):
+        self.assertEqual(list(batched(list(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+
+class TestMigration(unittest.TestCase):
+    """A database created before the best_lap_ms column is migrated in place."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        database_file = os.path.join(self.tmp_dir.name, 'old.db')
+        with sqlite3.connect(database_file) as connection:
+            connection.execute("CREATE TABLE driver_model (id INTEGER NOT NULL, driver_id VARCHAR(3) NOT NULL, "
+                               "name VARCHAR(100) NOT NULL, team VARCHAR(100) NOT NULL, "
+                               "best_lap VARCHAR(50) NOT NULL, PRIMARY KEY (id))")
+            connection.executemany("INSERT INTO driver_model VALUES (?, ?, ?, ?, ?)",
+                                   [(1, 'SVF', 'Sebastian Vettel', 'FERRARI', '1:04:415'),
+                                    (2, 'BHS', 'Brendon Hartley', 'SCUDERIA TORO ROSSO HONDA', '1:13:179'),
+                                    (3, 'NHR', 'Nico Hulkenberg', 'RENAULT', '1:13:650')])
+        connection.close()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database_file
+        db.init_app(self.app)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_migrate_best_lap_ms(self):
+        with self.app.app_context():
+            migrate_best_lap_ms()
+            migrate_best_lap_ms()  # a second run does nothing
+            self.assertEqual([dr.best_lap_ms for dr in DriverModel.query.order_by(DriverModel.id)],
+                             [64415, 73179, 73065])
+            self.assertEqual([dr[:2] for dr in get_report()], [[1, 'SVF'], [2, 'NHR'], [3, 'BHS']])
+
+    def test_data_imported_without_version_is_seeded(self):
+        database_file = self.app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+        with sqlite3.connect(database_file) as connection:
+            connection.execute("ALTER TABLE driver_model ADD COLUMN best_lap_ms INTEGER NOT NULL DEFAULT 0")
+        connection.close()
+        os.utime(database_file, (1_527_163_200, 1_527_163_200))  # 2018-05-24 12:00:00 UTC
+        with self.app.app_context():
+            migrate_best_lap_ms()
+            self.assertEqual(get_data_version_info(), (1, datetime(2018, 5, 24, 12)))
+            migrate_best_lap_ms()  # a seeded version is kept
+            self.assertEqual(get_data_version(), 1)
+
+
+class TestReadPath(unittest.TestCase):
+    """The report is read through a pool of tuned read-only connections of an SQLite file in WAL mode."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        database_uri = 'sqlite:///' + os.path.join(self.tmp_dir.name, 'monaco.db')
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+        db.init_app(self.app)
+        with self.app.app_context():
+            db.create_all()
+            model_creation()
+            enable_wal()
+            self.expected = get_report(), get_drivers(False), get_data_version()  # read through the session
+        init_read_path(self.app, database_uri)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.app.extensions[READER_ENGINE].dispose()
+        self.tmp_dir.cleanup()
+
+    def test_reader_connections_are_tuned(self):
+        with self.app.app_context(), read_connection() as connection:
+            self.assertEqual(connection.exec_driver_sql("PRAGMA query_only").scalar(), 1)
+            self.assertEqual(connection.exec_driver_sql("PRAGMA journal_mode").scalar(), 'wal')
+            self.assertEqual(connection.exec_driver_sql("PRAGMA cache_size").scalar(), -16384)
+            with self.assertRaises(Exception):
+                connection.exec_driver_sql("DELETE FROM driver_model")
+
+    def test_read_path_has_the_results_of_the_session(self):
+        with self.app.app_context():
+            self.assertEqual((get_report(), get_drivers(False), get_data_version()), self.expected)
+
+    def test_import_does_not_block_readers(self):
+        with self.app.app_context(), read_connection() as reader:
+            self.assertEqual(len(reader.execute(*report_statement()).all()), 19)  # a read transaction is open
+            model_creation()  # the writer commits while the reader holds its snapshot
+            self.assertEqual(get_data_version(), self.expected[2] + 1)
+
+    def test_statements_are_reused(self):
+        statement, params = report_statement(False, 'SVF', race='monaco-2018')
+        self.assertIs(report_statement(False, 'SVF', race='other-race')[0], statement)
+        self.assertEqual(params, {'driver': 'SVF', 'race': 'monaco-2018', 'session': 'race'})
+        first, cursor = report_statement(limit=5, max_lap=70_000), (65_000, 3, 3)
+        self.assertIs(report_statement(limit=10, max_lap=80_000, after=cursor)[0],
+                      report_statement(limit=20, max_lap=90_000, after=(70_000, 8, 8))[0])
+        self.assertIsNot(report_statement(limit=10, max_lap=80_000, after=cursor)[0], first[0])
+        with self.app.app_context(), read_connection() as reader:
+            self.assertEqual([row[1] for row in reader.execute(*report_statement(limit=2, max_lap=80_000,
+                                                                                 after=(72_434, 2, 2))).all()],
+                             [dr[1] for dr in get_report(max_lap=80_000)[2:4]])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""--Pytest for the live ingest mode of Monaco 2018 Racing--"""
+import json
+import os
+import shutil
+
+import fakeredis
+import pytest
+
+from packaging_tutorial.report_FEDONYUK import report_web
+from packaging_tutorial.report_FEDONYUK.report import build_report
+from packaging_tutorial.report_FEDONYUK.report_live import LIVE_CHANNEL, LiveStandings, load_standings, \
+    poll_logs, publish
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+ABBREVIATIONS = [{'driver_id': 'AAA', 'name': 'Driver A', 'team': 'TEAM A'},
+                 {'driver_id': 'BBB', 'name': 'Driver B', 'team': 'TEAM B'},
+                 {'driver_id': 'CCC', 'name': 'Driver C', 'team': 'TEAM C'}]
+
+
+@pytest.fixture
+def race_dir(tmp_path):
+    for file_name in ('abbreviations.txt', 'start.log', 'end.log'):
+        shutil.copy(os.path.join(DATA_DIR, file_name), tmp_path)
+    return str(tmp_path)
+
+
+def test_standings_match_the_report():
+    standings, _ = load_standings(DATA_DIR)
+    report = build_report(True, None, DATA_DIR)
+    assert [row[1:] for row in standings.rows()] == [row[1:] for row in report]
+
+
+def test_update_returns_only_changed_rows():
+    standings = LiveStandings(ABBREVIATIONS)
+    standings.apply({'AAA': '2018-05-24_12:00:00.000', 'BBB': '2018-05-24_12:00:00.000',
+                     'CCC': '2018-05-24_12:00:00.000'},
+                    {'AAA': '2018-05-24_12:01:10.000', 'BBB': '2018-05-24_12:01:20.000',
+                     'CCC': '2018-05-24_12:01:30.000'})
+    assert [row[1] for row in standings.rows()] == ['AAA', 'BBB', 'CCC']
+
+    changed = standings.apply({}, {'CCC': '2018-05-24_12:01:15.000'})  # CCC overtakes BBB
+    assert [row[:2] for row in changed] == [[2, 'CCC'], [3, 'BBB']]
+    assert standings.apply({}, {'CCC': '2018-05-24_12:01:15.000'}) == []  # the same lap changes nothing
+    assert standings.apply({}, {'XXX': '2018-05-24_12:01:15.000'}) == []  # unknown driver is ignored
+
+
+def test_poll_logs_reads_appended_lines(race_dir):
+    standings, offsets = load_standings(race_dir)
+    assert poll_logs(race_dir, standings, offsets) == []
+
+    with open(os.path.join(race_dir, 'end.log'), 'a') as file:
+        file.write('\nSVF2018-05-24_12:03:00.000\n')  # the last line of end.log had no line break yet
+    changed = poll_logs(race_dir, standings, offsets)
+    assert changed[0][:2] == [1, 'SVF']
+    assert offsets['end.log'] == os.path.getsize(os.path.join(race_dir, 'end.log'))
+
+
+def test_line_being_written_is_read_once_complete(race_dir):
+    end_log = os.path.join(race_dir, 'end.log')
+    with open(end_log, 'a') as file:
+        file.write('\nSVF2018-05-24_12:0')  # a writer is in the middle of the line
+    standings, offsets = load_standings(race_dir)
+    assert offsets['end.log'] == os.path.getsize(end_log) - len('SVF2018-05-24_12:0')
+    with open(end_log, 'a') as file:
+        file.write('3:00.000\n')
+    assert poll_logs(race_dir, standings, offsets)[0][:2] == [1, 'SVF']
+    assert offsets['end.log'] == os.path.getsize(end_log)
+
+
+def test_truncated_log_is_read_from_its_start(race_dir):
+    standings, offsets = load_standings(race_dir)
+    end_log = os.path.join(race_dir, 'end.log')
+    with open(end_log, 'w') as file:
+        file.write('SVF2018-05-24_12:03:00.000\n')  # rotated: a new log shorter than the offset
+    assert poll_logs(race_dir, standings, offsets)[0][:2] == [1, 'SVF']
+    assert offsets['end.log'] == os.path.getsize(end_log)
+
+
+def test_publish_survives_redis_errors():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    assert not publish(fakeredis.FakeStrictRedis(server=server), [[1, 'SVF']])
+    assert publish(fakeredis.FakeStrictRedis(), [[1, 'SVF']])
+
+
+def test_live_stream_without_redis_sends_snapshot_and_retry(monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(report_web, 'redis_client', fakeredis.FakeStrictRedis(server=server))
+    report_web.app.config['TESTING'] = True
+    with report_web.app.test_client() as client:
+        events = client.get('/report/live/').get_data(as_text=True).split('\n\n')
+    assert events[0].startswith('event: snapshot')
+    assert events[1:] == [f'retry: {report_web.LIVE_RETRY}', '']
+
+
+def test_live_stream_ends_with_retry_when_redis_fails(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(report_web, 'redis_client', fakeredis.FakeStrictRedis(server=server))
+    report_web.app.config['TESTING'] = True
+    with report_web.app.test_client() as client:
+        events = client.get('/report/live/').response
+        assert next(events).decode().startswith('event: snapshot')
+        server.connected = False
+        assert [event.decode() for event in events][-1] == f'retry: {report_web.LIVE_RETRY}\n\n'  # then the end
+
+
+def test_live_stream_sends_snapshot_and_updates(monkeypatch):
+    redis_client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(report_web, 'redis_client', redis_client)
+    report_web.app.config['TESTING'] = True
+    with report_web.app.test_client() as client:
+        response = client.get('/report/live/')
+        assert response.mimetype == 'text/event-stream'
+        events = response.response
+        snapshot = next(events).decode()
+        assert snapshot.startswith('event: snapshot')
+        assert len(json.loads(snapshot.split('data: ', 1)[1])) == 19
+
+        publish(redis_client, [[1, 'SVF', 'Sebastian Vettel', 'FERRARI', '1:02:000']], LIVE_CHANNEL)
+        update = next(event for event in map(bytes.decode, events) if not event.startswith(':'))  # skip keep-alive
+        assert update.startswith('event: update')
+        assert json.loads(update.split('data: ', 1)[1])[0][1] == 'SVF'
+        response.close()
@@ -0,0 +1,122 @@
+"""--Pytest for the logging pipeline of Monaco 2018 Racing--"""
+import json
+import os
+
+import pytest
+from loguru import logger
+
+from packaging_tutorial.report_FEDONYUK import log_config
+from packaging_tutorial.report_FEDONYUK.log_config import BatchingSink, InfoSampler, json_format, LOG_FORMAT
+
+
+@pytest.fixture
+def sink_to(tmp_path):
+    """Adds a BatchingSink on a file of tmp_path, the sink is removed by the test or at the end of it"""
+    handlers = []
+
+    def add(log_format=LOG_FORMAT, log_filter=None, **options):
+        sink = BatchingSink(str(tmp_path / 'test.log'), **options)
+        handlers.append(logger.add(sink, format=log_format, level='DEBUG', filter=log_filter))
+        return sink, handlers[-1]
+    yield add
+    for handler in handlers:
+        try:
+            logger.remove(handler)
+        except ValueError:
+            pass
+
+
+def test_lines_are_written_in_batches(sink_to, tmp_path):
+    sink, handler = sink_to(flush_interval=0.05)
+    for i in range(1000):
+        logger.info(f"[INFO] line {i}")
+    logger.remove(handler)  # the queued lines are written before remove returns
+    lines = (tmp_path / 'test.log').read_text(encoding='utf-8').splitlines()
+    assert [line.split()[-1] for line in lines] == [str(i) for i in range(1000)]
+    assert sink.batches < 100
+
+
+def test_full_queue_drops_and_counts_lines(sink_to, tmp_path, monkeypatch):
+    sink, handler = sink_to(queue_size=1)
+    monkeypatch.setattr(sink, 'run', lambda: None)  # no writer: the queue stays full
+    logger.info("[INFO] kept")
+    logger.info("[INFO] dropped")
+    assert sink.dropped == 1
+    sink.write_batch([sink.queue.get()])
+    assert sink.dropped == 0
+    assert 'WARNING [LOG] 1 lines dropped' in (tmp_path / 'test.log').read_text(encoding='utf-8')
+
+
+def test_rotation_by_size_keeps_the_retention(sink_to, tmp_path):
+    sink, handler = sink_to(batch_size=1, rotation_size=200, retention=2)
+    for i in range(40):
+        logger.info(f"[INFO] line {i}")
+    logger.remove(handler)
+    rotated = sorted(tmp_path.glob('test.*.log'))
+    assert len(rotated) == 2
+    assert os.path.getsize(rotated[0]) >= 200
+    last = (tmp_path / 'test.log').read_text(encoding='utf-8') or rotated[-1].read_text(encoding='utf-8')
+    assert last.splitlines()[-1].endswith('line 39')
+
+
+def test_rotation_by_age(tmp_path, monkeypatch):
+    sink = BatchingSink(str(tmp_path / 'test.log'), rotation_interval=60)
+    sink.write_batch(["first file\n"])
+    now = log_config.time.time()
+    monkeypatch.setattr(log_config.time, 'time', lambda: now + 61)
+    sink.write_batch(["last line of the first file\n"])
+    sink.write_batch(["second file\n"])
+    sink.stop()
+    rotated = list(tmp_path.glob('test.*.log'))
+    assert len(rotated) == 1
+    assert rotated[0].read_text(encoding='utf-8') == "first file\nlast line of the first file\n"
+    assert (tmp_path / 'test.log').read_text(encoding='utf-8') == "second file\n"
+
+
+def test_info_lines_are_sampled_by_call_site(sink_to, tmp_path):
+    sink, handler = sink_to(log_filter=InfoSampler(10))
+    for i in range(25):
+        logger.info(f"[INFO] request {i}")
+        logger.error(f"[ERROR] request {i}")
+    logger.remove(handler)
+    lines = (tmp_path / 'test.log').read_text(encoding='utf-8').splitlines()
+    assert [line.split()[-1] for line in lines if 'INFO' in line] == ['0', '10', '20']  # the first, then 1 of 10
+    assert len([line for line in lines if 'ERROR' in line]) == 25
+
+
+def test_json_lines(sink_to, tmp_path):
+    sink, handler = sink_to(log_format=json_format)
+    logger.bind(route='/report/').info("[INFO] Report data retrieved successfully.")
+    try:
+        raise ValueError('bad limit')
+    except ValueError:
+        logger.exception("[ERROR] Invalid query")
+    logger.remove(handler)
+    info, error = [json.loads(line) for line in (tmp_path / 'test.log').read_text(encoding='utf-8').splitlines()]
+    assert info['level'] == 'INFO'
+    assert info['message'] == "[INFO] Report data retrieved successfully."
+    assert info['route'] == '/report/'
+    assert info['function'] == 'test_json_lines'
+    assert error['exception'] == "ValueError('bad limit')"
+
+
+def test_workers_rotate_the_shared_file_once(tmp_path):
+    first, second = (BatchingSink(str(tmp_path / 'test.log'), rotation_size=100) for _ in range(2))
+    first.write_batch(["first 1\n"])
+    second.write_batch(["second 1\n"])
+    first.write_batch(["x" * 100 + "\n"])  # rotates the file the second worker has open
+    second.write_batch(["second 2\n"])  # goes to the new file
+    first.write_batch(["first 2\n"])
+    first.stop()
+    second.stop()
+    rotated = list(tmp_path.glob('test.*.log'))
+    assert len(rotated) == 1
+    assert rotated[0].read_text(encoding='utf-8') == "first 1\nsecond 1\n" + "x" * 100 + "\n"
+    assert (tmp_path / 'test.log').read_text(encoding='utf-8') == "second 2\nfirst 2\n"
+
+
+def test_write_error_is_reported_to_stderr(tmp_path, capsys):
+    sink = BatchingSink(str(tmp_path / 'missing' / 'test.log'), flush_interval=0)
+    sink.write("lost line\n")
+    sink.stop()
+    assert 'ERROR [LOG] 1 lines not written' in capsys.readouterr().err
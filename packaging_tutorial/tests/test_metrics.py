@@ -0,0 +1,86 @@
+"""--Pytest for the metrics and the request profiler of Monaco 2018 Racing--"""
+import pytest
+
+from packaging_tutorial.report_FEDONYUK import metrics, models, report
+from packaging_tutorial.report_FEDONYUK.metrics import CallbackMetric, Histogram, Registry, DB_QUERY_SECONDS, \
+    IMPORT_STAGE_SECONDS, REQUEST_SECONDS, SERIALIZATION_SECONDS
+from packaging_tutorial.report_FEDONYUK.report_web import app
+
+pytestmark = pytest.mark.usefixtures('no_snapshots')
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Empty registry in place of the one of the app"""
+    registry = Registry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    return registry
+
+
+def count(histogram: Histogram, *labels) -> int:
+    """Function returns the observations of a series"""
+    series = histogram.series.get(labels)
+    return sum(series[0]) if series else 0
+
+
+def test_histogram_renders_cumulative_buckets(registry):
+    histogram = Histogram('test_seconds', 'Test durations.', ('route',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, '/report/')
+    histogram.observe(0.01, 'a "quoted" \\ route')
+    lines = registry.render().splitlines()
+    assert lines[:2] == ['# HELP test_seconds Test durations.', '# TYPE test_seconds histogram']
+    assert 'test_seconds_bucket{route="/report/",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{route="/report/",le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{route="/report/",le="+Inf"} 4' in lines
+    assert 'test_seconds_sum{route="/report/"} 3.65' in lines
+    assert 'test_seconds_count{route="/report/"} 4' in lines
+    assert 'test_seconds_count{route="a \\"quoted\\" \\\\ route"} 1' in lines
+
+
+def test_callback_metric_is_read_at_scrape(registry):
+    hits = {('local_hit',): 1}
+    CallbackMetric('test_lookups_total', 'Test lookups.', 'counter', lambda: hits, ('result',))
+    hits[('local_hit',)] = 5
+    assert registry.render().splitlines()[2] == 'test_lookups_total{result="local_hit"} 5.0'
+
+
+def test_disabled_metrics_observe_nothing(registry):
+    histogram = Histogram('test_seconds', 'Test durations.')
+    registry.enabled = False
+    with metrics.timer(histogram):
+        pass
+    metrics.timed(histogram)(lambda: None)()
+    histogram.observe(1.0)
+    assert histogram.series == {}
+
+
+def test_metrics_endpoint(client):
+    requests, queries = count(REQUEST_SECONDS, '/api/v1/report/', 'GET', '200'), count(DB_QUERY_SECONDS, 'report')
+    client.get('/api/v1/report/', query_string={'limit': 3})
+    client.get('/api/v1/report/', query_string={'limit': 3, 'format': 'xml'})
+    assert count(REQUEST_SECONDS, '/api/v1/report/', 'GET', '200') == requests + 2
+    assert count(DB_QUERY_SECONDS, 'report') == queries + 2
+    assert count(SERIALIZATION_SECONDS, 'json') and count(SERIALIZATION_SECONDS, 'xml')
+    response = client.get('/metrics')
+    assert response.content_type == metrics.CONTENT_TYPE
+    body = response.get_data(as_text=True)
+    assert 'report_request_seconds_count{route="/api/v1/report/",method="GET",status="200"}' in body
+    assert '# TYPE report_cache_hit_ratio gauge' in body
+
+
+def test_import_stages_are_timed():
+    stages = {stage: count(IMPORT_STAGE_SECONDS, stage) for stage in ('parse', 'join', 'validate')}
+    models.get_drivers_all()
+    report.get_drivers(models._BASE_DIR)
+    assert all(count(IMPORT_STAGE_SECONDS, stage) == seen for stage, seen in stages.items())
+    models.get_drivers_all(stage=models.import_stage)
+    assert all(count(IMPORT_STAGE_SECONDS, stage) == seen + 1 for stage, seen in stages.items())
+
+
+def test_profile_needs_debug_or_config(client, monkeypatch):
+    assert client.get('/api/v1/report/', query_string={'profile': 1}).is_json
+    monkeypatch.setitem(app.config, metrics.PROFILE_CONFIG, True)
+    response = client.get('/api/v1/report/', query_string={'profile': 1})
+    assert response.mimetype == 'text/plain'
+    assert 'Ordered by: cumulative time' in response.get_data(as_text=True)
@@ -0,0 +1,150 @@
+"""--Pytest for the binary race snapshot of Monaco 2018 Racing--"""
+import os
+import shutil
+
+import pytest
+from click.testing import CliRunner
+
+from packaging_tutorial.report_FEDONYUK import race_snapshot, report
+from packaging_tutorial.report_FEDONYUK.db_util import get_report, get_report_page, get_drivers, SNAPSHOT_DIR
+from packaging_tutorial.report_FEDONYUK.race_snapshot import RaceSnapshot, encode_snapshot, read_snapshot, \
+    write_snapshot, SNAPSHOT_FILE
+from packaging_tutorial.report_FEDONYUK.report import build_report, get_list_drivers, load_snapshot, _BASE_DIR
+from packaging_tutorial.report_FEDONYUK.report_cli import main_cli
+from packaging_tutorial.report_FEDONYUK.report_web import app
+
+
+@pytest.fixture
+def race(tmp_path):
+    """A copy of the 3 files of the Monaco 2018 race, without snapshot"""
+    for file_name in race_snapshot.SOURCE_FILES:
+        shutil.copy(os.path.join(_BASE_DIR, file_name), tmp_path)
+    return str(tmp_path)
+
+
+def test_encode_and_query():
+    rows = [('BBB', 'Bob Bar', 'TEAM A', 70_000), ('AAA', 'Ann Ash', 'TEAM A', 65_000),
+            ('CCC', 'Cid Cole', 'TEAM B', 70_000)]
+    snapshot = RaceSnapshot(encode_snapshot(rows))
+    assert len(snapshot) == 3
+    assert snapshot.report() == [[1, 'AAA', 'Ann Ash', 'TEAM A', 65_000], [2, 'BBB', 'Bob Bar', 'TEAM A', 70_000],
+                                 [3, 'CCC', 'Cid Cole', 'TEAM B', 70_000]]  # ties keep the given order
+    assert snapshot.report(False)[0][1] == 'CCC'
+    assert snapshot.report(driver='BBB') == [[2, 'BBB', 'Bob Bar', 'TEAM A', 70_000]]
+    assert snapshot.report(driver='ZZZ') == []
+    assert snapshot.drivers(False) == [['Cid Cole', 'CCC'], ['Bob Bar', 'BBB'], ['Ann Ash', 'AAA']]
+    assert encode_snapshot(rows).count(b'TEAM A') == 1  # the string table stores a team once
+
+
+def test_report_matches_the_text_files(race):
+    assert build_report(path=race, use_snapshot=True) == build_report(path=race)
+    assert os.path.isfile(os.path.join(race, SNAPSHOT_FILE))  # written by the first run
+    assert build_report(False, path=race, use_snapshot=True) == build_report(False, path=race)
+    assert build_report(driver='SVF', path=race, use_snapshot=True) == build_report(driver='SVF', path=race)
+    assert get_list_drivers(False, race, use_snapshot=True) == get_list_drivers(False, race)
+
+
+def test_stale_or_invalid_snapshot_is_rebuilt(race):
+    load_snapshot(race)
+    assert read_snapshot(race) is not None
+    with open(os.path.join(race, 'end.log'), 'a', encoding='utf-8') as log:
+        log.write("\nSVF2018-05-24_12:03:15.000\n")  # the last lap of Sebastian Vettel is now longer
+    assert read_snapshot(race) is None
+    assert read_snapshot(race, check=False) is not None
+    assert build_report(driver='SVF', path=race, use_snapshot=True) == build_report(driver='SVF', path=race)
+
+    with open(os.path.join(race, SNAPSHOT_FILE), 'wb') as file:
+        file.write(b'F1RS')  # truncated
+    assert read_snapshot(race) is None
+    assert build_report(path=race, use_snapshot=True) == build_report(path=race)
+
+
+def test_same_size_rewrite_makes_the_snapshot_stale(race):
+    file_path = os.path.join(race, 'end.log')
+    with open(file_path, 'rb') as log:
+        padding = b'\n' * 10_000  # blank lines around the laps, which stay far from the head and the tail
+        content = padding + log.read() + b'\n' + padding
+    with open(file_path, 'wb') as log:
+        log.write(content)
+    assert load_snapshot(race).report(driver='SVF')[0][0] == 1
+    with open(file_path, 'r+b') as log:
+        log.seek(content.index(b'SVF'))
+        log.write(b'SVF2018-05-24_12:08:13.234')  # same size, only the middle of the file changes
+    assert read_snapshot(race) is None
+    assert build_report(driver='SVF', path=race, use_snapshot=True) == build_report(driver='SVF', path=race)
+    assert load_snapshot(race).report(driver='SVF')[0][0] != 1
+
+
+def test_read_only_directory_gets_a_snapshot_in_memory(race, monkeypatch):
+    def read_only(*args):
+        raise PermissionError('read-only file system')
+    monkeypatch.setattr(race_snapshot, 'write_snapshot', read_only)
+    assert build_report(path=race, use_snapshot=True) == build_report(path=race)
+    assert not os.path.exists(os.path.join(race, SNAPSHOT_FILE))
+
+
+def test_cli_snapshot(race):
+    runner = CliRunner()
+    expected = runner.invoke(main_cli, ['--file', race, '--driver', 'Sebastian Vettel']).output
+    result = runner.invoke(main_cli, ['--file', race, '--driver', 'Sebastian Vettel', '--snapshot'])
+    assert result.exit_code == 0
+    assert result.output == expected
+    assert runner.invoke(main_cli, ['--file', race, '--desc', '--snapshot']).output == \
+        runner.invoke(main_cli, ['--file', race, '--desc']).output
+
+
+def test_db_util_reads_the_snapshot(race, monkeypatch):
+    write_snapshot(race, [(dr[1], dr[2], dr[3], 0) for dr in build_report(path=race)])  # every lap 0:00:0
+    with app.app_context():
+        report, drivers = get_report(), get_drivers(False)
+        monkeypatch.setitem(app.config, SNAPSHOT_DIR, race)
+        assert [row[:4] for row in get_report()] == [row[:4] for row in report]
+        assert get_report()[0][4] == '0:00:0'  # read from the snapshot, not from monaco.db
+        assert get_drivers(False) == drivers
+        page, cursor = get_report_page(limit=5, fields=('driver_id',))
+        assert page == [[row[1]] for row in report[:5]]
+        assert get_report_page(limit=5, cursor=cursor, fields=('driver_id',))[0] == [[row[1]] for row in report[5:10]]
+        assert get_report(driver='SVF', team='FERRARI') == [[1, 'SVF', 'Sebastian Vettel', 'FERRARI', '0:00:0']]
+        assert get_report(max_lap=-1) == get_report(slower_than=0) == []
+
+
+def test_every_read_path_uses_the_snapshot(race, client, monkeypatch):
+    write_snapshot(race, [(dr[1], dr[2], dr[3], 0) for dr in build_report(path=race)])  # every lap 0:00:0
+    monkeypatch.setitem(app.config, SNAPSHOT_DIR, race)
+    served = client.get('/api/v1/report/')
+    assert served.json[0][4] == '0:00:0'
+    assert client.get('/api/v1/report/?limit=3').json[0][4] == '0:00:0'
+    assert client.get('/api/v1/report/?stream=1').json[0][4] == '0:00:0'
+    assert client.get('/api/v1/report/?format=ndjson&fields=best_lap').data.split(b'\n')[0] == b'["0:00:0"]'
+
+    with open(os.path.join(race, 'end.log'), 'a', encoding='utf-8') as log:
+        log.write("\n")  # the snapshot is rebuilt from the files: the snapshots, the cache and the ETags follow
+    renewed = client.get('/api/v1/report/', headers={'If-None-Match': served.headers['ETag']})
+    assert renewed.status_code == 200 and renewed.headers['ETag'] != served.headers['ETag']
+    assert renewed.json == client.get('/api/v1/report/?race=monaco-2018').json
+    assert client.get('/api/v1/report/?limit=3').json == renewed.json[:3]
+
+
+def test_snapshot_is_opened_once_per_change(race, monkeypatch):
+    snapshot = load_snapshot(race)
+    signatures = []
+    monkeypatch.setattr(race_snapshot, 'source_signature', lambda path: signatures.append(path) or bytes(32))
+    assert load_snapshot(race) is snapshot  # the files did not change: neither mapped nor hashed again
+    assert not signatures
+    monkeypatch.undo()
+
+    with open(os.path.join(race, 'end.log'), 'a', encoding='utf-8') as log:
+        log.write("\nSVF2018-05-24_12:03:15.000\n")
+    changed = load_snapshot(race)
+    assert changed is not snapshot
+    assert build_report(driver='SVF', path=race, use_snapshot=True) == build_report(driver='SVF', path=race)
+    assert snapshot.report(driver='SVF') != changed.report(driver='SVF')  # the replaced snapshot is still readable
+    os.utime(os.path.join(race, 'end.log'), ns=(0, 0))
+    assert load_snapshot(race) is not changed
+    assert snapshot.buffer.closed  # closed by the next replacement
+
+
+def test_package_data_is_never_written(monkeypatch):
+    monkeypatch.setattr(report, '_snapshots', {})
+    assert len(load_snapshot(_BASE_DIR)) == 19
+    assert not os.path.exists(os.path.join(_BASE_DIR, SNAPSHOT_FILE))
@@ -5,8 +5,9 @@ import io
 from datetime import datetime, timedelta
 
 import pytest
+from pydantic import ValidationError
 
-from packaging_tutorial.report_FEDONYUK import report
+from packaging_tutorial.report_FEDONYUK import report, log_mmap
 
 MOCK_START_LAP = datetime(2018, 1, 1, 12, 0, 0)
 MOCK_END_LAP = datetime(2018, 1, 1, 12, 1, 30)
@@ -82,6 +83,98 @@ def test_print_report_one_driver():
     assert actual_output == expected_output
 
 
+def test_get_drivers_reads_each_log_once(mocker):
+    spy = mocker.spy(report, 'read_log_file')
+    drivers = report.get_drivers(report._BASE_DIR)
+    assert len(drivers) == 19
+    assert sorted(call.args[0] for call in spy.call_args_list) == [report.END_LOG, report.START_LOG]
+
+
+def test_get_drivers_join_by_driver_id(tmp_path):
+    (tmp_path / report.ABBREVIATION_TXT).write_text("AAA_Abc Def_TEAM A\nBBB_Ghi Jkl_TEAM B\nCCC_Mno Pqr_TEAM C\n",
+                                                    encoding='utf-8')
+    (tmp_path / report.START_LOG).write_text("BBB2018-05-24_12:00:00.000\nAAA2018-05-24_12:00:00.000\n",
+                                             encoding='utf-8')
+    (tmp_path / report.END_LOG).write_text("AAA2018-05-24_12:01:05.250\nBBB2018-05-24_12:01:10.100\n",
+                                           encoding='utf-8')
+    drivers = report.get_drivers(str(tmp_path))
+    assert [dr.driver_id for dr in drivers] == ['AAA', 'BBB']
+    assert [dr.best_lap for dr in drivers] == [timedelta(minutes=1, seconds=5, milliseconds=250),
+                                               timedelta(minutes=1, seconds=10, milliseconds=100)]
+
+
+def test_iter_log_batches_bounded_size():
+    batches = list(report.iter_log_batches(report.START_LOG, report._BASE_DIR, batch_size=4))
+    assert all(len(batch) <= 4 for batch in batches)
+    assert dict(record for batch in batches for record in batch) == report.read_log_file(report.START_LOG,
+                                                                                        report._BASE_DIR)
+
+
+def test_build_report_stream_matches_default():
+    assert report.build_report(stream=True) == report.build_report()
+    assert report.build_report(False, 'KRF', stream=True) == report.build_report(False, 'KRF')
+
+
+def test_mmap_read_log_file_matches_text_parser():
+    for file_name in (report.START_LOG, report.END_LOG):
+        assert log_mmap.read_log_file(file_name, report._BASE_DIR) == report.read_log_file(file_name,
+                                                                                           report._BASE_DIR)
+    assert log_mmap.merged_laps(report._BASE_DIR) == report.merged_laps(report._BASE_DIR)
+
+
+def test_mmap_read_log_file_empty_and_blank_lines(tmp_path):
+    (tmp_path / report.START_LOG).write_bytes(b"")
+    (tmp_path / report.END_LOG).write_bytes(b"AAA2018-05-24_12:01:05.250\r\n\nAAA2018-05-24_12:01:06.250 \n")
+    assert log_mmap.read_log_file(report.START_LOG, str(tmp_path)) == {}
+    assert log_mmap.read_log_file(report.END_LOG, str(tmp_path)) == {'AAA': '2018-05-24_12:01:06.250'}
+
+
+def test_build_report_mmap_matches_default():
+    assert report.build_report(use_mmap=True) == report.build_report()
+
+
+@pytest.mark.parametrize('asc, driver', [(True, None), (False, None), (True, 'FAM'), (False, 'KRF'), (True, 'XXX')])
+def test_build_report_columnar_matches_default(asc, driver):
+    assert report.build_report_columnar(asc, driver) == report.build_report(asc, driver)
+
+
+def test_build_report_columnar_without_numpy(monkeypatch):
+    monkeypatch.setattr(report, 'np', None)
+    assert report.build_report_columnar(driver='KRF') == report.build_report(driver='KRF')
+
+
+def test_sample_indexes():
+    assert report.sample_indexes(5, 8) == {0, 1, 2, 3, 4}
+    indexes = report.sample_indexes(1000, 8)
+    assert len(indexes) == 8 and {0, 999} <= indexes
+
+
+def test_build_report_trusted_matches_default():
+    assert report.build_report(trusted=True) == report.build_report()
+    assert all(isinstance(dr, report.DriverRecord) for dr in report.get_drivers(report._BASE_DIR, trusted=True))
+
+
+def test_build_drivers_trusted_rejects_invalid_sample():
+    rows = [{"driver_id": "svf", "name": "Sebastian Vettel", "team": "FERRARI",
+             "start_lap": MOCK_START_LAP, "end_lap": MOCK_END_LAP}]
+    with pytest.raises(ValidationError):
+        report.build_drivers(rows, trusted=True)
+
+
+def test_check_source_files(tmp_path):
+    checks = report.check_source_files(report._BASE_DIR)
+    assert {file_name: lines for file_name, (lines, _) in checks.items()} == \
+           {report.ABBREVIATION_TXT: 19, report.START_LOG: 19, report.END_LOG: 19}
+    for file_name in (report.ABBREVIATION_TXT, report.START_LOG, report.END_LOG):
+        (tmp_path / file_name).write_bytes(open(os.path.join(report._BASE_DIR, file_name), 'rb').read())
+    (tmp_path / report.END_LOG).write_text("MES2018-05-24_12:05:58.778\n", encoding='utf-8')
+    with pytest.raises(ValueError):
+        report.get_drivers(str(tmp_path), trusted=True)
+    (tmp_path / report.START_LOG).write_text("garbage\n", encoding='utf-8')
+    with pytest.raises(ValueError):
+        report.check_source_files(str(tmp_path))
+
+
 def test_format_timedelta():
     time_obj = timedelta(minutes=2, seconds=15, milliseconds=500)
     assert report.format_timedelta(time_obj) == "2:15:500"
@@ -0,0 +1,84 @@
+"""--Pytest for the pre-serialized snapshots of the report of Monaco 2018 Racing--"""
+import gzip
+
+import pytest
+
+from packaging_tutorial.report_FEDONYUK import snapshots
+from packaging_tutorial.report_FEDONYUK.cache_util import version_memo
+from packaging_tutorial.report_FEDONYUK.snapshots import SnapshotStore
+
+URLS = ['/api/v1/report/', '/api/v1/report/?order=desc', '/api/v1/report/?format=xml',
+        '/api/v1/report/?format=xml&order=desc', '/api/v1/report/?driver_id=SVF',
+        '/api/v1/report/?driver_id=LHM&format=xml', '/api/v1/report/drivers/', '/api/v1/report/drivers/?order=desc',
+        '/api/v1/report/drivers/?format=xml', '/api/v1/report/drivers/?driver_id=SVF',
+        '/api/v1/report/?race=monaco-2018', '/api/v1/report/?race=monaco-2018&session=race&order=desc',
+        '/report/', '/report/?order=desc', '/report/drivers/', '/report/drivers/?order=desc',
+        '/report/drivers/?driver_id=SVF', '/report/?race=monaco-2018', '/report/drivers/?race=monaco-2018&session=race']
+
+pytestmark = pytest.mark.usefixtures('store')
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = SnapshotStore()
+    monkeypatch.setattr(snapshots, 'snapshot_store', store)
+    return store
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_snapshot_matches_the_view(client, store, monkeypatch, url):
+    served = client.get(url)
+    monkeypatch.setattr(store, 'get', lambda *args: None)  # no snapshots: the view runs
+    rendered = client.get(url)
+    assert served.headers['ETag'] == rendered.headers['ETag']
+    assert served.status_code == rendered.status_code == 200
+    assert served.data == rendered.data
+    assert served.content_type.split(';')[0] == rendered.content_type.split(';')[0]
+
+
+def test_gzip_variant(client):
+    plain = client.get('/api/v1/report/?format=xml')
+    gzipped = client.get('/api/v1/report/?format=xml', headers={'Accept-Encoding': 'gzip, br'})
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert gzipped.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(gzipped.data) == plain.data
+    assert gzipped.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'  # strong ETags differ by encoding
+
+
+def test_snapshots_are_built_once_per_data_version(client, store, monkeypatch):
+    built = []
+    build_snapshots = snapshots.build_snapshots
+    monkeypatch.setattr(snapshots, 'build_snapshots', lambda *args: built.append(args) or build_snapshots(*args))
+    for url in ('/api/v1/report/', '/report/', '/api/v1/report/drivers/?driver_id=SVF'):
+        client.get(url)
+    assert built == [(None, None)]
+    monkeypatch.setattr(version_memo, 'get', lambda: (store.version + 1, None))  # an import bumped it
+    client.get('/api/v1/report/')
+    assert len(built) == 2
+
+
+def test_queries_without_snapshot_run_the_view(client, store):
+    assert client.get('/api/v1/report/?race=unknown-race').json == []
+    assert store.races == {('unknown-race', None): snapshots.NO_SNAPSHOTS}
+    assert client.get('/api/v1/report/?format=html').status_code == 400
+    assert client.get('/api/v1/report/?driver_id=XXX').json == []
+    assert client.get('/report/', query_string={'driver_id': 'SVF'}).status_code == 302
+
+
+def test_race_without_data_is_built_once_per_data_version(store, monkeypatch):
+    built = []
+    monkeypatch.setattr(snapshots, 'source_version', lambda: (7, None))
+    monkeypatch.setattr(snapshots, 'build_snapshots', lambda *args: built.append(args) or {})
+    for _ in range(3):
+        assert store.get('unknown-race', None, ('report', 'asc', 'json')) is None
+    assert built == [('unknown-race', None)]
+
+
+def test_races_without_data_are_bounded(store, monkeypatch):
+    monkeypatch.setattr(snapshots, 'EMPTY_RACES', 2)
+    monkeypatch.setattr(snapshots, 'source_version', lambda: (7, None))
+    monkeypatch.setattr(snapshots, 'build_snapshots', lambda *args: {})
+    for race in ('a', 'b', 'c'):
+        store.get(race, None, ('report', 'asc', 'json'))
+    assert list(store.races) == [('b', None), ('c', None)]
+    assert not store.builds
@@ -0,0 +1,73 @@
+"""--Pytest for the start time of the Web and CLI report of Monaco 2018 Racing--"""
+import json
+import os
+import subprocess
+import sys
+
+from loguru import logger
+
+from packaging_tutorial.report_FEDONYUK import report_web
+from packaging_tutorial.report_FEDONYUK.log_config import setup_logging
+
+IMPORT_BUDGET = 3.0  # Seconds to import and create the web app in a new interpreter, about 0.7 s on one slow CPU
+LAZY_MODULES = ('redis', 'flasgger', 'numpy', 'pyarrow')
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # parent of packaging_tutorial
+
+
+def cold_start(code: str) -> dict:
+    """Function runs code in a new interpreter and returns the modules it imported and its duration in seconds"""
+    script = ("import json, sys, time\nstarted = time.perf_counter()\n" + code +
+              "\nprint(json.dumps({'seconds': time.perf_counter() - started, 'modules': sorted(sys.modules)}))")
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                            cwd=ROOT).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_web_worker_import_budget():
+    start = cold_start("from packaging_tutorial.report_FEDONYUK.report_web import create_app\ncreate_app()")
+    assert start['seconds'] < IMPORT_BUDGET
+    assert not set(LAZY_MODULES) & set(start['modules'])
+
+
+def test_factory_worker_creates_one_app():
+    created = cold_start("from unittest import mock\nimport flask\n"
+                         "with mock.patch.object(flask.Flask, '__init__', autospec=True,\n"
+                         "                       side_effect=flask.Flask.__init__) as init:\n"
+                         "    from packaging_tutorial.report_FEDONYUK.report_web import create_app\n"
+                         "    create_app()\n"
+                         "assert init.call_count == 1, init.call_count")
+    assert created['seconds'] < IMPORT_BUDGET
+
+
+def test_cli_imports_neither_flask_nor_redis():
+    modules = set(cold_start("import packaging_tutorial.report_FEDONYUK.report_cli")['modules'])
+    assert not {'flask', 'redis', 'sqlalchemy', 'numpy'} & modules
+
+
+def test_logging_is_set_up_once():
+    sink = setup_logging()
+    handlers = len(logger._core.handlers)
+    report_web.create_app()
+    report_web.create_app()
+    assert setup_logging() == sink
+    assert len(logger._core.handlers) == handlers
+
+
+def test_swagger_is_loaded_by_its_first_request():
+    app = report_web.create_app()
+    assert isinstance(app.wsgi_app, report_web.LazySwagger)
+    assert app.wsgi_app.docs is None
+    with app.test_client() as client:
+        assert client.get('/apispec_1.json').json['paths']
+        assert client.get('/apidocs/').status_code == 200
+    assert app.wsgi_app.docs is not None
+
+
+def test_redis_client_is_created_on_first_use(monkeypatch):
+    monkeypatch.setattr(report_web, 'redis_client', None)
+    client = report_web.get_redis()
+    assert report_web.get_redis() is client
+
+
+def test_shared_app_is_created_once():
+    assert report_web.app is report_web.get_app() is report_web.app
@@ -0,0 +1,80 @@
+"""--Pytest for the streamed report payloads of Monaco 2018 Racing--"""
+import gzip
+import json
+import zlib
+
+import pytest
+from dicttoxml import dicttoxml
+
+from packaging_tutorial.report_FEDONYUK import report_api, streaming
+from packaging_tutorial.report_FEDONYUK.cache_util import cache
+from packaging_tutorial.report_FEDONYUK.streaming import StreamCompressor, encode_stream
+
+ROWS = [[1, 'SVF', 'Sebastian Vettel', 'FERRARI', '1:04.415'], [2, 'VBM', 'Valtteri Bottas', 'MERCEDES', '1:12.434'],
+        [3, 'SVM', 'Stoffel Vandoorne', 'MCLAREN RENAULT', '1:12.463']]
+
+
+@pytest.mark.parametrize('batches', [[ROWS], [ROWS[:1], [], ROWS[1:]], [[row] for row in ROWS], []])
+def test_chunks_have_the_bytes_of_the_buffered_formats(batches):
+    rows = [row for batch in batches for row in batch]
+    assert b''.join(encode_stream(batches, 'json')) == (json.dumps(rows) + "\n").encode()
+    assert b''.join(encode_stream(batches, 'xml')) == dicttoxml(rows)
+    assert [json.loads(line) for line in b''.join(encode_stream(batches, 'ndjson')).splitlines()] == rows
+
+
+def test_every_compressed_chunk_can_be_decoded():
+    compressor, decompressor = StreamCompressor('gzip'), zlib.decompressobj(31)
+    first = compressor.compress(b'[1, ')
+    assert decompressor.decompress(first) == b'[1, '  # readable before the end of the stream
+    rest = compressor.compress(b'2]') + compressor.finish()
+    assert gzip.decompress(first + rest) == b'[1, 2]'
+
+
+def test_streamed_report_is_the_buffered_report(client):
+    for query in ('', 'order=desc&format=xml', 'race=monaco-2018&session=race&fields=driver_id,best_lap&limit=4'):
+        response = client.get(f'/api/v1/report/?stream=1&{query}')
+        assert response.is_streamed
+        assert response.data == client.get(f'/api/v1/report/?{query}').data
+
+
+def test_ndjson_rows_come_from_batches_of_the_cursor(client, monkeypatch):
+    batches = []
+    original = report_api.stream_report
+
+    def stream_report(*args, **kwargs):
+        for rows in original(*args, batch_size=5, **kwargs):
+            batches.append(len(rows))
+            yield rows
+    monkeypatch.setattr(report_api, 'stream_report', stream_report)
+    response = client.get('/api/v1/report/?format=ndjson')
+    assert response.content_type == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.data.splitlines()]
+    assert rows == client.get('/api/v1/report/').json
+    assert batches == [5, 5, 5, 4]
+    assert 'ETag' in response.headers
+    assert not cache.cache._cache  # a stream is not cached
+
+
+def test_stream_is_compressed(client, monkeypatch):
+    monkeypatch.setattr(streaming, 'brotli', None)
+    response = client.get('/api/v1/report/?stream=1', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'].endswith('-gzip"')
+    assert gzip.decompress(response.data) == client.get('/api/v1/report/').data
+
+
+def test_stream_is_compressed_with_brotli(client):
+    brotli = pytest.importorskip('brotli')
+    response = client.get('/api/v1/report/?format=ndjson', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    body = response.data
+    revalidated = client.get('/api/v1/report/?format=ndjson', headers={'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert brotli.decompress(body) == client.get('/api/v1/report/?format=ndjson').data
+
+
+def test_invalid_stream_query(client):
+    for query in ('stream=1&format=html', 'format=ndjson&limit=0', 'stream=1&cursor=abc'):
+        response = client.get(f'/api/v1/report/?{query}')
+        assert response.status_code == 400
+        assert 'Invalid' in response.json['error']
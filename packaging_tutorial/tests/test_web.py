@@ -73,7 +73,7 @@ def test_show_drivers_desc(client):
 
 
 def test_show_report_with_driver_id(client):
-    response = client.get('/report/', query_string={'driver_id': 'SVM'})
+    response = client.get('/report/', query_string={'driver_id': 'SVM'}, follow_redirects=True)
     assert response.status_code == 200  # Redirect to /report/drivers/?driver_id=SVM
 
 